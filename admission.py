@@ -0,0 +1,116 @@
+import threading
+import time
+
+# Most peer connections, established or still handshaking, at once.
+DEFAULT_MAX_CONNECTIONS = 1024
+# Most sockets in the introduce handshake at once; while there are this
+# many, new connections wait in the listen backlog.
+DEFAULT_MAX_PENDING_CONNECTIONS = 64
+# Kernel queue of connections not yet accepted.
+DEFAULT_LISTEN_BACKLOG = 128
+# Seconds a new connection gets to complete the introduce handshake.
+DEFAULT_HANDSHAKE_TIMEOUT = 10.0
+
+
+class TokenBucket:
+    """
+    Refills `rate` tokens per second up to `burst`. consume() always
+    succeeds but may leave the bucket in debt; it returns how long the
+    caller should pause for the debt to be paid back.
+    """
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def consume(self, amount):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class ReceiveLimiter:
+    """
+    Per-peer limits on received messages and bytes per second. The reader
+    charges every frame it handles and, once over the limit, stops reading
+    that socket for the returned delay, so a flooding peer is slowed down
+    by TCP flow control instead of having its messages dropped.
+    """
+    __slots__ = ("messages", "bytes", "throttled", "throttled_seconds")
+
+    def __init__(self, message_rate=0, message_burst=0, byte_rate=0, byte_burst=0):
+        self.messages = TokenBucket(message_rate, message_burst or message_rate) if message_rate else None
+        self.bytes = TokenBucket(byte_rate, byte_burst or byte_rate) if byte_rate else None
+        self.throttled = 0
+        self.throttled_seconds = 0.0
+
+    def charge(self, messages, nbytes):
+        """Account for received frames. Returns the seconds to pause reading, 0.0 if none."""
+        delay = 0.0
+        if self.messages:
+            delay = self.messages.consume(messages)
+        if self.bytes:
+            delay = max(delay, self.bytes.consume(nbytes))
+        if delay:
+            self.throttled += 1
+            self.throttled_seconds += delay
+        return delay
+
+
+class AdmissionControl:
+    """
+    Caps on connections. Every accepted or dialed socket is admitted
+    before use and released when its handshake ends. Beyond
+    max_connections in total, new sockets are closed at once. While
+    max_pending are still in the introduce handshake the engines stop
+    accepting, so a burst of connects waits in the listen backlog instead
+    of costing a thread (or buffers) each.
+    """
+
+    def __init__(self, network, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 max_pending=DEFAULT_MAX_PENDING_CONNECTIONS):
+        self.network = network
+        self.max_connections = max_connections
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.released = threading.Condition(self.lock)
+        self.pending = 0
+        self.rejected = 0
+        self.handshake_timeouts = 0
+
+    def accepting(self):
+        """Whether the engine should accept another connection now."""
+        return self.pending < self.max_pending
+
+    def wait_accepting(self, timeout):
+        with self.released:
+            return self.released.wait_for(self.accepting, timeout)
+
+    def admit(self, addr, inbound=True):
+        """Reserve a handshake slot for a new socket. Returns False if the connection limit is reached."""
+        with self.network.lock:
+            established = len(self.network.connections)
+        with self.lock:
+            if self.pending + established < self.max_connections:
+                self.pending += 1
+                return True
+            self.rejected += 1
+        print(f"[WARN] Refusing connection {'from' if inbound else 'to'} {addr}: "
+              f"limit of {self.max_connections} connections reached")
+        return False
+
+    def release(self):
+        """The handshake of an admitted socket finished, successfully or not."""
+        with self.released:
+            self.pending -= 1
+            self.released.notify()
+
+    def handshake_timed_out(self, addr, timeout):
+        with self.lock:
+            self.handshake_timeouts += 1
+        print(f"[WARN] No introduction from {addr} within {timeout:g}s. Closing connection.")
@@ -0,0 +1,129 @@
+"""
+Latency/throughput trade-off of write coalescing for small messages.
+
+Two peers on loopback. For each setting the sender first fires a burst of
+chat messages as fast as it can (throughput), then sends at a fixed rate
+while the receiver records how long each message took to arrive (latency).
+Run from the repository root:
+
+    python benchmarks/bench_coalescing.py --engine selector --windows 0 0.0005 0.002 0.01
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import NetworkConfig
+from network import PeerNetwork
+
+
+def wait_for_peer(network, username, timeout=5.0):
+    deadline = time.time() + timeout
+    while username not in network.list_peers():
+        if time.time() > deadline:
+            raise RuntimeError(f"{network.username} never connected to {username}")
+        time.sleep(0.01)
+
+
+class Receiver:
+    """Collects one-way latencies from chat messages carrying their send time."""
+
+    def __init__(self):
+        self.latencies = []
+        self.count = 0
+        self.done = threading.Event()
+        self.expected = 0
+
+    def reset(self, expected):
+        self.latencies = []
+        self.count = 0
+        self.expected = expected
+        self.done.clear()
+
+    def __call__(self, output):
+        if not isinstance(output, str) or not output.startswith("[CHAT]"):
+            return
+        sent_at = float(output.rsplit(": ", 1)[1])
+        self.latencies.append(time.perf_counter() - sent_at)
+        self.count += 1
+        if self.count >= self.expected:
+            self.done.set()
+
+
+def run_setting(engine, port, label, config, burst, rate, paced):
+    receiver = Receiver()
+    server = PeerNetwork("receiver", "127.0.0.1", port, engine=engine, config=config)
+    server.message_callback = receiver
+    server.start_server()
+    client = PeerNetwork("sender", "127.0.0.1", 0, engine=engine, config=config)
+    client.message_callback = lambda output: None
+    try:
+        client.connect_to_peer("127.0.0.1", port)
+        wait_for_peer(client, "receiver")
+        wait_for_peer(server, "sender")
+
+        receiver.reset(burst)
+        start = time.perf_counter()
+        for _ in range(burst):
+            client.send_chat_message("receiver", repr(time.perf_counter()))
+        if not receiver.done.wait(60):
+            raise RuntimeError(f"Only {receiver.count} of {burst} burst messages arrived")
+        throughput = burst / (time.perf_counter() - start)
+
+        receiver.reset(paced)
+        interval = 1.0 / rate
+        next_send = time.perf_counter()
+        for _ in range(paced):
+            while time.perf_counter() < next_send:
+                time.sleep(0)  # yield the GIL to the network threads
+            client.send_chat_message("receiver", repr(time.perf_counter()))
+            next_send += interval
+        if not receiver.done.wait(60):
+            raise RuntimeError(f"Only {receiver.count} of {paced} paced messages arrived")
+        latencies = sorted(receiver.latencies)
+        stats = client.queue_stats().get("receiver", {})
+    finally:
+        client.shutdown()
+        server.shutdown()
+
+    writes = stats.get("coalesced_writes") or 0
+    per_write = stats.get("coalesced_frames", 0) / writes if writes else 1.0
+    p50 = statistics.median(latencies) * 1e6
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1e6
+    return label, throughput, p50, p99, per_write
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engine", choices=("threaded", "selector"), default="selector")
+    parser.add_argument("--windows", type=float, nargs="+", default=[0.0, 0.0005, 0.002, 0.01],
+                        help="coalescing windows to try, in seconds")
+    parser.add_argument("--max-bytes", type=int, default=64 * 1024)
+    parser.add_argument("--burst", type=int, default=20000, help="messages in the throughput burst")
+    parser.add_argument("--rate", type=float, default=2000, help="messages per second in the latency run")
+    parser.add_argument("--paced", type=int, default=2000, help="messages in the latency run")
+    parser.add_argument("--no-nodelay", action="store_true", help="leave Nagle's algorithm enabled")
+    parser.add_argument("--port", type=int, default=19500)
+    args = parser.parse_args()
+
+    settings = [("off", NetworkConfig(tcp_nodelay=not args.no_nodelay))]
+    for window in args.windows:
+        settings.append((f"window {window * 1000:g}ms", NetworkConfig(
+            tcp_nodelay=not args.no_nodelay, coalesce=True,
+            coalesce_window=window, coalesce_max_bytes=args.max_bytes,
+        )))
+
+    print(f"{'setting':>16} {'burst msg/s':>12} {'p50 us':>10} {'p99 us':>10} {'frames/write':>13}")
+    for offset, (label, config) in enumerate(settings):
+        label, throughput, p50, p99, per_write = run_setting(
+            args.engine, args.port + offset, label, config, args.burst, args.rate, args.paced
+        )
+        print(f"{label:>16} {throughput:12.0f} {p50:10.0f} {p99:10.0f} {per_write:13.1f}")
+
+
+if __name__ == "__main__":
+    main()
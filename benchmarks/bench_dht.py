@@ -0,0 +1,84 @@
+"""
+Username lookups over the DHT as the network grows.
+
+Starts N selector-engine peers on loopback with the DHT enabled, each
+joining through the first one, lets every peer republish its record, then
+resolves random usernames from random peers. Reports the success rate,
+round trips per lookup (which should grow with log n) and lookup latency.
+Run from the repository root:
+
+    python benchmarks/bench_dht.py --peers 200 --lookups 50
+    python benchmarks/bench_dht.py --peers 500 --k 8 --alpha 3
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import NetworkConfig
+from network import PeerNetwork
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--peers", type=int, default=100)
+    parser.add_argument("--lookups", type=int, default=30)
+    parser.add_argument("--k", type=int, default=8, help="bucket size and replication factor")
+    parser.add_argument("--alpha", type=int, default=3, help="parallel queries per lookup round")
+    parser.add_argument("--settle", type=float, default=3.0, help="seconds to let joins finish")
+    parser.add_argument("--port", type=int, default=27000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    networks = []
+    rpcs = []
+    latencies = []
+    resolved = 0
+    try:
+        for i in range(args.peers):
+            bootstrap = (("127.0.0.1", args.port),) if i else ()
+            config = NetworkConfig(dht=True, dht_bootstrap=bootstrap, dht_k=args.k, dht_alpha=args.alpha,
+                                   heartbeat_interval=0)
+            network = PeerNetwork(f"peer{i}", "127.0.0.1", args.port + i, engine="selector", config=config)
+            network.message_callback = lambda output: None
+            network.start_server()
+            networks.append(network)
+            time.sleep(0.02)
+        time.sleep(args.settle)
+        # Early joiners stored their records before their true closest nodes existed.
+        for network in networks:
+            network.dht.publish()
+
+        for _ in range(args.lookups):
+            source, target = rng.sample(networks, 2)
+            before = source.dht.rpcs_sent
+            started = time.perf_counter()
+            address = source.dht.resolve(target.username)
+            latencies.append(time.perf_counter() - started)
+            rpcs.append(source.dht.rpcs_sent - before)
+            resolved += address == ("127.0.0.1", target.port)
+        contacts = sorted(len(network.dht.table) for network in networks)
+    finally:
+        for network in networks:
+            network.shutdown()
+
+    latencies.sort()
+    print(f"{args.peers} peers, k {args.k}, alpha {args.alpha}")
+    print(f"  resolved:   {resolved}/{args.lookups}")
+    print(f"  rpcs:       mean {sum(rpcs) / len(rpcs):.1f}, max {max(rpcs)} per lookup")
+    print(f"  latency:    p50 {percentile(latencies, 0.5) * 1000:.1f} ms, p99 {percentile(latencies, 0.99) * 1000:.1f} ms")
+    print(f"  contacts:   median {contacts[len(contacts) // 2]} per routing table")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Loopback throughput of the file transfer paths.
+
+Compares the original ChatPanel.send_file approach (whole file read into
+memory, base64-encoded and sent as one JSON message) with the streaming
+transfer in each of its send modes. Run from the repository root:
+
+    python benchmarks/bench_file_transfer.py --size-mb 64 --engine selector
+"""
+import argparse
+import base64
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import NetworkConfig
+from network import PeerNetwork
+
+MODES = ("base64", "copy", "mmap", "sendfile")
+
+
+def make_file(path, size):
+    block = os.urandom(1024 * 1024)
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining > 0:
+            f.write(block[:min(remaining, len(block))])
+            remaining -= len(block)
+
+
+def wait_for_peer(network, username, timeout=5.0):
+    deadline = time.time() + timeout
+    while username not in network.list_peers():
+        if time.time() > deadline:
+            raise RuntimeError(f"{network.username} never connected to {username}")
+        time.sleep(0.01)
+
+
+def run_once(mode, engine, path, size, port, download_dir):
+    done = threading.Event()
+
+    def on_message(msg):
+        if not isinstance(msg, dict):
+            return
+        if msg.get("type") == "file_transfer":
+            # The receiver of the old path has to decode the payload as well.
+            base64.b64decode(msg["content"])
+            done.set()
+        elif msg.get("type") == "file_received":
+            done.set()
+
+    # The base64 path sends one frame larger than the file itself.
+    max_frame = max(size * 2, 64 * 1024 * 1024)
+    send_mode = "auto" if mode == "base64" else mode
+    receiver = PeerNetwork("receiver", "127.0.0.1", port, engine=engine,
+                           config=NetworkConfig(download_dir=download_dir, max_frame_size=max_frame))
+    receiver.message_callback = on_message
+    receiver.start_server()
+    sender = PeerNetwork("sender", "127.0.0.1", 0, engine=engine,
+                         config=NetworkConfig(file_send_mode=send_mode, max_frame_size=max_frame))
+    sender.message_callback = lambda msg: None
+    try:
+        sender.connect_to_peer("127.0.0.1", port)
+        wait_for_peer(sender, "receiver")
+        start = time.perf_counter()
+        if mode == "base64":
+            with open(path, "rb") as f:
+                file_data = f.read()
+            file_msg = {
+                "type": "file_transfer",
+                "sender": "sender",
+                "recipient": "receiver",
+                "filename": os.path.basename(path),
+                "filesize": len(file_data),
+                "content": base64.b64encode(file_data).decode("utf-8"),
+            }
+            sender.send_chat_message("receiver", file_msg, is_dict=True)
+        else:
+            sender.send_file("receiver", path)
+        if not done.wait(timeout=300):
+            raise RuntimeError(f"{mode} transfer did not finish")
+        return time.perf_counter() - start
+    finally:
+        sender.shutdown()
+        receiver.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=64)
+    parser.add_argument("--engine", choices=("threaded", "selector"), default="threaded")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--port", type=int, default=47000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="p2p-bench-")
+    size = args.size_mb * 1024 * 1024
+    path = os.path.join(workdir, "payload.bin")
+    make_file(path, size)
+    port = args.port
+    try:
+        print(f"{'mode':<10} {'best s':>8} {'GB/s':>8}")
+        for mode in args.modes:
+            best = None
+            for _ in range(args.repeat):
+                download_dir = tempfile.mkdtemp(dir=workdir)
+                elapsed = run_once(mode, args.engine, path, size, port, download_dir)
+                shutil.rmtree(download_dir)
+                port += 1
+                best = elapsed if best is None else min(best, elapsed)
+            print(f"{mode:<10} {best:>8.3f} {size / best / 1e9:>8.2f}")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Delivery and cost of group messages gossiped over a partial mesh.
+
+Starts N selector-engine peers on loopback, wires each to a ring neighbour
+plus random extra neighbours until the average degree is reached, then
+publishes group messages from random peers. Reports the fraction of peers
+each message reached, origin-to-peer latency, and how many copies were
+sent and dropped as duplicates per message. Run from the repository root:
+
+    python benchmarks/bench_gossip.py --peers 500 --degree 6 --messages 50
+    python benchmarks/bench_gossip.py --peers 200 --fanout 3 --ttl 8
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import NetworkConfig
+from network import PeerNetwork
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def overlay_edges(count, degree, rng):
+    """A ring (so the overlay is connected) plus random chords up to the average degree."""
+    edges = {(i, (i + 1) % count) for i in range(count)}
+    target = min(count * degree // 2, count * (count - 1) // 2)
+    while len(edges) < target:
+        a, b = rng.sample(range(count), 2)
+        if (b, a) not in edges:
+            edges.add((a, b))
+    return sorted(edges)
+
+
+class Collector:
+    """Records when each peer first delivered each group message."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.arrivals = {}  # mapping: message id -> list of one-way latencies
+
+    def callback(self):
+        def on_message(output):
+            if isinstance(output, dict) and output.get("type") == "group_chat":
+                now = time.perf_counter()
+                with self.lock:
+                    self.arrivals.setdefault(output["id"], []).append(now - output["sent_at"])
+        return on_message
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--peers", type=int, default=100)
+    parser.add_argument("--degree", type=int, default=6, help="average number of neighbours")
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--fanout", type=int, default=0, help="relay fanout, 0 floods to all neighbours")
+    parser.add_argument("--ttl", type=int, default=8)
+    parser.add_argument("--interval", type=float, default=0.05, help="seconds between published messages")
+    parser.add_argument("--settle", type=float, default=3.0, help="seconds to wait for delivery")
+    parser.add_argument("--port", type=int, default=26000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    config = NetworkConfig(gossip_ttl=args.ttl, gossip_fanout=args.fanout, heartbeat_interval=0)
+    collector = Collector()
+    networks = []
+    try:
+        for i in range(args.peers):
+            network = PeerNetwork(f"peer{i}", "127.0.0.1", args.port + i, engine="selector", config=config)
+            network.message_callback = collector.callback()
+            network.start_server()
+            networks.append(network)
+        edges = overlay_edges(args.peers, args.degree, rng)
+        for a, b in edges:
+            networks[a].connect_to_peer("127.0.0.1", args.port + b)
+        deadline = time.time() + 30
+        while sum(len(network.list_peers()) for network in networks) < 2 * len(edges):
+            if time.time() > deadline:
+                raise RuntimeError("overlay never finished connecting")
+            time.sleep(0.05)
+
+        for _ in range(args.messages):
+            origin = rng.choice(networks)
+            origin.send_group_message("bench", "x", {"sent_at": time.perf_counter()})
+            time.sleep(args.interval)
+        time.sleep(args.settle)
+    finally:
+        stats = [network.gossip.stats() for network in networks]
+        for network in networks:
+            network.shutdown()
+
+    with collector.lock:
+        reached = [len(latencies) / (args.peers - 1) for latencies in collector.arrivals.values()]
+        latencies = sorted(latency for values in collector.arrivals.values() for latency in values)
+    reached += [0.0] * (args.messages - len(reached))
+    relayed = sum(s["relayed"] for s in stats)
+    duplicates = sum(s["duplicates"] for s in stats)
+    print(f"{args.peers} peers, {len(edges)} connections, fanout {args.fanout or 'all'}, ttl {args.ttl}")
+    print(f"  reached:    mean {100 * sum(reached) / len(reached):.1f}% of peers, worst {100 * min(reached):.1f}%")
+    print(f"  latency:    p50 {percentile(latencies, 0.5) * 1000:.1f} ms, p99 {percentile(latencies, 0.99) * 1000:.1f} ms")
+    print(f"  per message: {relayed / args.messages:.0f} copies sent, {duplicates / args.messages:.0f} duplicates "
+          f"dropped (full mesh would need {args.peers * (args.peers - 1) // 2} connections)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Store-and-forward delivery of a large outbox.
+
+A sender queues N chat messages for a peer that is offline, is restarted
+(the outbox lives on disk), then the receiver comes up and the sender
+connects to it. While the backlog is being delivered the sender keeps
+sending, and those messages must arrive after the queued ones. Reports
+the queueing rate, delivery time and whether everything arrived once, in
+order. Run from the repository root:
+
+    python benchmarks/bench_outbox.py --messages 50000
+    python benchmarks/bench_outbox.py --engine selector --batch 1024
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import NetworkConfig
+from network import ENGINES, PeerNetwork
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--live", type=int, default=500, help="messages sent while the backlog is delivered")
+    parser.add_argument("--batch", type=int, default=256, help="outbox batch size")
+    parser.add_argument("--engine", choices=ENGINES, default="threaded")
+    parser.add_argument("--port", type=int, default=27500)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    config = NetworkConfig(heartbeat_interval=0, reconnect=False, outbox_dir=directory,
+                           outbox_max_messages=args.messages + args.live, outbox_batch_size=args.batch)
+    received = []
+    sender = receiver = None
+    try:
+        sender = PeerNetwork("sender", "127.0.0.1", args.port, engine=args.engine, config=config)
+        started = time.perf_counter()
+        for i in range(args.messages):
+            sender.send_chat_message("receiver", str(i))
+        queue_time = time.perf_counter() - started
+        sender.shutdown()
+
+        sender = PeerNetwork("sender", "127.0.0.1", args.port, engine=args.engine, config=config)
+        receiver = PeerNetwork("receiver", "127.0.0.1", args.port + 1, engine=args.engine,
+                               config=NetworkConfig(heartbeat_interval=0, reconnect=False))
+        receiver.add_handler("chat", lambda message, peer: received.append(int(message.content)))
+        receiver.start_server()
+        total = args.messages + args.live
+        started = time.perf_counter()
+        sender.connect_to_peer("127.0.0.1", args.port + 1)
+        for i in range(args.messages, total):
+            sender.send_chat_message("receiver", str(i))
+        deadline = time.monotonic() + 120
+        while len(received) < total and time.monotonic() < deadline:
+            time.sleep(0.005)
+        deliver_time = time.perf_counter() - started
+    finally:
+        for network in (sender, receiver):
+            if network:
+                network.shutdown()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    print(f"{args.messages} queued + {args.live} live messages, {args.engine} engine, batch {args.batch}")
+    print(f"  queueing:   {queue_time:.2f} s ({args.messages / queue_time:.0f} msg/s)")
+    print(f"  delivery:   {deliver_time:.2f} s ({len(received) / deliver_time:.0f} msg/s)")
+    print(f"  received:   {len(received)}/{total}, in order {received == list(range(total))}")
+
+
+if __name__ == "__main__":
+    main()
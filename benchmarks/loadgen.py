@@ -0,0 +1,311 @@
+"""
+Loopback load generator for PeerNetwork.
+
+Starts N peers on localhost wired up as a star, full mesh or chain, drives
+chat, presence and (optionally) file traffic between neighbours for a fixed
+time and reports throughput, end-to-end chat latency, CPU and RSS. Every
+combination of the given engines, framings and codecs is run in turn and
+the results are written as JSON, which --compare checks against an older
+run. Run from the repository root:
+
+    python benchmarks/loadgen.py --topology star --peers 10 --duration 5 --output star.json
+    python benchmarks/loadgen.py --engine threaded selector --framing length newline --compare star.json
+"""
+import argparse
+import itertools
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import NetworkConfig
+from message import available_codecs
+from network import ENGINES, PeerNetwork
+
+TOPOLOGIES = ("star", "mesh", "chain")
+
+# Metrics compared by --compare, and whether bigger is better.
+COMPARED_METRICS = (
+    ("msgs_per_sec", True),
+    ("chat_mb_per_sec", True),
+    ("file_mb_per_sec", True),
+    ("latency_p50_us", False),
+    ("latency_p99_us", False),
+    ("latency_p999_us", False),
+    ("cpu_seconds", False),
+    ("rss_peak_mb", False),
+)
+
+
+def topology_edges(topology, count):
+    """(connecting peer, listening peer) index pairs."""
+    if topology == "star":
+        return [(i, 0) for i in range(1, count)]
+    if topology == "chain":
+        return [(i, i - 1) for i in range(1, count)]
+    return [(i, j) for i in range(count) for j in range(i)]
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def rss_mb():
+    """Current resident set size, where /proc is available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except (OSError, ValueError):
+        return None
+
+
+class Collector:
+    """Counts what the peers receive and records chat latencies."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.chat_messages = 0
+        self.chat_bytes = 0
+        self.presence_messages = 0
+        self.files = 0
+        self.file_bytes = 0
+
+    def __call__(self, output):
+        now = time.perf_counter()
+        with self.lock:
+            if isinstance(output, dict):
+                if output.get("type") == "file_received":
+                    self.files += 1
+                    self.file_bytes += output.get("filesize", 0)
+            elif output.startswith("[CHAT]"):
+                content = output.split(": ", 1)[1]
+                self.latencies.append(now - float(content.split("|", 1)[0]))
+                self.chat_messages += 1
+                self.chat_bytes += len(content)
+            elif output.startswith("[PRESENCE]"):
+                self.presence_messages += 1
+
+
+class Sender(threading.Thread):
+    """Sends chat at a fixed rate to every neighbour, plus periodic presence."""
+
+    def __init__(self, network, neighbours, rate, message_size, presence_interval, stop):
+        super().__init__(daemon=True)
+        self.network = network
+        self.neighbours = neighbours
+        self.rate = rate
+        self.padding = "x" * max(0, message_size - 20)
+        self.presence_interval = presence_interval
+        self.stop = stop
+        self.sent = 0
+
+    def run(self):
+        start = time.perf_counter()
+        next_presence = start + self.presence_interval if self.presence_interval else None
+        targets = itertools.cycle(self.neighbours)
+        while not self.stop.is_set():
+            now = time.perf_counter()
+            if next_presence is not None and now >= next_presence:
+                self.network.broadcast_presence("online")
+                next_presence += self.presence_interval
+            if self.rate and self.sent >= (now - start) * self.rate:
+                time.sleep(0.001)
+                continue
+            self.network.send_chat_message(next(targets), f"{time.perf_counter()!r}|{self.padding}")
+            self.sent += 1
+
+
+def wait_for_topology(networks, neighbours, timeout=10.0):
+    deadline = time.time() + timeout
+    for index, network in enumerate(networks):
+        expected = {networks[n].username for n in neighbours[index]}
+        while not expected.issubset(network.list_peers()):
+            if time.time() > deadline:
+                missing = expected - set(network.list_peers())
+                raise RuntimeError(f"{network.username} never connected to {sorted(missing)}")
+            time.sleep(0.01)
+
+
+def run_once(args, engine, framing, codec, port):
+    download_dir = tempfile.mkdtemp(prefix="loadgen-")
+    config = NetworkConfig(
+        framings=(framing,) if framing == "newline" else (framing, "newline"),
+        codecs=(codec, "json") if codec != "json" else ("json",),
+        compressions=tuple(args.compression),
+        channels=not args.no_channels,
+        coalesce=args.coalesce,
+        download_dir=download_dir,
+    )
+    collector = Collector()
+    networks = []
+    for i in range(args.peers):
+        network = PeerNetwork(f"peer{i}", "127.0.0.1", port + i, engine=engine, config=config)
+        network.message_callback = collector
+        networks.append(network)
+    neighbours = {i: [] for i in range(args.peers)}
+    for a, b in topology_edges(args.topology, args.peers):
+        neighbours[a].append(b)
+        neighbours[b].append(a)
+
+    source = None
+    try:
+        for network in networks:
+            network.start_server()
+        for a, b in topology_edges(args.topology, args.peers):
+            networks[a].connect_to_peer("127.0.0.1", port + b)
+        wait_for_topology(networks, neighbours)
+
+        if args.file_mb:
+            source = os.path.join(download_dir, "loadgen-source.bin")
+            with open(source, "wb") as f:
+                f.write(os.urandom(args.file_mb * 1024 * 1024))
+
+        stop = threading.Event()
+        senders = [
+            Sender(network, [networks[n].username for n in neighbours[i]], args.rate,
+                   args.message_size, args.presence_interval, stop)
+            for i, network in enumerate(networks) if neighbours[i]
+        ]
+        cpu_start = os.times()
+        wall_start = time.perf_counter()
+        if source:
+            for i, network in enumerate(networks):
+                if neighbours[i]:
+                    network.send_file(networks[neighbours[i][0]].username, source)
+        for sender in senders:
+            sender.start()
+        time.sleep(args.duration)
+        stop.set()
+        for sender in senders:
+            sender.join()
+        sent = sum(sender.sent for sender in senders)
+        expected_files = len(senders) if source else 0
+        # Let queued traffic drain before taking the measurements.
+        drain_deadline = time.perf_counter() + args.drain_timeout
+        while time.perf_counter() < drain_deadline:
+            with collector.lock:
+                if collector.chat_messages >= sent and collector.files >= expected_files:
+                    break
+            time.sleep(0.01)
+        wall = time.perf_counter() - wall_start
+        cpu_end = os.times()
+        current_rss = rss_mb()
+    finally:
+        for network in networks:
+            network.shutdown()
+        shutil.rmtree(download_dir, ignore_errors=True)
+
+    latencies = sorted(collector.latencies)
+    return {
+        "engine": engine,
+        "framing": framing,
+        "codec": codec,
+        "topology": args.topology,
+        "peers": args.peers,
+        "duration": args.duration,
+        "rate_per_peer": args.rate,
+        "message_size": args.message_size,
+        "compression": list(args.compression),
+        "channels": not args.no_channels,
+        "coalesce": args.coalesce,
+        "wall_seconds": wall,
+        "chat_sent": sent,
+        "chat_received": collector.chat_messages,
+        "presence_received": collector.presence_messages,
+        "files_received": collector.files,
+        "msgs_per_sec": collector.chat_messages / wall,
+        "chat_mb_per_sec": collector.chat_bytes / wall / 1e6,
+        "file_mb_per_sec": collector.file_bytes / wall / 1e6,
+        "latency_p50_us": percentile(latencies, 0.50) * 1e6,
+        "latency_p99_us": percentile(latencies, 0.99) * 1e6,
+        "latency_p999_us": percentile(latencies, 0.999) * 1e6,
+        "latency_max_us": (latencies[-1] if latencies else 0.0) * 1e6,
+        "cpu_seconds": (cpu_end.user - cpu_start.user) + (cpu_end.system - cpu_start.system),
+        "cpu_percent": 100.0 * ((cpu_end.user - cpu_start.user) + (cpu_end.system - cpu_start.system)) / wall,
+        # ru_maxrss is in kilobytes on Linux.
+        "rss_peak_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "rss_mb": current_rss,
+    }
+
+
+def run_key(result):
+    return (result["engine"], result["framing"], result["codec"], result["topology"], result["peers"])
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {run_key(result): result for result in json.load(f)["runs"]}
+    print(f"\nCompared with {baseline_path} (+ is better):")
+    for result in results:
+        old = baseline.get(run_key(result))
+        if old is None:
+            print(f"  {'/'.join(map(str, run_key(result)))}: no baseline run")
+            continue
+        changes = []
+        for metric, higher_is_better in COMPARED_METRICS:
+            if not old.get(metric) or result.get(metric) is None:
+                continue
+            change = (result[metric] - old[metric]) / old[metric] * 100
+            changes.append(f"{metric} {change if higher_is_better else -change:+.1f}%")
+        print(f"  {'/'.join(map(str, run_key(result)))}: " + ", ".join(changes))
+
+
+def print_result(result):
+    print(f"{result['engine']:>9} {result['framing']:>8} {result['codec']:>8} "
+          f"{result['msgs_per_sec']:10.0f} {result['chat_mb_per_sec'] + result['file_mb_per_sec']:8.1f} "
+          f"{result['latency_p50_us']:9.0f} {result['latency_p99_us']:9.0f} {result['latency_p999_us']:9.0f} "
+          f"{result['cpu_percent']:6.0f} {result['rss_peak_mb']:8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--topology", choices=TOPOLOGIES, default="star")
+    parser.add_argument("--peers", type=int, default=5)
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds of traffic per run")
+    parser.add_argument("--rate", type=float, default=1000, help="chat messages per second per peer, 0 = flat out")
+    parser.add_argument("--message-size", type=int, default=100, help="approximate chat content bytes")
+    parser.add_argument("--presence-interval", type=float, default=1.0, help="seconds between presence broadcasts")
+    parser.add_argument("--file-mb", type=int, default=0, help="size of one file each peer sends to a neighbour")
+    parser.add_argument("--engine", choices=ENGINES, nargs="+", default=["threaded"])
+    parser.add_argument("--framing", choices=("length", "newline"), nargs="+", default=["length"])
+    parser.add_argument("--codec", choices=available_codecs(), nargs="+", default=["json"])
+    parser.add_argument("--compression", nargs="*", default=[], help="compressors to offer (default none)")
+    parser.add_argument("--no-channels", action="store_true")
+    parser.add_argument("--coalesce", action="store_true")
+    parser.add_argument("--drain-timeout", type=float, default=10.0)
+    parser.add_argument("--port", type=int, default=21000)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", metavar="BASELINE", help="compare with the JSON of an earlier run")
+    args = parser.parse_args()
+
+    runs = []
+    print(f"{'engine':>9} {'framing':>8} {'codec':>8} {'msgs/s':>10} {'MB/s':>8} "
+          f"{'p50 us':>9} {'p99 us':>9} {'p999 us':>9} {'cpu%':>6} {'rss MB':>8}")
+    port = args.port
+    for engine, framing, codec in itertools.product(args.engine, args.framing, args.codec):
+        if framing == "newline" and codec != "json":
+            continue  # binary codecs are only negotiated with length framing
+        result = run_once(args, engine, framing, codec, port)
+        port += args.peers
+        runs.append(result)
+        print_result(result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "argv": sys.argv[1:], "runs": runs}, f, indent=2)
+        print(f"\nResults written to {args.output}")
+    if args.compare:
+        compare(runs, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+# Logical channels multiplexed over one peer connection, most urgent first.
+# The writer always serves the most urgent channel that has data and credit,
+# and large messages are split into fragments, so bulk data never holds the
+# socket for longer than one fragment or file chunk.
+CHANNEL_CONTROL = 0
+CHANNEL_CHAT = 1
+CHANNEL_BULK = 2
+CHANNELS = (CHANNEL_CONTROL, CHANNEL_CHAT, CHANNEL_BULK)
+CHANNEL_NAMES = {CHANNEL_CONTROL: "control", CHANNEL_CHAT: "chat", CHANNEL_BULK: "bulk"}
+
+# Receive windows we advertise per channel: how many bytes the peer may have
+# outstanding on that channel before it waits for a window_update. Control
+# is not flow controlled, so window updates themselves can never stall.
+DEFAULT_CHAT_WINDOW = 1024 * 1024
+DEFAULT_BULK_WINDOW = 4 * 1024 * 1024
+# Messages larger than this are sent as several interleavable fragments.
+DEFAULT_FRAGMENT_SIZE = 64 * 1024
+
+# mapping: message type -> channel; anything unlisted travels on chat
+MESSAGE_CHANNELS = {
+    "introduce": CHANNEL_CONTROL,
+    "presence": CHANNEL_CONTROL,
+    "window_update": CHANNEL_CONTROL,
+    "file_transfer": CHANNEL_BULK,
+}
+
+
+def assign_channel(msg_type, channel):
+    """Route every message of msg_type over channel."""
+    MESSAGE_CHANNELS[msg_type] = channel
+
+
+def channel_for(message_dict):
+    return MESSAGE_CHANNELS.get(message_dict.get("type"), CHANNEL_CHAT)
@@ -0,0 +1,157 @@
+import threading
+import time
+import zlib
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Frames smaller than this are sent as they are; compressing them costs
+# more CPU than the bytes it saves.
+DEFAULT_COMPRESSION_THRESHOLD = 1024
+
+
+class ZlibCompressor:
+    """DEFLATE from the standard library; always available."""
+    name = "zlib"
+    priority = 0
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data, max_size):
+        decompressor = zlib.decompressobj()
+        result = decompressor.decompress(data, max_size)
+        if decompressor.unconsumed_tail:
+            raise ValueError(f"Compressed frame expands beyond {max_size} bytes")
+        return result
+
+
+class Lz4Compressor:
+    """LZ4 frame format, available when the lz4 package is installed."""
+    name = "lz4"
+    priority = 10
+
+    def compress(self, data):
+        return lz4_frame.compress(data, store_size=True)
+
+    def decompress(self, data, max_size):
+        result = lz4_frame.decompress(data)
+        if len(result) > max_size:
+            raise ValueError(f"Compressed frame expands beyond {max_size} bytes")
+        return result
+
+
+class ZstdCompressor:
+    """Zstandard, available when the zstandard package is installed."""
+    name = "zstd"
+    priority = 20
+
+    def __init__(self, level=3):
+        self.level = level
+
+    def compress(self, data):
+        # Compressor objects are not thread safe, and several threads send.
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def decompress(self, data, max_size):
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=max_size)
+
+
+COMPRESSORS = {}  # mapping: compressor name -> compressor instance
+
+
+def register_compressor(compressor):
+    """Make a compressor available for negotiation under compressor.name."""
+    COMPRESSORS[compressor.name] = compressor
+
+
+def available_compressors():
+    """Names of all registered compressors, most preferred first."""
+    return tuple(name for name, c in sorted(COMPRESSORS.items(), key=lambda item: -item[1].priority))
+
+
+register_compressor(ZlibCompressor())
+if lz4_frame is not None:
+    register_compressor(Lz4Compressor())
+if zstandard is not None:
+    register_compressor(ZstdCompressor())
+
+
+class CompressionStats:
+    """Per-connection counters for the compression ratio and CPU time spent."""
+
+    def __init__(self):
+        self.lock = threading.Lock()  # several threads may send at once
+        self.frames_compressed = 0
+        self.frames_skipped = 0  # above the threshold but did not shrink
+        self.bytes_in = 0        # payload bytes before compression
+        self.bytes_out = 0       # bytes actually put on the wire for them
+        self.compress_seconds = 0.0
+        self.frames_decompressed = 0
+        self.bytes_received = 0
+        self.bytes_expanded = 0
+        self.decompress_seconds = 0.0
+
+    def record_compress(self, size_in, size_out, seconds, skipped):
+        with self.lock:
+            self.compress_seconds += seconds
+            self.bytes_in += size_in
+            self.bytes_out += size_out
+            if skipped:
+                self.frames_skipped += 1
+            else:
+                self.frames_compressed += 1
+
+    def record_decompress(self, size_in, size_out, seconds):
+        with self.lock:
+            self.decompress_seconds += seconds
+            self.frames_decompressed += 1
+            self.bytes_received += size_in
+            self.bytes_expanded += size_out
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                "frames_compressed": self.frames_compressed,
+                "frames_skipped": self.frames_skipped,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "ratio": self.bytes_in / self.bytes_out if self.bytes_out else 1.0,
+                "compress_seconds": self.compress_seconds,
+                "frames_decompressed": self.frames_decompressed,
+                "bytes_received": self.bytes_received,
+                "bytes_expanded": self.bytes_expanded,
+                "decompress_seconds": self.decompress_seconds,
+            }
+
+
+def compress_payload(compressor, payload, stats):
+    """
+    Compress payload for the wire. Returns the compressed bytes, or None if
+    compression did not make the frame smaller.
+    """
+    start = time.perf_counter()
+    compressed = compressor.compress(payload)
+    seconds = time.perf_counter() - start
+    if len(compressed) >= len(payload):
+        stats.record_compress(len(payload), len(payload), seconds, True)
+        return None
+    stats.record_compress(len(payload), len(compressed), seconds, False)
+    return compressed
+
+
+def decompress_payload(compressor, data, max_size, stats):
+    start = time.perf_counter()
+    result = compressor.decompress(data, max_size)
+    stats.record_decompress(len(data), len(result), time.perf_counter() - start)
+    return result
@@ -0,0 +1,163 @@
+from dataclasses import dataclass, field
+
+from message import available_codecs
+from framing import FRAMINGS, DEFAULT_RECV_SIZE, DEFAULT_MAX_FRAME_SIZE
+from file_transfer import DEFAULT_CHUNK_SIZE
+from connection_manager import (
+    DEFAULT_RECONNECT_INITIAL_DELAY, DEFAULT_RECONNECT_MAX_DELAY, DEFAULT_RECONNECT_MAX_ATTEMPTS,
+)
+from dht import (
+    DEFAULT_K, DEFAULT_ALPHA, DEFAULT_REFRESH_INTERVAL, DEFAULT_RECORD_TTL, DEFAULT_RPC_TIMEOUT,
+)
+from discovery import (
+    DEFAULT_DISCOVERY_GROUP, DEFAULT_DISCOVERY_PORT, DEFAULT_DISCOVERY_INTERVAL, DEFAULT_DISCOVERY_MAX_RATE,
+)
+from gossip import (
+    DEFAULT_GOSSIP_TTL, DEFAULT_GOSSIP_FANOUT, DEFAULT_SEEN_CACHE_SIZE, DEFAULT_SEEN_CACHE_SECONDS,
+)
+from admission import (
+    DEFAULT_MAX_CONNECTIONS, DEFAULT_MAX_PENDING_CONNECTIONS, DEFAULT_LISTEN_BACKLOG, DEFAULT_HANDSHAKE_TIMEOUT,
+)
+from message_store import DEFAULT_HISTORY_BATCH_SIZE, DEFAULT_HISTORY_FLUSH_INTERVAL
+from outbox import DEFAULT_OUTBOX_MAX_MESSAGES, DEFAULT_OUTBOX_MAX_AGE, DEFAULT_OUTBOX_BATCH_SIZE
+from heartbeat import DEFAULT_HEARTBEAT_INTERVAL, DEFAULT_HEARTBEAT_MISSES, DEFAULT_RTT_ALPHA
+from compression import available_compressors, DEFAULT_COMPRESSION_THRESHOLD
+from channels import DEFAULT_CHAT_WINDOW, DEFAULT_BULK_WINDOW, DEFAULT_FRAGMENT_SIZE
+from outbound import (
+    DEFAULT_HIGH_WATERMARK, DEFAULT_LOW_WATERMARK, DEFAULT_COALESCE_WINDOW, DEFAULT_COALESCE_MAX_BYTES,
+)
+
+
+@dataclass
+class NetworkConfig:
+    """
+    Tunables for a PeerNetwork. Options that affect the wire format are
+    advertised in the introduce handshake and negotiated per connection.
+    """
+    # Framings we accept, most preferred first.
+    framings: tuple = FRAMINGS
+    # Bytes requested from the socket per recv call.
+    recv_size: int = DEFAULT_RECV_SIZE
+    # Largest single frame we are willing to buffer.
+    max_frame_size: int = DEFAULT_MAX_FRAME_SIZE
+    # Message codecs we accept, most preferred first.
+    codecs: tuple = field(default_factory=available_codecs)
+    # Frame compressors we accept, most preferred first; empty disables
+    # compression. Only frames of at least compression_threshold bytes
+    # are compressed.
+    compressions: tuple = field(default_factory=available_compressors)
+    compression_threshold: int = DEFAULT_COMPRESSION_THRESHOLD
+    # Multiplex control, chat and bulk channels over each connection (needs
+    # length framing). The windows are the bytes a peer may have in flight
+    # to us per channel; messages above fragment_size are split so other
+    # channels can interleave.
+    channels: bool = True
+    chat_window: int = DEFAULT_CHAT_WINDOW
+    bulk_window: int = DEFAULT_BULK_WINDOW
+    fragment_size: int = DEFAULT_FRAGMENT_SIZE
+    # Where accepted incoming files are written.
+    download_dir: str = "downloads"
+    # Size of each streamed file chunk.
+    file_chunk_size: int = DEFAULT_CHUNK_SIZE
+    # How outgoing chunks are sent: "auto", "sendfile", "mmap" or "copy".
+    file_send_mode: str = "auto"
+    # Per-peer send queue: producers are throttled above the high watermark
+    # until the writer drains below the low one.
+    send_queue_high_watermark: int = DEFAULT_HIGH_WATERMARK
+    send_queue_low_watermark: int = DEFAULT_LOW_WATERMARK
+    # What happens to a full queue: "drop_presence", "block" or "disconnect".
+    send_queue_overflow: str = "drop_presence"
+    # Longest a producer waits on a full queue before giving up.
+    send_queue_block_timeout: float = 30.0
+    # Gather small frames queued within coalesce_window seconds (or until
+    # coalesce_max_bytes are waiting) into one vectored write. A window of
+    # 0 only batches what is already queued.
+    coalesce: bool = False
+    coalesce_window: float = DEFAULT_COALESCE_WINDOW
+    coalesce_max_bytes: int = DEFAULT_COALESCE_MAX_BYTES
+    # Socket options applied to every peer connection. Buffer sizes of 0
+    # keep the OS defaults; keepalive timers are in seconds.
+    tcp_nodelay: bool = True
+    socket_sndbuf: int = 0
+    socket_rcvbuf: int = 0
+    keepalive: bool = False
+    keepalive_idle: int = 60
+    keepalive_interval: int = 10
+    keepalive_count: int = 5
+    # Ping every peer that supports it each heartbeat_interval seconds (0
+    # disables) and evict it after heartbeat_misses silent intervals. RTT
+    # is a moving average giving each new sample a weight of rtt_alpha.
+    heartbeat_interval: float = DEFAULT_HEARTBEAT_INTERVAL
+    heartbeat_misses: int = DEFAULT_HEARTBEAT_MISSES
+    rtt_alpha: float = DEFAULT_RTT_ALPHA
+    # Redial peers we connected to when their connection drops, with
+    # jittered exponential backoff between the delays below. After
+    # reconnect_max_attempts failures we give up (0 keeps trying forever).
+    reconnect: bool = True
+    reconnect_initial_delay: float = DEFAULT_RECONNECT_INITIAL_DELAY
+    reconnect_max_delay: float = DEFAULT_RECONNECT_MAX_DELAY
+    reconnect_max_attempts: int = DEFAULT_RECONNECT_MAX_ATTEMPTS
+    # group_chat gossip: messages travel at most gossip_ttl hops, each relay
+    # forwards to gossip_fanout random neighbours (0 = all of them), and
+    # seen message IDs are kept (at most seen_cache_size, for up to
+    # seen_cache_seconds) to drop duplicates.
+    gossip_ttl: int = DEFAULT_GOSSIP_TTL
+    gossip_fanout: int = DEFAULT_GOSSIP_FANOUT
+    seen_cache_size: int = DEFAULT_SEEN_CACHE_SIZE
+    seen_cache_seconds: float = DEFAULT_SEEN_CACHE_SECONDS
+    # LAN discovery (off by default): announce ourselves on a UDP multicast
+    # group or broadcast address, sent from discovery_interface (use
+    # 127.0.0.1 to keep it on this host). Announcements go out every
+    # discovery_interval seconds, stretched so the segment stays near
+    # discovery_max_rate per second. With auto-connect, discovered peers
+    # are dialed automatically.
+    discovery: bool = False
+    discovery_group: str = DEFAULT_DISCOVERY_GROUP
+    discovery_port: int = DEFAULT_DISCOVERY_PORT
+    discovery_interface: str = "0.0.0.0"
+    discovery_interval: float = DEFAULT_DISCOVERY_INTERVAL
+    discovery_max_rate: float = DEFAULT_DISCOVERY_MAX_RATE
+    discovery_auto_connect: bool = False
+    # Kademlia DHT mapping usernames to addresses (off by default). It uses
+    # UDP on dht_port (0: the same number as the TCP listen port) and
+    # joins through the (host, port) nodes in dht_bootstrap and through
+    # every connected peer that runs one. Our record is republished every
+    # dht_refresh_interval seconds and expires after dht_record_ttl.
+    dht: bool = False
+    dht_port: int = 0
+    dht_bootstrap: tuple = ()
+    dht_k: int = DEFAULT_K
+    dht_alpha: int = DEFAULT_ALPHA
+    dht_refresh_interval: float = DEFAULT_REFRESH_INTERVAL
+    dht_record_ttl: float = DEFAULT_RECORD_TTL
+    dht_rpc_timeout: float = DEFAULT_RPC_TIMEOUT
+    # Admission control: sockets beyond max_connections are closed right
+    # away, and while max_pending_connections are still handshaking new
+    # ones wait in the listen backlog (listen_backlog long). A socket that
+    # has not introduced itself within handshake_timeout seconds is dropped.
+    max_connections: int = DEFAULT_MAX_CONNECTIONS
+    max_pending_connections: int = DEFAULT_MAX_PENDING_CONNECTIONS
+    listen_backlog: int = DEFAULT_LISTEN_BACKLOG
+    handshake_timeout: float = DEFAULT_HANDSHAKE_TIMEOUT
+    # Per-peer receive limits in messages and bytes per second (0 is
+    # unlimited), with bursts of up to *_burst (0: one second's worth). A
+    # peer over its limit is not read from until it is back under.
+    peer_message_rate: float = 0
+    peer_message_burst: float = 0
+    peer_byte_rate: float = 0
+    peer_byte_burst: float = 0
+    # Chat and group messages, sent and received, are logged to
+    # <history_dir>/<username>.sqlite3 when set. Writes are committed in
+    # batches of up to history_batch_size rows every history_flush_interval.
+    history_dir: str = ""
+    history_batch_size: int = DEFAULT_HISTORY_BATCH_SIZE
+    history_flush_interval: float = DEFAULT_HISTORY_FLUSH_INTERVAL
+    # When set, chat messages to peers that are not connected are kept in
+    # <outbox_dir>/<username>.outbox.sqlite3 and sent, outbox_batch_size
+    # at a time, when the peer connects. Each peer keeps at most
+    # outbox_max_messages (the oldest go first), none older than
+    # outbox_max_age seconds.
+    outbox_dir: str = ""
+    outbox_max_messages: int = DEFAULT_OUTBOX_MAX_MESSAGES
+    outbox_max_age: float = DEFAULT_OUTBOX_MAX_AGE
+    outbox_batch_size: int = DEFAULT_OUTBOX_BATCH_SIZE
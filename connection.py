@@ -0,0 +1,308 @@
+import errno
+import os
+import socket
+import threading
+from message import encode_message
+from framing import encode_frame, FRAME_HEADER, FLAG_COMPRESSED, FLAG_MORE, CHANNEL_SHIFT, FrameError
+from channels import CHANNEL_CHAT, CHANNEL_BULK, DEFAULT_FRAGMENT_SIZE, channel_for
+from outbound import QueueOverflow
+from compression import COMPRESSORS, CompressionStats, compress_payload, decompress_payload
+
+# os.sendfile copies file pages to the socket inside the kernel.
+HAS_SENDFILE = hasattr(os, "sendfile")
+# sendmsg writes several buffers with one syscall (not available on Windows).
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+
+
+def send_buffers(sock, buffers):
+    """Write a list of buffers with one vectored send; returns the bytes sent."""
+    if HAS_SENDMSG:
+        return sock.sendmsg(buffers)
+    return sock.send(b"".join(buffers))
+
+
+def tune_socket(sock, config):
+    """Apply the TCP options of a NetworkConfig to a socket."""
+    if config.tcp_nodelay:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if config.socket_sndbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, config.socket_sndbuf)
+    if config.socket_rcvbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, config.socket_rcvbuf)
+    if config.keepalive:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # Platforms without these keep their system-wide keepalive timers.
+        for name, value in (("TCP_KEEPIDLE", config.keepalive_idle),
+                            ("TCP_KEEPINTVL", config.keepalive_interval),
+                            ("TCP_KEEPCNT", config.keepalive_count)):
+            if hasattr(socket, name):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+
+
+class FileSegment:
+    """
+    A byte range of an open file queued for sending without reading it into
+    Python objects. With view set (a memoryview over an mmap) the range is
+    sent from the mapping; otherwise os.sendfile is used.
+    """
+
+    def __init__(self, fileobj, offset, count, view=None):
+        self.fileobj = fileobj
+        self.offset = offset
+        self.count = count
+        self.view = view
+
+    def __len__(self):
+        return self.count
+
+    def send_nonblocking(self, sock):
+        """Send as much as the socket takes right now; returns the bytes sent."""
+        if self.view is not None:
+            sent = sock.send(self.view)
+            self.view = self.view[sent:]
+        else:
+            sent = os.sendfile(sock.fileno(), self.fileobj.fileno(), self.offset, self.count)
+            if sent == 0:
+                raise OSError(f"File ended before the queued range was sent ({self.count} bytes left)")
+            self.offset += sent
+        self.count -= sent
+        return sent
+
+
+class PeerConnection:
+    """
+    One established (or handshaking) socket to a peer, together with the
+    options negotiated for it and its outbound queue. Nothing but the
+    engine's writer ever writes to the socket; engines subclass this to
+    wake that writer and to close the connection.
+    """
+
+    def __init__(self, sock, addr, decoder, queue):
+        self.sock = sock
+        self.addr = addr
+        self.decoder = decoder
+        self.queue = queue
+        self.peer_username = None
+        self.peer_instance = None  # the peer process's instance_id
+        self.peer_dht_port = None  # UDP port of the peer's DHT node, if it runs one
+        self.peer_listen_port = None  # TCP port the peer accepts connections on, as it told us
+        self.initiator = False     # whether we dialed this connection
+        self.limiter = None        # ReceiveLimiter when per-peer rate limits are on
+        self.framing = "newline"
+        self.codec = "json"
+        self.compression = None  # negotiated compressor name, if any
+        self.compressor = None
+        self.compression_threshold = 0
+        self.compression_stats = CompressionStats()
+        # Logical channels, once negotiated: fragmentation, per-channel
+        # reassembly and the bytes consumed against our receive windows.
+        self.channels = False
+        self.fragment_size = DEFAULT_FRAGMENT_SIZE
+        self.recv_windows = {}
+        self.recv_consumed = {}
+        self.fragments = {}  # mapping: channel -> bytearray of a partial message
+        # Receive counters, only touched by the reading thread; the network
+        # reads them when its metrics are scraped.
+        self.frames_in = 0
+        self.bytes_in = 0
+        self.received_at = 0.0  # perf_counter() of the last recv
+        # Heartbeat state, once negotiated: smoothed RTT in seconds (None
+        # until the first pong), when the last pong arrived and liveness.
+        self.heartbeats = False
+        self.ping_seq = 0
+        self.rtt = None
+        self.last_seen = 0.0
+        self.liveness = "alive"
+        self.closed = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def set_framing(self, framing):
+        self.framing = framing
+        self.decoder.set_framing(framing)
+
+    def set_compression(self, name, threshold):
+        """Compress frames of at least threshold bytes with the named compressor (None disables)."""
+        self.compression = name
+        self.compressor = COMPRESSORS[name] if name else None
+        self.compression_threshold = threshold
+
+    def enable_channels(self, recv_windows, send_windows, fragment_size):
+        """Switch to channel-tagged frames with flow control in both directions."""
+        self.channels = True
+        self.fragment_size = fragment_size
+        self.recv_windows = dict(recv_windows)
+        self.recv_consumed = {channel: 0 for channel in recv_windows}
+        self.queue.set_credit(send_windows)
+
+    def frame_flags(self, flags, channel):
+        """Header flags for a frame on channel."""
+        if self.channels:
+            return flags | (channel << CHANNEL_SHIFT)
+        return flags
+
+    def send_message(self, message_dict, on_sent=None, droppable=False, channel=None):
+        if channel is None:
+            channel = channel_for(message_dict)
+        payload = encode_message(message_dict, self.codec)
+        if payload is None:
+            return False
+        flags = 0
+        if self.compressor and len(payload) >= self.compression_threshold:
+            compressed = compress_payload(self.compressor, payload, self.compression_stats)
+            if compressed is not None:
+                payload, flags = compressed, FLAG_COMPRESSED
+        if not self.channels:
+            return self.sendall(encode_frame(payload, self.framing, flags), on_sent, droppable, channel)
+        # Split large messages so other channels can interleave between the pieces.
+        flags = self.frame_flags(flags, channel)
+        view = memoryview(payload)
+        frames = []
+        for start in range(0, max(len(view), 1), self.fragment_size):
+            piece = view[start:start + self.fragment_size]
+            more = FLAG_MORE if start + self.fragment_size < len(view) else 0
+            frames.append([memoryview(FRAME_HEADER.pack(len(piece), flags | more)), piece])
+        return self._enqueue(frames, on_sent, droppable, channel)
+
+    def reassemble(self, channel, flags, frame):
+        """Collect a fragment; returns the whole message once its last fragment is in, else None."""
+        buffer = self.fragments.get(channel)
+        if flags & FLAG_MORE:
+            if buffer is None:
+                buffer = self.fragments[channel] = bytearray()
+            buffer += frame
+            if len(buffer) > self.decoder.max_frame_size:
+                raise FrameError(f"Fragmented message exceeds limit of {self.decoder.max_frame_size}")
+            return None
+        if buffer is None:
+            return frame
+        buffer += frame
+        del self.fragments[channel]
+        return buffer
+
+    def consume_window(self, channel, nbytes):
+        """
+        Account received bytes against our window for channel. Returns the
+        increment to grant back to the peer once half the window is used.
+        """
+        window = self.recv_windows.get(channel)
+        if window is None:
+            return 0
+        consumed = self.recv_consumed[channel] + nbytes
+        if consumed < window // 2:
+            self.recv_consumed[channel] = consumed
+            return 0
+        self.recv_consumed[channel] = 0
+        return consumed
+
+    def decompress(self, frame):
+        """Expand a frame received with FLAG_COMPRESSED."""
+        if not self.compressor:
+            raise ValueError("Compressed frame on a connection without compression")
+        return decompress_payload(self.compressor, frame, self.decoder.max_frame_size, self.compression_stats)
+
+    def sendall(self, data, on_sent=None, droppable=False, channel=CHANNEL_CHAT):
+        """
+        Queue an already framed buffer for the writer; on_sent() is called
+        once it has been written to the socket. Returns False if the
+        overflow policy dropped it.
+        """
+        return self._enqueue([[memoryview(data)]], on_sent, droppable, channel)
+
+    def sendfile(self, header, segment, on_sent=None, channel=CHANNEL_BULK):
+        """Queue header followed by a FileSegment as one uninterrupted unit."""
+        return self._enqueue([[memoryview(header), segment]], on_sent, False, channel)
+
+    def _enqueue(self, frames, on_sent, droppable, channel):
+        if self.closed or self.queue.closed:
+            raise OSError(errno.ENOTCONN, "connection closed")
+        try:
+            queued = self.queue.put_frames(frames, on_sent, droppable, self._can_block(), channel)
+        except QueueOverflow:
+            if self.queue.overflow == "disconnect" and not self.queue.closed:
+                print(f"[WARN] Send queue to {self.peer_username or self.addr} overflowed, disconnecting")
+                self.abort()
+            raise
+        self._wake_writer()
+        return queued
+
+    def _can_block(self):
+        return True
+
+    def _wake_writer(self):
+        pass
+
+    def close(self):
+        """Close once everything already queued has been written."""
+        raise NotImplementedError
+
+    def abort(self):
+        """Close immediately, discarding whatever is still queued."""
+        raise NotImplementedError
+
+
+class ThreadedConnection(PeerConnection):
+    """
+    Blocking socket of the threaded engine: a reader thread owned by
+    PeerNetwork plus a writer thread draining the outbound queue.
+    """
+
+    # Longest close() waits for queued frames to go out.
+    CLOSE_FLUSH_TIMEOUT = 1.0
+
+    def __init__(self, sock, addr, decoder, queue):
+        super().__init__(sock, addr, decoder, queue)
+        self.writer = threading.Thread(target=self._writer_loop, daemon=True)
+        self.writer.start()
+
+    def _writer_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                if self.queue.coalesce and item.in_memory:
+                    self._send_batch(self.queue.gather(self.queue.coalesce_window))
+                    continue
+                for part in item.parts:
+                    if isinstance(part, FileSegment):
+                        if part.view is not None:
+                            self.sock.sendall(part.view)
+                        else:
+                            self.sock.sendfile(part.fileobj, part.offset, part.count)
+                    else:
+                        self.sock.sendall(part)
+            except OSError as e:
+                if not self.closed:
+                    print(f"[ERROR] Sending to {self.peer_username or self.addr}: {e}")
+                self.abort()
+                break
+            self.queue.task_done(item)
+
+    def _send_batch(self, batch):
+        while batch:
+            buffers = [part for item in batch for part in item.parts]
+            batch = self.queue.advance(batch, send_buffers(self.sock, buffers))
+
+    def close(self):
+        self.closed = True
+        self.queue.close()
+        if threading.current_thread() is not self.writer:
+            self.writer.join(self.CLOSE_FLUSH_TIMEOUT)
+        try:
+            # Wakes the reader thread if another thread is closing us.
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def abort(self):
+        self.closed = True
+        self.queue.close()
+        try:
+            # Wakes the reader thread blocked in recv.
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
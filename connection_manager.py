@@ -0,0 +1,119 @@
+import heapq
+import random
+import threading
+import time
+
+# Redial backoff: the first retry comes after about this many seconds and
+# every failed attempt doubles the wait, up to the maximum.
+DEFAULT_RECONNECT_INITIAL_DELAY = 0.5
+DEFAULT_RECONNECT_MAX_DELAY = 30.0
+# Redials before giving up on a peer; with the delays above about five
+# minutes of trying. 0 redials forever.
+DEFAULT_RECONNECT_MAX_ATTEMPTS = 20
+
+
+def backoff_delay(attempt, initial_delay, max_delay):
+    """
+    Exponential backoff with jitter: a random point in the upper half of
+    the window, so peers that lost each other at the same moment do not
+    keep redialing in lockstep.
+    """
+    window = min(max_delay, initial_delay * 2 ** attempt)
+    return window * random.uniform(0.5, 1.0)
+
+
+class ConnectionManager:
+    """
+    Remembers the addresses of peers we dialed and redials them when the
+    connection drops, until it is back or max_attempts have failed (0
+    retries forever). Only the dialing side redials; the other side may
+    not be reachable from here at all.
+
+    Attempts are checked again after the next backoff delay: if the peer is
+    connected by then (by this attempt or by the peer dialing us) the
+    redial stops, otherwise another attempt is made.
+    """
+
+    def __init__(self, network, initial_delay=DEFAULT_RECONNECT_INITIAL_DELAY,
+                 max_delay=DEFAULT_RECONNECT_MAX_DELAY, max_attempts=DEFAULT_RECONNECT_MAX_ATTEMPTS):
+        self.network = network
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.addresses = {}  # mapping: username -> (host, port) we dialed
+        self.pending = {}    # mapping: username -> number of the next redial attempt
+        self.timers = []     # heap of (due, username, attempt)
+        self.cond = threading.Condition()
+        self.thread = None
+        self.stopped = False
+        self.attempts = 0
+
+    def peer_connected(self, conn):
+        with self.cond:
+            if conn.initiator:
+                self.addresses[conn.peer_username] = conn.addr
+            self.pending.pop(conn.peer_username, None)
+
+    def peer_disconnected(self, peer_username):
+        """The last connection to peer_username is gone; start redialing if we know where it is."""
+        with self.cond:
+            if peer_username in self.addresses and not self.stopped:
+                print(f"[INFO] Will reconnect to {peer_username}")
+                self._schedule(peer_username, 0)
+
+    def forget(self, peer_username):
+        """Stop remembering (and redialing) a peer."""
+        with self.cond:
+            self.addresses.pop(peer_username, None)
+            self.pending.pop(peer_username, None)
+
+    def known_addresses(self):
+        with self.cond:
+            return dict(self.addresses)
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.pending.clear()
+            self.cond.notify_all()
+
+    def _schedule(self, peer_username, attempt):
+        due = time.monotonic() + backoff_delay(attempt, self.initial_delay, self.max_delay)
+        self.pending[peer_username] = attempt
+        heapq.heappush(self.timers, (due, peer_username, attempt))
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        self.cond.notify_all()
+
+    def _run(self):
+        with self.cond:
+            while not self.stopped:
+                if not self.timers:
+                    self.cond.wait()
+                    continue
+                due, peer_username, attempt = self.timers[0]
+                remaining = due - time.monotonic()
+                if remaining > 0:
+                    self.cond.wait(remaining)
+                    continue
+                heapq.heappop(self.timers)
+                # Entries superseded by a reconnect or a newer schedule are stale.
+                if self.pending.get(peer_username) != attempt:
+                    continue
+                self._attempt(peer_username, attempt)
+
+    def _attempt(self, peer_username, attempt):
+        if peer_username in self.network.list_peers():
+            self.pending.pop(peer_username, None)
+            return
+        if self.max_attempts and attempt >= self.max_attempts:
+            print(f"[WARN] Giving up reconnecting to {peer_username} after {attempt} attempts")
+            self.pending.pop(peer_username, None)
+            return
+        host, port = self.addresses[peer_username]
+        print(f"[INFO] Reconnecting to {peer_username} at {host}:{port} (attempt {attempt + 1})")
+        self.attempts += 1
+        # The threaded engine connects synchronously; keep this thread free.
+        threading.Thread(target=self.network.connect_to_peer, args=(host, port), daemon=True).start()
+        self._schedule(peer_username, attempt + 1)
@@ -0,0 +1,434 @@
+import hashlib
+import json
+import random
+import socket
+import threading
+import time
+
+# Node ids and keys are 160-bit integers, as in Kademlia.
+ID_BITS = 160
+# Contacts per k-bucket, and nodes each record is stored on.
+DEFAULT_K = 20
+# Lookup RPCs in flight at once.
+DEFAULT_ALPHA = 3
+# Seconds between republishing our record and refreshing idle buckets.
+DEFAULT_REFRESH_INTERVAL = 600.0
+# How long a stored record lives without being republished.
+DEFAULT_RECORD_TTL = 3600.0
+DEFAULT_RPC_TIMEOUT = 1.0
+
+MAX_DATAGRAM = 8192
+
+
+def key_for(username):
+    """DHT key of a username's address record."""
+    return int.from_bytes(hashlib.sha1(username.encode("utf-8")).digest(), "big")
+
+
+def _hex(node_id):
+    return format(node_id, "040x")
+
+
+def _valid_port(port):
+    return type(port) is int and 0 < port < 65536
+
+
+def _valid_record(record, key):
+    """Whether record is a usable address record stored under key."""
+    return (isinstance(record, dict) and isinstance(record.get("username"), str)
+            and key_for(record["username"]) == key
+            and isinstance(record.get("host"), str) and bool(record["host"]) and _valid_port(record.get("port")))
+
+
+def _parse_contact(entry):
+    """Contact from a [node_hex, host, port] triple of a reply, or None if malformed."""
+    if not isinstance(entry, list) or len(entry) != 3:
+        return None
+    node_hex, host, port = entry
+    if not isinstance(node_hex, str) or not isinstance(host, str) or not _valid_port(port):
+        return None
+    try:
+        node_id = int(node_hex, 16)
+    except ValueError:
+        return None
+    if not 0 <= node_id < 2 ** ID_BITS:
+        return None
+    return Contact(node_id, host, port)
+
+
+class Contact:
+    __slots__ = ("node_id", "host", "port")
+
+    def __init__(self, node_id, host, port):
+        self.node_id = node_id
+        self.host = host
+        self.port = port
+
+    @property
+    def address(self):
+        return (self.host, self.port)
+
+    def as_wire(self):
+        return [_hex(self.node_id), self.host, self.port]
+
+
+class RoutingTable:
+    """
+    k-buckets indexed by the bit length of the XOR distance to our id.
+    Each bucket keeps at most k contacts, least recently seen first.
+    """
+
+    def __init__(self, node_id, k=DEFAULT_K):
+        self.node_id = node_id
+        self.k = k
+        self.lock = threading.Lock()
+        self.buckets = [[] for _ in range(ID_BITS)]
+        self.refreshed = [time.monotonic()] * ID_BITS  # last lookup into each bucket's range
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(bucket) for bucket in self.buckets)
+
+    def bucket_index(self, node_id):
+        return (self.node_id ^ node_id).bit_length() - 1
+
+    def touch(self, contact):
+        """
+        Record that contact was heard from. Returns None when it was added
+        or refreshed, or the bucket's least recently seen contact when the
+        bucket is full: the caller pings that one and calls replace() if
+        it does not answer.
+        """
+        if contact.node_id == self.node_id:
+            return None
+        with self.lock:
+            bucket = self.buckets[self.bucket_index(contact.node_id)]
+            for i, known in enumerate(bucket):
+                if known.node_id == contact.node_id:
+                    del bucket[i]
+                    bucket.append(contact)
+                    return None
+            if len(bucket) < self.k:
+                bucket.append(contact)
+                return None
+            return bucket[0]
+
+    def replace(self, stale, contact):
+        with self.lock:
+            bucket = self.buckets[self.bucket_index(stale.node_id)]
+            if stale in bucket:
+                bucket.remove(stale)
+                if len(bucket) < self.k:
+                    bucket.append(contact)
+
+    def remove(self, node_id):
+        with self.lock:
+            bucket = self.buckets[self.bucket_index(node_id)]
+            bucket[:] = [contact for contact in bucket if contact.node_id != node_id]
+
+    def closest(self, target, count):
+        with self.lock:
+            contacts = [contact for bucket in self.buckets for contact in bucket]
+        contacts.sort(key=lambda contact: contact.node_id ^ target)
+        return contacts[:count]
+
+    def mark_refreshed(self, target):
+        if target != self.node_id:
+            self.refreshed[self.bucket_index(target)] = time.monotonic()
+
+    def stale_buckets(self, max_age):
+        """Indexes of non-empty buckets with no lookup for max_age seconds."""
+        now = time.monotonic()
+        with self.lock:
+            return [i for i, bucket in enumerate(self.buckets) if bucket and now - self.refreshed[i] >= max_age]
+
+
+class DHTNode:
+    """
+    Kademlia-style directory mapping usernames to their current address.
+
+    Runs over UDP (JSON datagrams) on its own port, so looking a peer up
+    needs no TCP connection to anyone. Every node has a random id; the
+    record for a username lives on the k nodes whose ids are closest (by
+    XOR) to the SHA-1 of the username. Iterative lookups query the alpha
+    closest known nodes at a time and converge in O(log n) rounds.
+
+    Records are republished by their owner every refresh interval and
+    expire on the storing nodes after record_ttl. The storing node fills in
+    the publisher's address as it sees it, so peers behind a wildcard bind
+    still publish a reachable host.
+
+    A record belongs to the node that stored it first. Its owner can
+    replace it with a higher sequence number. Another node only takes
+    over once the owner no longer answers at its address, e.g. after a
+    restart with a new node id. The owner also keeps its own record.
+    """
+
+    def __init__(self, network, port, k=DEFAULT_K, alpha=DEFAULT_ALPHA, refresh_interval=DEFAULT_REFRESH_INTERVAL,
+                 record_ttl=DEFAULT_RECORD_TTL, rpc_timeout=DEFAULT_RPC_TIMEOUT):
+        self.network = network
+        self.port = port
+        self.k = k
+        self.alpha = alpha
+        self.refresh_interval = refresh_interval
+        self.record_ttl = record_ttl
+        self.rpc_timeout = rpc_timeout
+        self.node_id = random.getrandbits(ID_BITS)
+        self.table = RoutingTable(self.node_id, k)
+        self.lock = threading.Lock()
+        self.records = {}  # mapping: key -> (record dict, expires, owner's DHT address)
+        self.pending = {}  # mapping: rpc id -> [threading.Event, reply]
+        self.next_rpc = 0
+        self.sock = None
+        self.stopped = threading.Event()
+        self.rpcs_sent = 0
+        self.lookups = 0
+
+    def start(self, bootstrap=()):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((self.network.host, self.port))
+        self.sock.settimeout(0.5)
+        print(f"[INFO] DHT node {_hex(self.node_id)[:8]} on UDP {self.network.host}:{self.port}")
+        threading.Thread(target=self._receive_loop, daemon=True).start()
+        threading.Thread(target=self._maintain, args=(list(bootstrap),), daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.sock:
+            self.sock.close()
+
+    def stats(self):
+        with self.lock:
+            records = len(self.records)
+        return {"contacts": len(self.table), "records": records, "rpcs_sent": self.rpcs_sent,
+                "lookups": self.lookups}
+
+    # ------------------- RPC plumbing -------------------
+    def _send(self, address, message):
+        message["node"] = _hex(self.node_id)
+        try:
+            self.sock.sendto(json.dumps(message).encode("utf-8"), address)
+        except OSError as e:
+            if not self.stopped.is_set():
+                print(f"[WARN] DHT send to {address[0]}:{address[1]} failed: {e}")
+
+    def _request_many(self, requests):
+        """Send (address, message) requests at once; returns the replies in order, None for timeouts."""
+        waiting = []
+        with self.lock:
+            for address, message in requests:
+                self.next_rpc += 1
+                message["rpc_id"] = self.next_rpc
+                self.pending[self.next_rpc] = [threading.Event(), None]
+                waiting.append(self.next_rpc)
+            self.rpcs_sent += len(requests)
+        for address, message in requests:
+            self._send(address, message)
+        deadline = time.monotonic() + self.rpc_timeout
+        replies = []
+        for rpc_id in waiting:
+            event, _ = self.pending[rpc_id]
+            event.wait(max(0.0, deadline - time.monotonic()))
+            with self.lock:
+                replies.append(self.pending.pop(rpc_id)[1])
+        return replies
+
+    def _request(self, address, message):
+        return self._request_many([(address, message)])[0]
+
+    def _receive_loop(self):
+        while not self.stopped.is_set():
+            try:
+                data, address = self.sock.recvfrom(MAX_DATAGRAM)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            try:
+                message = json.loads(data)
+                sender = Contact(int(message["node"], 16), address[0], address[1])
+                self._seen(sender)
+                if message.get("type") == "reply":
+                    with self.lock:
+                        waiter = self.pending.get(message.get("rpc_id"))
+                    if waiter:
+                        waiter[1] = message
+                        waiter[0].set()
+                else:
+                    reply = self._handle_request(message, address)
+                    reply.update(type="reply", rpc_id=message.get("rpc_id"))
+                    self._send(address, reply)
+            except (ValueError, TypeError, KeyError, AttributeError) as e:
+                print(f"[WARN] Ignoring malformed DHT datagram from {address[0]}: {e}")
+
+    def _seen(self, contact):
+        stale = self.table.touch(contact)
+        if stale is not None:
+            # Full bucket: keep the old contact if it still answers.
+            threading.Thread(target=self._check_stale, args=(stale, contact), daemon=True).start()
+
+    def _check_stale(self, stale, contact):
+        if self._request(stale.address, {"type": "ping"}) is None:
+            self.table.replace(stale, contact)
+
+    def _handle_request(self, message, address):
+        msg_type = message.get("type")
+        if msg_type == "ping":
+            return {}
+        if msg_type == "store":
+            self._store(int(message["key"], 16), dict(message["record"]), int(message["node"], 16), address)
+            return {}
+        if msg_type in ("find_node", "find_value"):
+            target = int(message["target"], 16)
+            if msg_type == "find_value":
+                record = self._get_record(target)
+                # Our own record lacks a host when we listen on a wildcard address.
+                if record is not None and record.get("host"):
+                    return {"record": record}
+            return {"nodes": [contact.as_wire() for contact in self.table.closest(target, self.k)]}
+        raise ValueError(f"unknown DHT request {msg_type!r}")
+
+    # ------------------- records -------------------
+    def _store(self, key, record, owner, address):
+        if key != key_for(str(record.get("username"))):
+            raise ValueError("record key does not match its username")
+        if type(record.get("seq")) is not int:
+            raise ValueError("record has no sequence number")
+        # The owner is whoever sent the store, whatever the record claims.
+        record["node"] = _hex(owner)
+        if not record.get("host"):
+            record["host"] = address[0]
+        if not _valid_record(record, key):
+            raise ValueError("record has no valid address")
+        with self.lock:
+            current = self.records.get(key)
+            if current and current[1] <= time.monotonic():
+                current = None
+            if current is None or current[0]["node"] == record["node"]:
+                if current is None or record["seq"] >= current[0]["seq"]:
+                    self.records[key] = (record, time.monotonic() + self.record_ttl, address)
+                return
+            if current[0]["node"] == _hex(self.node_id):
+                print(f"[WARN] Refusing DHT record for our own username from {address[0]}:{address[1]}")
+                return
+        # Someone else claims a username with a live record; check on its owner first.
+        threading.Thread(target=self._take_over, args=(key, record, address, current), daemon=True).start()
+
+    def _take_over(self, key, record, address, current):
+        """Replace current with record if current's owner no longer answers as itself."""
+        reply = self._request(current[2], {"type": "ping"})
+        if reply is not None and reply.get("node") == current[0]["node"]:
+            print(f"[WARN] Refusing DHT record for {record['username']} from {address[0]}:{address[1]}: "
+                  f"owned by another node")
+            return
+        with self.lock:
+            if self.records.get(key) is current:
+                self.records[key] = (record, time.monotonic() + self.record_ttl, address)
+
+    def _get_record(self, key):
+        with self.lock:
+            entry = self.records.get(key)
+            if entry and entry[1] <= time.monotonic():
+                del self.records[key]
+                entry = None
+        return entry[0] if entry else None
+
+    def _expire_records(self):
+        now = time.monotonic()
+        with self.lock:
+            for key in [key for key, (_, expires, _) in self.records.items() if expires <= now]:
+                del self.records[key]
+
+    # ------------------- Kademlia procedures -------------------
+    def lookup(self, target, find_value=False):
+        """
+        Iterative node lookup. Returns the k closest contacts to target, or
+        with find_value the record stored under target (None if nobody has it).
+        """
+        self.lookups += 1
+        self.table.mark_refreshed(target)
+        shortlist = {contact.node_id: contact for contact in self.table.closest(target, self.k)}
+        queried = set()
+        while True:
+            closest = sorted(shortlist.values(), key=lambda contact: contact.node_id ^ target)[:self.k]
+            batch = [contact for contact in closest if contact.node_id not in queried][:self.alpha]
+            if not batch:
+                break
+            request_type = "find_value" if find_value else "find_node"
+            replies = self._request_many(
+                [(contact.address, {"type": request_type, "target": _hex(target)}) for contact in batch]
+            )
+            for contact, reply in zip(batch, replies):
+                queried.add(contact.node_id)
+                if reply is None:
+                    shortlist.pop(contact.node_id, None)
+                    self.table.remove(contact.node_id)
+                    continue
+                if find_value and reply.get("record"):
+                    if _valid_record(reply["record"], target):
+                        return reply["record"]
+                    print(f"[WARN] Ignoring malformed DHT record from {contact.host}:{contact.port}")
+                nodes = reply.get("nodes")
+                for entry in nodes if isinstance(nodes, list) else []:
+                    found = _parse_contact(entry)
+                    if found is not None and found.node_id != self.node_id and found.node_id not in shortlist:
+                        shortlist[found.node_id] = found
+        if find_value:
+            return None
+        return sorted(shortlist.values(), key=lambda contact: contact.node_id ^ target)[:self.k]
+
+    def publish(self):
+        """Store our own address record on the k nodes closest to our username's key."""
+        key = key_for(self.network.username)
+        record = {
+            "username": self.network.username,
+            "port": self.network.port,
+            "instance": self.network.instance_id,
+            # Milliseconds, so it still grows across a restart.
+            "seq": int(time.time() * 1000),
+        }
+        if self.network.host not in ("", "0.0.0.0"):
+            record["host"] = self.network.host
+        with self.lock:
+            self.records[key] = (dict(record, node=_hex(self.node_id)), time.monotonic() + self.record_ttl,
+                                 (self.network.host, self.port))
+        nodes = self.lookup(key)
+        self._request_many([(contact.address, {"type": "store", "key": _hex(key), "record": record})
+                            for contact in nodes])
+        return len(nodes)
+
+    def resolve(self, username):
+        """Current (host, port) of username, or None if no node knows it."""
+        key = key_for(username)
+        record = self._get_record(key)
+        if not _valid_record(record, key):
+            record = self.lookup(key, find_value=True)
+        if record is None:
+            return None
+        return record["host"], record["port"]
+
+    def add_node(self, host, port):
+        """Introduce a node we learned about elsewhere, e.g. a connected peer."""
+        threading.Thread(target=self._request, args=((host, port), {"type": "ping"}), daemon=True).start()
+
+    def bootstrap(self, addresses):
+        replies = self._request_many([(address, {"type": "ping"}) for address in addresses])
+        if addresses and not any(replies):
+            print("[WARN] No DHT bootstrap node answered")
+        # Looking ourselves up fills the buckets near us and announces us.
+        self.lookup(self.node_id)
+
+    def _maintain(self, bootstrap):
+        try:
+            self.bootstrap(bootstrap)
+            self.publish()
+        except Exception as e:
+            print(f"[ERROR] DHT bootstrap: {e}")
+        while not self.stopped.wait(self.refresh_interval):
+            try:
+                self._expire_records()
+                for index in self.table.stale_buckets(self.refresh_interval):
+                    self.lookup(self.node_id ^ random.randrange(2 ** index, 2 ** (index + 1)))
+                self.publish()
+            except Exception as e:
+                print(f"[ERROR] DHT refresh: {e}")
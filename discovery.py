@@ -0,0 +1,217 @@
+import ipaddress
+import json
+import random
+import socket
+import threading
+import time
+
+# Administratively scoped multicast group and port the announcements use.
+# A broadcast address (e.g. 255.255.255.255) works too.
+DEFAULT_DISCOVERY_GROUP = "239.255.77.77"
+DEFAULT_DISCOVERY_PORT = 47777
+# Seconds between our announcements on a quiet segment.
+DEFAULT_DISCOVERY_INTERVAL = 5.0
+# Announcements per second the whole segment should stay under; each peer
+# stretches its interval as the peer table grows.
+DEFAULT_DISCOVERY_MAX_RATE = 20.0
+# A peer is forgotten after this many of its announcement intervals of silence.
+DISCOVERY_TTL_FACTOR = 3
+
+DISCOVERY_SERVICE = "p2p-chat"
+MAX_DATAGRAM = 2048
+
+
+class DiscoveredPeer:
+    __slots__ = ("username", "host", "port", "instance", "expires")
+
+    def __init__(self, username, host, port, instance, expires):
+        self.username = username
+        self.host = host
+        self.port = port
+        self.instance = instance
+        self.expires = expires
+
+    def as_dict(self):
+        return {"username": self.username, "host": self.host, "port": self.port}
+
+
+class PeerTable:
+    """Peers heard on the LAN, each expiring unless announced again in time."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}  # mapping: username -> DiscoveredPeer
+
+    def __len__(self):
+        return len(self.entries)
+
+    def update(self, username, host, port, instance, ttl):
+        """Record an announcement. Returns the entry if the peer (or its address) is new, else None."""
+        expires = time.monotonic() + ttl
+        with self.lock:
+            entry = self.entries.get(username)
+            if entry and (entry.host, entry.port, entry.instance) == (host, port, instance):
+                entry.expires = expires
+                return None
+            entry = self.entries[username] = DiscoveredPeer(username, host, port, instance, expires)
+            return entry
+
+    def remove(self, username):
+        with self.lock:
+            return self.entries.pop(username, None)
+
+    def expire(self):
+        """Drop and return the entries whose TTL ran out."""
+        now = time.monotonic()
+        with self.lock:
+            expired = [entry for entry in self.entries.values() if entry.expires <= now]
+            for entry in expired:
+                del self.entries[entry.username]
+        return expired
+
+    def peers(self):
+        with self.lock:
+            return list(self.entries.values())
+
+
+class DiscoveryService:
+    """
+    Opt-in LAN discovery: announces username, host and port on a UDP
+    multicast group (or broadcast address) and keeps a table of the peers
+    heard, which expires entries that stop announcing.
+
+    Every peer waits max(interval, peers / max_rate) seconds between
+    announcements, with jitter, so the segment as a whole sends about
+    max_rate announcements per second however many peers are on it.
+    Announcements carry that interval, and receivers expire the entry
+    after DISCOVERY_TTL_FACTOR of them.
+
+    With auto_connect, newly discovered peers are dialed by whichever side
+    has the lower username, the same side the duplicate-connection rule
+    favours, so the two never dial each other at once.
+    """
+
+    def __init__(self, network, group=DEFAULT_DISCOVERY_GROUP, port=DEFAULT_DISCOVERY_PORT,
+                 interface="0.0.0.0", interval=DEFAULT_DISCOVERY_INTERVAL,
+                 max_rate=DEFAULT_DISCOVERY_MAX_RATE, auto_connect=False):
+        self.network = network
+        self.group = group
+        self.port = port
+        self.interface = interface
+        self.interval = interval
+        self.max_rate = max_rate
+        self.auto_connect = auto_connect
+        self.multicast = ipaddress.ip_address(group).is_multicast
+        self.table = PeerTable()
+        self.sock = None
+        self.stopped = threading.Event()
+        self.announcements_sent = 0
+        # Optional callable(event, peer_dict) with event "found" or "lost".
+        self.peer_callback = None
+
+    def start(self):
+        self.sock = self._open_socket()
+        print(f"[INFO] Discovery on {self.group}:{self.port}")
+        threading.Thread(target=self._receive_loop, daemon=True).start()
+        threading.Thread(target=self._announce_loop, daemon=True).start()
+
+    def _open_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Several peers on one host all listen on the discovery port.
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(("", self.port))
+        if self.multicast:
+            membership = socket.inet_aton(self.group) + socket.inet_aton(self.interface)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.interface))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        else:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.settimeout(0.5)
+        return sock
+
+    def stop(self):
+        if self.stopped.is_set() or self.sock is None:
+            return
+        self.stopped.set()
+        self._send("bye")
+        self.sock.close()
+
+    def peers(self):
+        """Discovered peers as dicts with username, host and port."""
+        return [entry.as_dict() for entry in self.table.peers()]
+
+    def current_interval(self):
+        return max(self.interval, (len(self.table) + 1) / self.max_rate)
+
+    # ------------------- announcing -------------------
+    def _send(self, msg_type):
+        message = {
+            "service": DISCOVERY_SERVICE,
+            "type": msg_type,
+            "username": self.network.username,
+            "instance": self.network.instance_id,
+            "port": self.network.port,
+            "interval": self.current_interval(),
+        }
+        if self.network.host not in ("", "0.0.0.0"):
+            message["host"] = self.network.host
+        try:
+            self.sock.sendto(json.dumps(message).encode("utf-8"), (self.group, self.port))
+            self.announcements_sent += 1
+        except OSError as e:
+            print(f"[WARN] Discovery announcement failed: {e}")
+
+    def _announce_loop(self):
+        # A short random delay spreads out peers started together.
+        delay = random.uniform(0, min(1.0, self.interval))
+        while not self.stopped.wait(delay):
+            self._send("announce")
+            for entry in self.table.expire():
+                self._notify("lost", entry)
+            delay = self.current_interval() * random.uniform(0.75, 1.25)
+
+    # ------------------- receiving -------------------
+    def _receive_loop(self):
+        while not self.stopped.is_set():
+            try:
+                data, addr = self.sock.recvfrom(MAX_DATAGRAM)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            try:
+                self._on_datagram(json.loads(data), addr)
+            except (ValueError, TypeError, KeyError, AttributeError) as e:
+                print(f"[WARN] Ignoring malformed discovery datagram from {addr[0]}: {e}")
+
+    def _on_datagram(self, message, addr):
+        if message.get("service") != DISCOVERY_SERVICE:
+            return
+        username = message["username"]
+        if username == self.network.username:
+            return
+        if message.get("type") == "bye":
+            # The peer left on purpose; do not keep redialing it.
+            self.network.connection_manager.forget(username)
+            entry = self.table.remove(username)
+            if entry:
+                self._notify("lost", entry)
+            return
+        host = message.get("host") or addr[0]
+        port = int(message["port"])
+        ttl = DISCOVERY_TTL_FACTOR * max(float(message.get("interval", self.interval)), self.interval)
+        entry = self.table.update(username, host, port, message.get("instance"), ttl)
+        if entry is None:
+            return
+        self._notify("found", entry)
+        if self.auto_connect and self.network.username < username and username not in self.network.list_peers():
+            print(f"[INFO] Auto-connecting to discovered peer {username} at {host}:{port}")
+            threading.Thread(target=self.network.connect_to_peer, args=(host, port), daemon=True).start()
+
+    def _notify(self, event, entry):
+        if self.peer_callback:
+            self.peer_callback(event, entry.as_dict())
@@ -0,0 +1,57 @@
+import collections
+import time
+
+# Most callbacks one drain() runs, so a burst is spread over several GUI
+# ticks instead of freezing one.
+DEFAULT_DISPATCH_BATCH = 500
+# How often the GUI drains the queue, in milliseconds (about once a frame).
+DEFAULT_DISPATCH_INTERVAL_MS = 16
+
+
+class QueuedDispatcher:
+    """
+    Hands callbacks from network threads over to a single consumer thread,
+    typically the Qt GUI thread.
+
+    wrap(handler) returns a callback for network threads that only appends
+    (handler, args) to a deque, which never blocks: deque appends and pops
+    are atomic in CPython. The consumer calls drain() on a timer and runs
+    the queued calls there, in arrival order. With a metrics registry, the
+    time calls spend queued and the queue depth are exported.
+    """
+
+    def __init__(self, metrics=None, max_batch=DEFAULT_DISPATCH_BATCH):
+        self.queue = collections.deque()
+        self.max_batch = max_batch
+        self.lag = None
+        if metrics is not None:
+            self.lag = metrics.histogram(
+                "dispatch_lag_seconds", "Time a callback waited in the queue for the GUI thread.")
+            metrics.gauge("dispatch_queue_depth", "Callbacks waiting for the GUI thread.", lambda: len(self.queue))
+
+    def __len__(self):
+        return len(self.queue)
+
+    def wrap(self, handler):
+        """A callback that queues handler(*args) instead of calling it."""
+        queue = self.queue
+
+        def enqueue(*args):
+            queue.append((time.perf_counter(), handler, args))
+        return enqueue
+
+    def drain(self):
+        """Run up to max_batch queued calls on the calling thread. Returns how many ran."""
+        now = time.perf_counter()
+        for count in range(self.max_batch):
+            try:
+                queued_at, handler, args = self.queue.popleft()
+            except IndexError:
+                return count
+            if self.lag:
+                self.lag.observe(now - queued_at)
+            try:
+                handler(*args)
+            except Exception as e:
+                print(f"[ERROR] Dispatched callback {getattr(handler, '__name__', handler)} failed: {e}")
+        return self.max_batch
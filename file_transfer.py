@@ -0,0 +1,677 @@
+import base64
+import collections
+import glob
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import uuid
+
+from connection import HAS_SENDFILE, FileSegment
+from framing import FRAME_HEADER, FLAG_FILE_CHUNK
+from channels import CHANNEL_BULK, assign_channel
+
+DEFAULT_CHUNK_SIZE = 256 * 1024
+# Chunks handed to the connection but not yet written to the socket.
+SEND_WINDOW = 4
+# Receiver state is rewritten after this many newly verified chunks.
+STATE_SAVE_INTERVAL = 256
+# A chunk that keeps failing verification cancels the transfer.
+MAX_CHUNK_RETRIES = 5
+
+# Binary chunk payload header: transfer id, chunk index.
+CHUNK_HEADER = struct.Struct("!16sI")
+
+HASH_NAME = "blake2b-128"
+
+FILE_MESSAGE_TYPES = (
+    "file_offer", "file_accept", "file_resume", "file_chunk", "file_resend",
+    "file_complete", "file_done", "file_cancel",
+)
+# All of a transfer's messages share the bulk channel so they stay in order
+# with its chunks.
+for _msg_type in FILE_MESSAGE_TYPES:
+    assign_channel(_msg_type, CHANNEL_BULK)
+
+# How outgoing binary chunks leave the process:
+#   "sendfile" - os.sendfile, file pages never enter Python
+#   "mmap"     - memoryview slices of a read-only mapping of the file
+#   "copy"     - read each chunk into a bytes object
+#   "auto"     - sendfile where available, otherwise mmap
+SEND_MODES = ("auto", "sendfile", "mmap", "copy")
+
+
+class TransferCancelled(Exception):
+    pass
+
+
+def chunk_digest(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def build_manifest(path, chunk_size):
+    """
+    Hash the file chunk by chunk. The manifest lets the receiver verify each
+    chunk on arrival and identify a partially received file across restarts.
+    """
+    hashes = []
+    filesize = 0
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    with open(path, "rb") as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            hashes.append(chunk_digest(view[:n]))
+            filesize += n
+    file_id = hashlib.blake2b(f"{filesize}:{chunk_size}:{''.join(hashes)}".encode("ascii"), digest_size=16).hexdigest()
+    return {"hash": HASH_NAME, "file_id": file_id, "filesize": filesize,
+            "chunk_size": chunk_size, "chunk_hashes": hashes}
+
+
+def valid_manifest(manifest):
+    """Whether a manifest from a peer is well-formed and describes a consistent file."""
+    if not isinstance(manifest, dict) or manifest.get("hash") != HASH_NAME:
+        return False
+    filesize = manifest.get("filesize")
+    chunk_size = manifest.get("chunk_size")
+    hashes = manifest.get("chunk_hashes")
+    if not all(type(value) is int for value in (filesize, chunk_size)) or filesize < 0 or chunk_size <= 0:
+        return False
+    if not isinstance(manifest.get("file_id"), str) or not isinstance(hashes, list):
+        return False
+    return len(hashes) == -(-filesize // chunk_size) and all(isinstance(h, str) for h in hashes)
+
+
+def int_list(values):
+    """values as a list of ints, or None if it is not a list of integers."""
+    if not isinstance(values, list) or not all(type(value) is int for value in values):
+        return None
+    return values
+
+
+def missing_ranges(have):
+    """Turn a per-chunk 0/1 bytearray into [start, end) ranges of missing chunks."""
+    ranges = []
+    pos = have.find(0)
+    while pos >= 0:
+        end = have.find(1, pos)
+        if end < 0:
+            end = len(have)
+        ranges.append([pos, end])
+        pos = have.find(0, end)
+    return ranges
+
+
+def expand_ranges(ranges):
+    for start, end in ranges:
+        yield from range(start, end)
+
+
+class OutgoingTransfer:
+    def __init__(self, recipient, path, chunk_size, progress_callback):
+        self.transfer_id = uuid.uuid4().hex
+        self.recipient = recipient
+        self.path = path
+        self.filename = os.path.basename(path)
+        self.chunk_size = chunk_size
+        self.progress_callback = progress_callback
+        self.manifest = None
+        self.filesize = 0
+        self.sent_bytes = 0
+        self.reported_bytes = -1
+        self.pending = collections.deque()  # chunk indexes still to send
+        self.cond = threading.Condition()
+        self.stream_conn = None  # connection the streaming thread is using
+        self.cancelled = False
+        self.done = False
+
+    def chunk_count(self):
+        return len(self.manifest["chunk_hashes"])
+
+    def chunk_length(self, index):
+        return min(self.chunk_size, self.filesize - index * self.chunk_size)
+
+
+class IncomingTransfer:
+    """
+    A file being received into <name>.part. Which chunks have been verified
+    is persisted to <name>.state so the transfer survives a dropped
+    connection or a restart.
+    """
+
+    def __init__(self, transfer_id, sender, filename, manifest, final_path, have=None):
+        self.transfer_id = transfer_id
+        self.sender = sender
+        self.filename = filename
+        self.manifest = manifest
+        self.filesize = int(manifest["filesize"])
+        self.chunk_size = int(manifest["chunk_size"])
+        self.chunk_hashes = manifest["chunk_hashes"]
+        self.final_path = final_path
+        self.part_path = final_path + ".part"
+        self.state_path = final_path + ".state"
+        self.have = have if have is not None else bytearray(len(self.chunk_hashes))
+        self.retries = {}
+        self.unsaved = 0
+        self.orphaned = False  # the sender no longer knows this transfer id
+        self.fileobj = None
+
+    @classmethod
+    def load(cls, state_path):
+        with open(state_path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        if not valid_manifest(state.get("manifest")):
+            raise ValueError("invalid manifest")
+        have = bytearray(b"\1" * len(state["manifest"]["chunk_hashes"]))
+        for index in expand_ranges(state["missing"]):
+            have[index] = 0
+        return cls(state["transfer_id"], state["sender"], state["filename"],
+                   state["manifest"], state["final_path"], have)
+
+    def save_state(self):
+        state = {
+            "transfer_id": self.transfer_id,
+            "sender": self.sender,
+            "filename": self.filename,
+            "final_path": self.final_path,
+            "manifest": self.manifest,
+            "missing": missing_ranges(self.have),
+        }
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+        self.unsaved = 0
+
+    def chunk_length(self, index):
+        return min(self.chunk_size, self.filesize - index * self.chunk_size)
+
+    def is_complete(self):
+        return self.have.find(0) < 0
+
+    def write_chunk(self, index, data):
+        if self.fileobj is None:
+            mode = "r+b" if os.path.exists(self.part_path) else "w+b"
+            self.fileobj = open(self.part_path, mode)
+        self.fileobj.seek(index * self.chunk_size)
+        self.fileobj.write(data)
+        self.have[index] = 1
+        self.unsaved += 1
+
+    def close(self):
+        if self.fileobj is not None:
+            self.fileobj.close()
+            self.fileobj = None
+
+    def discard(self):
+        self.close()
+        for path in (self.part_path, self.state_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class FileTransferManager:
+    """
+    Streaming, resumable file transfers over peer connections.
+
+    The sender hashes the file into a manifest and offers it. The receiver
+    accepts with the list of chunks it still needs, which is everything
+    for a new file and only the gaps for one it has partially received.
+    The chunks follow, then a completion message. Every chunk is checked
+    against the manifest on arrival and a bad chunk is re-requested on its
+    own. When the connection drops, both sides keep the transfer. The
+    receiver asks for the missing chunks again once the peer reconnects.
+
+    Only SEND_WINDOW chunks are in memory at a time on either side. With
+    length framing the chunks are raw binary frames; with newline framing
+    they fall back to base64 inside file_chunk messages.
+    """
+
+    def __init__(self, network, download_dir="downloads", chunk_size=DEFAULT_CHUNK_SIZE, send_mode="auto"):
+        if send_mode not in SEND_MODES:
+            raise ValueError(f"Unknown send mode {send_mode!r}, expected one of {SEND_MODES}")
+        self.network = network
+        self.download_dir = download_dir
+        self.chunk_size = chunk_size
+        self.send_mode = send_mode
+        self.outgoing = {}  # mapping: transfer_id -> OutgoingTransfer
+        self.incoming = {}  # mapping: transfer_id -> IncomingTransfer
+        self.lock = threading.Lock()
+        # Optional callable(offer_dict, sender) -> bool deciding whether to accept.
+        self.offer_callback = None
+        self._load_partial_transfers()
+
+    def _load_partial_transfers(self):
+        for state_path in glob.glob(os.path.join(glob.escape(self.download_dir), "*.state")):
+            try:
+                transfer = IncomingTransfer.load(state_path)
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                print(f"[WARN] Ignoring unreadable transfer state {state_path}: {e}")
+                continue
+            self.incoming[transfer.transfer_id] = transfer
+
+    # ------------------- connection events -------------------
+    def peer_connected(self, peer_username):
+        """Ask a reconnected sender for whatever is still missing."""
+        with self.lock:
+            transfers = [t for t in self.incoming.values() if t.sender == peer_username and not t.orphaned]
+        for transfer in transfers:
+            print(f"[INFO] Resuming '{transfer.filename}' from {peer_username}")
+            self._send(peer_username, {
+                "type": "file_resume", "transfer_id": transfer.transfer_id,
+                "missing": missing_ranges(transfer.have),
+            })
+
+    def peer_disconnected(self, peer_username):
+        with self.lock:
+            transfers = [t for t in self.incoming.values() if t.sender == peer_username]
+        for transfer in transfers:
+            transfer.save_state()
+            transfer.close()
+
+    def shutdown(self):
+        with self.lock:
+            transfers = list(self.incoming.values())
+            for transfer in self.outgoing.values():
+                transfer.cancelled = True
+        for transfer in transfers:
+            transfer.save_state()
+            transfer.close()
+
+    def _send(self, peer_username, message):
+        message.setdefault("sender", self.network.username)
+        self.network.send_chat_message(peer_username, message, is_dict=True)
+
+    # ------------------- sending -------------------
+    def send_file(self, recipient, path, progress_callback=None):
+        """
+        Offer a file to a connected peer. Returns the transfer id straight
+        away; the manifest is built and the offer sent from a worker thread.
+        The progress callback receives (bytes_written, filesize) as chunks
+        reach the socket.
+        """
+        transfer = OutgoingTransfer(recipient, path, self.chunk_size, progress_callback)
+        with self.lock:
+            self.outgoing[transfer.transfer_id] = transfer
+        threading.Thread(target=self._offer, args=(transfer,), daemon=True).start()
+        return transfer.transfer_id
+
+    def _offer(self, transfer):
+        try:
+            transfer.manifest = build_manifest(transfer.path, transfer.chunk_size)
+        except OSError as e:
+            print(f"[ERROR] Reading file '{transfer.filename}': {e}")
+            with self.lock:
+                self.outgoing.pop(transfer.transfer_id, None)
+            return
+        transfer.filesize = transfer.manifest["filesize"]
+        self._send(transfer.recipient, {
+            "type": "file_offer",
+            "recipient": transfer.recipient,
+            "transfer_id": transfer.transfer_id,
+            "filename": transfer.filename,
+            "filesize": transfer.filesize,
+            "chunk_size": transfer.chunk_size,
+            "manifest": transfer.manifest,
+        })
+
+    def cancel(self, transfer_id, reason="cancelled"):
+        with self.lock:
+            transfer = self.outgoing.pop(transfer_id, None) or self.incoming.pop(transfer_id, None)
+        if transfer is None:
+            return
+        if isinstance(transfer, OutgoingTransfer):
+            peer = transfer.recipient
+            with transfer.cond:
+                transfer.cancelled = True
+                transfer.cond.notify_all()
+        else:
+            peer = transfer.sender
+            transfer.discard()
+        self._send(peer, {"type": "file_cancel", "transfer_id": transfer_id, "reason": reason})
+
+    def _on_accept(self, message, peer_username):
+        """Handle file_accept and file_resume: (re)start streaming the listed chunks."""
+        transfer_id = message.get("transfer_id")
+        with self.lock:
+            transfer = self.outgoing.get(transfer_id)
+        if transfer is None or transfer.recipient != peer_username or transfer.manifest is None:
+            self._send(peer_username, {"type": "file_cancel", "transfer_id": transfer_id, "reason": "unknown transfer"})
+            return
+        missing = message.get("missing", [[0, transfer.chunk_count()]])
+        if not isinstance(missing, list) or not all(int_list(pair) is not None and len(pair) == 2 for pair in missing):
+            print(f"[WARN] Ignoring {message.get('type')} with malformed chunk ranges from {peer_username}")
+            return
+        indexes = [i for i in expand_ranges(missing) if 0 <= i < transfer.chunk_count()]
+        conn = self.network.connections.get(peer_username)
+        with transfer.cond:
+            transfer.pending = collections.deque(indexes)
+            transfer.sent_bytes = transfer.filesize - sum(transfer.chunk_length(i) for i in indexes)
+            transfer.cond.notify_all()
+            if conn is None or transfer.stream_conn is conn:
+                return
+            transfer.stream_conn = conn
+        threading.Thread(target=self._stream, args=(transfer, conn), daemon=True).start()
+
+    def _resolve_send_mode(self, conn):
+        # Raw chunks need length framing; newline peers get base64 copies.
+        if conn.framing != "length":
+            return "copy"
+        if self.send_mode == "auto":
+            return "sendfile" if HAS_SENDFILE else "mmap"
+        if self.send_mode == "sendfile" and not HAS_SENDFILE:
+            return "mmap"
+        return self.send_mode
+
+    def _stream(self, transfer, conn):
+        # Each connection gets its own window: chunks queued on a dead
+        # connection never report back and must not hold slots of the next.
+        window = threading.Semaphore(SEND_WINDOW)
+        try:
+            mode = self._resolve_send_mode(conn)
+            with open(transfer.path, "rb") as f:
+                mapping = None
+                if mode == "mmap" and transfer.filesize:
+                    mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    self._serve(transfer, conn, window, f, mode, mapping)
+                finally:
+                    # Queued segments still reference the file; let them drain.
+                    self._drain(transfer, conn, window)
+                    if mapping is not None:
+                        try:
+                            mapping.close()
+                        except BufferError:
+                            pass  # a dead connection still holds a slice; GC closes it
+            print(f"[INFO] Sent '{transfer.filename}' ({transfer.filesize} bytes) to {transfer.recipient}")
+        except TransferCancelled as e:
+            if not (transfer.cancelled or transfer.done):
+                print(f"[INFO] Transfer of '{transfer.filename}' to {transfer.recipient} paused: {e}")
+        except Exception as e:
+            print(f"[ERROR] Sending file '{transfer.filename}' to {transfer.recipient}: {e}")
+        finally:
+            with transfer.cond:
+                if transfer.stream_conn is conn:
+                    transfer.stream_conn = None
+            # Unfinished transfers stay registered so the receiver can resume them.
+            if transfer.done or transfer.cancelled:
+                with self.lock:
+                    self.outgoing.pop(transfer.transfer_id, None)
+
+    def _serve(self, transfer, conn, window, f, mode, mapping):
+        complete_sent = False
+        while True:
+            index = self._next_chunk(transfer, conn, wait=complete_sent)
+            if index is None:
+                if transfer.done:
+                    return
+                # Everything queued is on the wire; tell the receiver to check.
+                self._drain(transfer, conn, window)
+                try:
+                    conn.send_message({"type": "file_complete", "sender": self.network.username,
+                                       "transfer_id": transfer.transfer_id})
+                except OSError as e:
+                    raise TransferCancelled(f"connection lost: {e}") from e
+                complete_sent = True
+                continue
+            complete_sent = False
+            self._acquire_slot(transfer, conn, window)
+            try:
+                self._send_chunk(transfer, conn, window, f, mode, mapping, index)
+            except OSError as e:
+                # A resume on another connection carries on from here.
+                raise TransferCancelled(f"connection lost: {e}") from e
+
+    def _next_chunk(self, transfer, conn, wait):
+        with transfer.cond:
+            while not transfer.pending:
+                if transfer.done or not wait:
+                    return None
+                self._check_alive(transfer, conn)
+                transfer.cond.wait(0.5)
+            self._check_alive(transfer, conn)
+            return transfer.pending.popleft()
+
+    def _send_chunk(self, transfer, conn, window, f, mode, mapping, index):
+        offset = index * transfer.chunk_size
+        count = transfer.chunk_length(index)
+        on_sent = self._chunk_written(transfer, window, count)
+        if mode == "copy":
+            f.seek(offset)
+            data = f.read(count)
+            if conn.framing == "length":
+                flags = conn.frame_flags(FLAG_FILE_CHUNK, CHANNEL_BULK)
+                frame = (FRAME_HEADER.pack(CHUNK_HEADER.size + len(data), flags)
+                         + CHUNK_HEADER.pack(bytes.fromhex(transfer.transfer_id), index) + data)
+                conn.sendall(frame, on_sent, channel=CHANNEL_BULK)
+            else:
+                chunk_msg = {
+                    "type": "file_chunk",
+                    "transfer_id": transfer.transfer_id,
+                    "index": index,
+                    "data": base64.b64encode(data).decode("ascii"),
+                }
+                conn.send_message(chunk_msg, on_sent)
+            return
+        header = (FRAME_HEADER.pack(CHUNK_HEADER.size + count, conn.frame_flags(FLAG_FILE_CHUNK, CHANNEL_BULK))
+                  + CHUNK_HEADER.pack(bytes.fromhex(transfer.transfer_id), index))
+        view = memoryview(mapping)[offset:offset + count] if mapping is not None else None
+        conn.sendfile(header, FileSegment(f, offset, count, view), on_sent)
+
+    def _check_alive(self, transfer, conn):
+        if transfer.cancelled:
+            raise TransferCancelled("transfer cancelled")
+        if self.network.connections.get(transfer.recipient) is not conn or transfer.stream_conn is not conn:
+            raise TransferCancelled("connection lost")
+
+    def _drain(self, transfer, conn, window):
+        """Wait until every chunk handed to the connection has been written, or it is gone."""
+        acquired = 0
+        while acquired < SEND_WINDOW:
+            if window.acquire(timeout=0.5):
+                acquired += 1
+            elif self.network.connections.get(transfer.recipient) is not conn:
+                break
+        for _ in range(acquired):
+            window.release()
+
+    def _acquire_slot(self, transfer, conn, window):
+        while not window.acquire(timeout=0.5):
+            self._check_alive(transfer, conn)
+
+    def _chunk_written(self, transfer, window, nbytes):
+        def on_sent():
+            transfer.sent_bytes = min(transfer.sent_bytes + nbytes, transfer.filesize)
+            window.release()
+            # Re-sent chunks must not move the bar backwards or past 100%.
+            if transfer.progress_callback and transfer.sent_bytes > transfer.reported_bytes:
+                transfer.reported_bytes = transfer.sent_bytes
+                transfer.progress_callback(transfer.sent_bytes, transfer.filesize)
+        return on_sent
+
+    # ------------------- receiving -------------------
+    def handle_message(self, message, peer_username):
+        msg_type = message.get("type")
+        transfer_id = message.get("transfer_id")
+        if msg_type == "file_offer":
+            self._on_offer(message, peer_username)
+        elif msg_type in ("file_accept", "file_resume"):
+            self._on_accept(message, peer_username)
+        elif msg_type == "file_chunk":
+            index = self._int_field(message, "index", peer_username)
+            if index is None:
+                return
+            try:
+                data = base64.b64decode(message.get("data", ""))
+            except (TypeError, ValueError):
+                print(f"[WARN] Ignoring file_chunk with undecodable data from {peer_username}")
+                return
+            self._write_chunk(transfer_id, index, data, peer_username)
+        elif msg_type == "file_resend":
+            indexes = int_list(message.get("indexes", []))
+            if indexes is None:
+                print(f"[WARN] Ignoring file_resend with non-integer indexes from {peer_username}")
+                return
+            with self.lock:
+                transfer = self.outgoing.get(transfer_id)
+            if transfer is not None and transfer.recipient == peer_username:
+                with transfer.cond:
+                    transfer.pending.extend(i for i in indexes if 0 <= i < transfer.chunk_count())
+                    transfer.cond.notify_all()
+        elif msg_type == "file_complete":
+            self._on_complete(transfer_id, peer_username)
+        elif msg_type == "file_done":
+            with self.lock:
+                transfer = self.outgoing.get(transfer_id)
+            if transfer is not None and transfer.recipient == peer_username:
+                with transfer.cond:
+                    transfer.done = True
+                    transfer.cond.notify_all()
+                if transfer.progress_callback and transfer.filesize == 0:
+                    transfer.progress_callback(0, 0)
+        elif msg_type == "file_cancel":
+            self._on_cancel(message, peer_username)
+
+    def _int_field(self, message, key, peer_username):
+        """message[key] if it is an integer, else None after a warning."""
+        value = message.get(key)
+        if type(value) is not int:
+            print(f"[WARN] Ignoring {message.get('type')} with non-integer {key} {value!r} from {peer_username}")
+            return None
+        return value
+
+    def handle_chunk(self, frame, peer_username):
+        """
+        Handle a binary chunk frame. The chunk is written straight from the
+        receive buffer; frames for unknown transfers are discarded.
+        """
+        if len(frame) < CHUNK_HEADER.size:
+            print(f"[WARN] Dropping truncated file chunk frame ({len(frame)} bytes) from {peer_username}")
+            return
+        tid, index = CHUNK_HEADER.unpack_from(frame)
+        self._write_chunk(tid.hex(), index, frame[CHUNK_HEADER.size:], peer_username)
+
+    def _on_offer(self, offer, peer_username):
+        filename = os.path.basename(str(offer.get("filename", "")))
+        manifest = offer.get("manifest")
+        transfer_id = offer.get("transfer_id")
+        if filename in ("", ".", "..") or not isinstance(transfer_id, str):
+            print(f"[WARN] Ignoring invalid file offer from {peer_username}")
+            return
+        if not valid_manifest(manifest):
+            print(f"[WARN] Rejecting file offer '{filename}' from {peer_username}: invalid manifest")
+            self._send(peer_username, {"type": "file_cancel", "transfer_id": transfer_id, "reason": "invalid manifest"})
+            return
+        if self.offer_callback and not self.offer_callback(offer, peer_username):
+            self._send(peer_username, {"type": "file_cancel", "transfer_id": transfer_id, "reason": "rejected"})
+            return
+        with self.lock:
+            # The same file from the same sender picks up where it left off.
+            transfer = next((t for t in self.incoming.values()
+                             if t.sender == peer_username and t.manifest.get("file_id") == manifest.get("file_id")), None)
+            if transfer is not None:
+                del self.incoming[transfer.transfer_id]
+                transfer.transfer_id = transfer_id
+                transfer.orphaned = False
+            else:
+                os.makedirs(self.download_dir, exist_ok=True)
+                transfer = IncomingTransfer(transfer_id, peer_username, filename, manifest, self._unique_path(filename))
+            self.incoming[transfer_id] = transfer
+        transfer.save_state()
+        self._send(peer_username, {"type": "file_accept", "transfer_id": transfer_id,
+                                   "missing": missing_ranges(transfer.have)})
+
+    def _unique_path(self, filename):
+        base, ext = os.path.splitext(filename)
+        path = os.path.join(self.download_dir, filename)
+        taken = {t.final_path for t in self.incoming.values()}
+        n = 1
+        while path in taken or os.path.exists(path) or os.path.exists(path + ".part"):
+            path = os.path.join(self.download_dir, f"{base} ({n}){ext}")
+            n += 1
+        return path
+
+    def _write_chunk(self, transfer_id, index, data, peer_username):
+        with self.lock:
+            transfer = self.incoming.get(transfer_id)
+        if transfer is None or transfer.sender != peer_username:
+            return
+        if not 0 <= index < len(transfer.have):
+            print(f"[WARN] Dropping out-of-range chunk {index} for '{transfer.filename}'")
+            return
+        if transfer.have[index]:
+            return
+        if len(data) != transfer.chunk_length(index) or chunk_digest(data) != transfer.chunk_hashes[index]:
+            retries = transfer.retries[index] = transfer.retries.get(index, 0) + 1
+            if retries > MAX_CHUNK_RETRIES:
+                print(f"[ERROR] Chunk {index} of '{transfer.filename}' keeps failing verification")
+                self.cancel(transfer_id, "chunk verification failed")
+                return
+            print(f"[WARN] Chunk {index} of '{transfer.filename}' failed verification, re-requesting")
+            self._send(peer_username, {"type": "file_resend", "transfer_id": transfer_id, "indexes": [index]})
+            return
+        transfer.write_chunk(index, data)
+        if transfer.unsaved >= STATE_SAVE_INTERVAL:
+            transfer.save_state()
+
+    def _on_complete(self, transfer_id, peer_username):
+        with self.lock:
+            transfer = self.incoming.get(transfer_id)
+        if transfer is None or transfer.sender != peer_username:
+            return
+        if not transfer.is_complete():
+            indexes = list(expand_ranges(missing_ranges(transfer.have)))
+            self._send(peer_username, {"type": "file_resend", "transfer_id": transfer_id, "indexes": indexes})
+            return
+        with self.lock:
+            self.incoming.pop(transfer_id, None)
+        transfer.close()
+        if not os.path.exists(transfer.part_path):
+            open(transfer.part_path, "wb").close()  # empty file, no chunks were written
+        os.replace(transfer.part_path, transfer.final_path)
+        try:
+            os.remove(transfer.state_path)
+        except FileNotFoundError:
+            pass
+        self._send(peer_username, {"type": "file_done", "transfer_id": transfer_id})
+        self.network._deliver_message({
+            "type": "file_received",
+            "sender": peer_username,
+            "filename": transfer.filename,
+            "filesize": transfer.filesize,
+            "path": transfer.final_path,
+        }, peer_username)
+
+    def _on_cancel(self, message, peer_username):
+        transfer_id = message.get("transfer_id")
+        reason = message.get("reason")
+        with self.lock:
+            transfer = self.outgoing.get(transfer_id) or self.incoming.get(transfer_id)
+            if transfer is None:
+                return
+            if isinstance(transfer, OutgoingTransfer):
+                if transfer.recipient != peer_username:
+                    return
+                del self.outgoing[transfer_id]
+            else:
+                if transfer.sender != peer_username:
+                    return
+                if reason == "unknown transfer":
+                    # The sender restarted. Keep the partial file: offering the
+                    # same file again resumes it through the manifest file id.
+                    transfer.orphaned = True
+                    return
+                del self.incoming[transfer_id]
+        if isinstance(transfer, OutgoingTransfer):
+            with transfer.cond:
+                transfer.cancelled = True
+                transfer.cond.notify_all()
+        else:
+            transfer.discard()
+        print(f"[INFO] Transfer of '{transfer.filename}' cancelled by {peer_username}: {reason}")
@@ -0,0 +1,134 @@
+import struct
+
+# Supported wire framings, most preferred first. "newline" is the original
+# newline-delimited JSON and is always used for the introduce handshake.
+FRAMINGS = ("length", "newline")
+
+# Length-prefixed frame header: payload length, then a flags byte.
+FRAME_HEADER = struct.Struct("!IB")
+
+# Frame flags.
+FLAG_COMPRESSED = 0x01  # payload is compressed with the connection's negotiated compressor
+FLAG_FILE_CHUNK = 0x02  # payload is a raw file chunk, not an encoded message
+FLAG_MORE = 0x04        # more fragments of this message follow on the same channel
+# Bits 4-5 carry the logical channel once channels are negotiated.
+CHANNEL_SHIFT = 4
+CHANNEL_MASK = 0x30
+
+DEFAULT_RECV_SIZE = 65536
+DEFAULT_MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+
+class FrameError(ValueError):
+    """Raised when the peer sends a frame we refuse to buffer."""
+
+
+def encode_frame(payload, framing, flags=0):
+    """
+    Wrap an encoded message for the wire using the given framing.
+    """
+    if framing == "length":
+        return FRAME_HEADER.pack(len(payload), flags) + payload
+    return payload + b'\n'
+
+
+class FrameDecoder:
+    """
+    Incremental frame parser on top of one reusable bytearray.
+
+    Data is received straight into the buffer and frames are handed out as
+    memoryview slices of it, so nothing is copied per frame. A frame view is
+    only valid until the next recv_into() or feed() call.
+    """
+
+    def __init__(self, framing="newline", recv_size=DEFAULT_RECV_SIZE, max_frame_size=DEFAULT_MAX_FRAME_SIZE):
+        self.framing = framing
+        self.recv_size = recv_size
+        self.max_frame_size = max_frame_size
+        self._buf = bytearray(recv_size)
+        self._view = memoryview(self._buf)
+        self._start = 0   # first unconsumed byte
+        self._end = 0     # end of received data
+        self._scan = 0    # where the next newline search resumes
+        self._need = 0    # bytes needed to complete the current length frame
+
+    def set_framing(self, framing):
+        self.framing = framing
+
+    def pending(self):
+        return self._end - self._start
+
+    def _reserve(self, n):
+        """Make sure at least n bytes are free after the received data."""
+        size = len(self._buf)
+        if size - self._end >= n:
+            return
+        pending = self._end - self._start
+        if pending == 0:
+            self._start = self._end = self._scan = 0
+            if size >= n:
+                return
+        elif self._start >= pending and pending + n <= size:
+            # Moving the tail down costs no more than what was consumed since
+            # the last move, which keeps the total work linear.
+            self._view[:pending] = self._view[self._start:self._end]
+            self._scan -= self._start
+            self._start, self._end = 0, pending
+            return
+        new_buf = bytearray(max(size * 2, pending + n))
+        new_buf[:pending] = self._view[self._start:self._end]
+        self._buf = new_buf
+        self._view = memoryview(new_buf)
+        self._scan -= self._start
+        self._start, self._end = 0, pending
+
+    def recv_into(self, sock):
+        """Receive directly into the buffer. Returns the byte count, 0 on EOF."""
+        want = max(self.recv_size, self._need - self.pending())
+        self._reserve(want)
+        n = sock.recv_into(self._view[self._end:self._end + want])
+        self._end += n
+        return n
+
+    def feed(self, data):
+        n = len(data)
+        self._reserve(n)
+        self._view[self._end:self._end + n] = data
+        self._end += n
+
+    def next_frame(self):
+        """Return (flags, payload view) for the next complete frame, or None."""
+        if self.framing == "length":
+            available = self._end - self._start
+            if available < FRAME_HEADER.size:
+                return None
+            length, flags = FRAME_HEADER.unpack_from(self._buf, self._start)
+            if length > self.max_frame_size:
+                raise FrameError(f"Frame of {length} bytes exceeds limit of {self.max_frame_size}")
+            total = FRAME_HEADER.size + length
+            if available < total:
+                self._need = total
+                return None
+            self._need = 0
+            begin = self._start + FRAME_HEADER.size
+            self._start += total
+            self._scan = self._start
+            return flags, self._view[begin:begin + length]
+
+        index = self._buf.find(b'\n', self._scan, self._end)
+        if index < 0:
+            self._scan = self._end
+            if self._end - self._start > self.max_frame_size:
+                raise FrameError(f"Line exceeds limit of {self.max_frame_size} bytes")
+            return None
+        frame = self._view[self._start:index]
+        self._start = self._scan = index + 1
+        return 0, frame
+
+    def frames(self):
+        """Yield every complete frame currently buffered."""
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
@@ -0,0 +1,135 @@
+import collections
+import random
+import threading
+import time
+import uuid
+
+# Most hops a group message travels from its origin.
+DEFAULT_GOSSIP_TTL = 6
+# Neighbours each relay forwards to, chosen at random; 0 floods to all.
+DEFAULT_GOSSIP_FANOUT = 0
+# Message IDs remembered for duplicate suppression: at most this many,
+# and none for longer than DEFAULT_SEEN_CACHE_SECONDS.
+DEFAULT_SEEN_CACHE_SIZE = 65536
+DEFAULT_SEEN_CACHE_SECONDS = 300.0
+
+GOSSIP_MESSAGE_TYPES = ("group_chat",)
+
+
+class SeenCache:
+    """Bounded, time-windowed set of message IDs, oldest evicted first."""
+
+    def __init__(self, max_size=DEFAULT_SEEN_CACHE_SIZE, max_age=DEFAULT_SEEN_CACHE_SECONDS):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # mapping: message id -> first seen, oldest first
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, msg_id):
+        """Remember msg_id. Returns False if it was already seen."""
+        now = time.monotonic()
+        with self.lock:
+            entries = self.entries
+            while entries:
+                oldest, seen_at = next(iter(entries.items()))
+                if now - seen_at < self.max_age and len(entries) < self.max_size:
+                    break
+                del entries[oldest]
+            if msg_id in entries:
+                return False
+            entries[msg_id] = now
+            return True
+
+
+class GossipRelay:
+    """
+    Flooding overlay for group messages, so they reach peers we have no
+    direct connection to.
+
+    Every group message carries a unique id and a TTL. The origin sends
+    it to all its neighbours. Each peer delivers a message the first time
+    it sees the id, then forwards it with the TTL decremented to `fanout`
+    random neighbours (all with fanout 0), never back to the one it came
+    from. Duplicates arriving over other paths are dropped by the seen
+    cache, so the cost per message is one send per overlay edge at most.
+    """
+
+    def __init__(self, network, ttl=DEFAULT_GOSSIP_TTL, fanout=DEFAULT_GOSSIP_FANOUT,
+                 cache_size=DEFAULT_SEEN_CACHE_SIZE, cache_seconds=DEFAULT_SEEN_CACHE_SECONDS):
+        self.network = network
+        self.ttl = ttl
+        self.fanout = fanout
+        self.seen = SeenCache(cache_size, cache_seconds)
+        self.lock = threading.Lock()
+        self.published = 0
+        self.delivered = 0
+        self.relayed = 0     # copies forwarded to neighbours
+        self.duplicates = 0  # copies dropped because the id was already seen
+
+    def publish(self, group, content, extra_fields=None):
+        """Send a group message to the whole overlay. Returns its id."""
+        message = {
+            "type": "group_chat",
+            "id": uuid.uuid4().hex,
+            "ttl": self.ttl,
+            "origin": self.network.username,
+            "sender": self.network.username,
+            "group": group,
+            "content": content,
+        }
+        if extra_fields:
+            message.update(extra_fields)
+        self.seen.add(message["id"])
+        with self.lock:
+            self.published += 1
+        self._forward(message, exclude=None, fanout=0)
+        return message["id"]
+
+    def handle_message(self, message, peer_username):
+        """
+        Relay a received group message. Returns whether it should be
+        delivered here, i.e. it was not seen before.
+        """
+        msg_id = message.get("id")
+        if not isinstance(msg_id, str):
+            # From a peer without gossip support: deliver, do not relay.
+            return True
+        if not self.seen.add(msg_id):
+            with self.lock:
+                self.duplicates += 1
+            return False
+        with self.lock:
+            self.delivered += 1
+        ttl = message.get("ttl")
+        if isinstance(ttl, int) and ttl > 1:
+            self._forward(dict(message, ttl=ttl - 1), exclude=peer_username, fanout=self.fanout)
+        return True
+
+    def _forward(self, message, exclude, fanout):
+        origin = message.get("origin")
+        with self.network.lock:
+            conns = [(user, conn) for user, conn in self.network.connections.items()
+                     if user != exclude and user != origin]
+        if fanout and len(conns) > fanout:
+            conns = random.sample(conns, fanout)
+        for peer_username, conn in conns:
+            try:
+                conn.send_message(message)
+            except OSError as e:
+                print(f"[ERROR] Relaying group message to {peer_username}: {e}")
+                continue
+            with self.lock:
+                self.relayed += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "published": self.published,
+                "delivered": self.delivered,
+                "relayed": self.relayed,
+                "duplicates": self.duplicates,
+                "seen_cache": len(self.seen),
+            }
@@ -1,30 +1,26 @@
 import sys
 import os
-import base64
-import textwrap
+import dataclasses
+import functools
+import threading
 
-from PyQt5.QtCore import pyqtSignal, QThread, QTimer, Qt, QSettings, QSize
-from PyQt5.QtGui import QIcon, QTextCursor
+from PyQt5.QtCore import (
+    pyqtSignal, QTimer, Qt, QSettings, QSize, QStandardPaths, QAbstractListModel, QModelIndex, QRect, QPoint,
+)
+from PyQt5.QtGui import QIcon, QColor, QPainter
 from PyQt5.QtWidgets import (
-    QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QTextEdit,
-    QLineEdit, QPushButton, QMessageBox, QFileDialog, QProgressBar, QDockWidget,
+    QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QListView, QAbstractItemView,
+    QLineEdit, QPushButton, QMessageBox, QFileDialog, QProgressBar, QDockWidget, QStyledItemDelegate,
     QListWidget, QToolBar, QAction, QStackedWidget, QLabel, QFormLayout, QInputDialog,
-    QDialog, QDialogButtonBox, QComboBox, QGraphicsDropShadowEffect
+    QDialog, QDialogButtonBox, QComboBox, QGraphicsDropShadowEffect, QTreeWidget, QTreeWidgetItem,
+    QCheckBox, QListWidgetItem
 )
 
+from config import NetworkConfig
+from dispatch import QueuedDispatcher, DEFAULT_DISPATCH_INTERVAL_MS
+from message_store import DEFAULT_HISTORY_PAGE_SIZE
 from network import PeerNetwork
 
-# ------------------- FileTransferThread -------------------
-class FileTransferThread(QThread):
-    progress = pyqtSignal(int)
-    def __init__(self, total_bytes):
-        super().__init__()
-        self.total_bytes = total_bytes
-    def run(self):
-        for i in range(101):
-            self.progress.emit(i)
-            self.msleep(20)
-
 # ------------------- PreferencesDialog -------------------
 class PreferencesDialog(QDialog):
     def __init__(self, parent=None):
@@ -38,6 +34,19 @@ class PreferencesDialog(QDialog):
         form_layout = QFormLayout()
         self.username_edit = QLineEdit()
         form_layout.addRow("Default Sending Username:", self.username_edit)
+        self.discovery_check = QCheckBox("Find peers on the local network")
+        form_layout.addRow(self.discovery_check)
+        self.auto_connect_check = QCheckBox("Connect to discovered peers automatically")
+        form_layout.addRow(self.auto_connect_check)
+        self.dht_check = QCheckBox("Join the username directory (DHT)")
+        form_layout.addRow(self.dht_check)
+        self.dht_bootstrap_edit = QLineEdit()
+        self.dht_bootstrap_edit.setPlaceholderText("host:port")
+        form_layout.addRow("DHT Bootstrap Node:", self.dht_bootstrap_edit)
+        self.history_check = QCheckBox("Keep chat history between sessions")
+        form_layout.addRow(self.history_check)
+        self.outbox_check = QCheckBox("Queue messages for offline peers")
+        form_layout.addRow(self.outbox_check)
         self.layout.addLayout(form_layout)
 
         self.button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
@@ -51,10 +60,22 @@ class PreferencesDialog(QDialog):
         settings = QSettings("MyCompany", "P2PChatApp")
         default_username = settings.value("defaultSendingUsername", "")
         self.username_edit.setText(default_username)
+        self.discovery_check.setChecked(settings.value("lanDiscovery", False, type=bool))
+        self.auto_connect_check.setChecked(settings.value("discoveryAutoConnect", False, type=bool))
+        self.dht_check.setChecked(settings.value("dht", False, type=bool))
+        self.dht_bootstrap_edit.setText(settings.value("dhtBootstrap", ""))
+        self.history_check.setChecked(settings.value("keepHistory", True, type=bool))
+        self.outbox_check.setChecked(settings.value("queueOffline", True, type=bool))
 
     def save_settings(self):
         settings = QSettings("MyCompany", "P2PChatApp")
         settings.setValue("defaultSendingUsername", self.username_edit.text())
+        settings.setValue("lanDiscovery", self.discovery_check.isChecked())
+        settings.setValue("discoveryAutoConnect", self.auto_connect_check.isChecked())
+        settings.setValue("dht", self.dht_check.isChecked())
+        settings.setValue("dhtBootstrap", self.dht_bootstrap_edit.text().strip())
+        settings.setValue("keepHistory", self.history_check.isChecked())
+        settings.setValue("queueOffline", self.outbox_check.isChecked())
 
     def accept(self):
         self.save_settings()
@@ -133,18 +154,203 @@ class SetupWidget(QWidget):
 
         self.setupCompleted.emit(send_user, send_port, listen_user, listen_port)
 
+# ------------------- ChatListModel -------------------
+# Custom item data roles of the chat list.
+MSG_TYPE_ROLE = Qt.UserRole
+OUTGOING_ROLE = Qt.UserRole + 1
+# Rows kept per chat list; older ones are dropped (and paged back in from
+# the history log on scroll).
+MAX_CHAT_ROWS = 5000
+# Incoming messages are added to the list at most once per frame.
+FRAME_INTERVAL_MS = 16
+
+# (background, text colour) of a bubble per message type; our own
+# messages get OUTGOING_BUBBLE_COLOR behind the same text colour.
+BUBBLE_COLORS = {
+    "chat": ("orange", "#333333"),
+    "info": ("#F5F5F5", "#666666"),
+    "error": ("#FCE4EC", "#C62828"),
+    "group": ("#E8F5E9", "#2E7D32"),
+}
+OUTGOING_BUBBLE_COLOR = "green"
+# Widest a bubble gets, as a fraction of the list width.
+BUBBLE_MAX_WIDTH = 0.6
+BUBBLE_MARGIN = 4
+BUBBLE_PADDING_X = 10
+BUBBLE_PADDING_Y = 6
+
+
+def history_row(row, identity):
+    """A chat list row for a history log row, shown as it was live."""
+    if row["kind"] == "group":
+        text = f"{row['sender']} in [{row['grp']}]: {row['content']}"
+    else:
+        text = f"{row['sender']}: {row['content']}"
+    return text, row["kind"], row["sender"] == identity, row["id"]
+
+
+class ChatListModel(QAbstractListModel):
+    """
+    Chat messages as rows of (text, msg_type, outgoing, history_id), the
+    last set for rows that are in the history log. Holds at most
+    max_rows, dropping the oldest.
+    """
+
+    def __init__(self, parent=None, max_rows=MAX_CHAT_ROWS):
+        super().__init__(parent)
+        self.rows = []
+        self.max_rows = max_rows
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        text, msg_type, outgoing, _ = self.rows[index.row()]
+        if role == Qt.DisplayRole:
+            return text
+        if role == MSG_TYPE_ROLE:
+            return msg_type
+        if role == OUTGOING_ROLE:
+            return outgoing
+        return None
+
+    def append_rows(self, rows):
+        """Add rows at the bottom in one insert. Returns how many rows were dropped to stay under max_rows."""
+        dropped = max(0, len(rows) - self.max_rows)
+        rows = rows[dropped:]
+        first = len(self.rows)
+        self.beginInsertRows(QModelIndex(), first, first + len(rows) - 1)
+        self.rows.extend(rows)
+        self.endInsertRows()
+        excess = len(self.rows) - self.max_rows
+        if excess > 0:
+            self.beginRemoveRows(QModelIndex(), 0, excess - 1)
+            del self.rows[:excess]
+            self.endRemoveRows()
+            dropped += excess
+        return dropped
+
+    def prepend_rows(self, rows):
+        if not rows:
+            return
+        self.beginInsertRows(QModelIndex(), 0, len(rows) - 1)
+        self.rows[:0] = rows
+        self.endInsertRows()
+
+    def remove_top(self, count):
+        if count > 0:
+            self.beginRemoveRows(QModelIndex(), 0, count - 1)
+            del self.rows[:count]
+            self.endRemoveRows()
+
+    def remove_bottom(self, count):
+        if count > 0:
+            first = len(self.rows) - count
+            self.beginRemoveRows(QModelIndex(), first, len(self.rows) - 1)
+            del self.rows[first:]
+            self.endRemoveRows()
+
+    def clear(self):
+        self.beginResetModel()
+        self.rows = []
+        self.endResetModel()
+
+    def trim_to_logged_top(self):
+        """
+        Drop rows above the first one in the history log, so the view
+        starts where a history page can continue it. Returns that row's
+        history id, None if no row is in the log.
+        """
+        for index, row in enumerate(self.rows):
+            if row[3] is not None:
+                self.remove_top(index)
+                return row[3]
+        return None
+
+    def trim_to_logged_bottom(self):
+        """Like trim_to_logged_top, for the bottom of the list."""
+        for index in range(len(self.rows) - 1, -1, -1):
+            if self.rows[index][3] is not None:
+                self.remove_bottom(len(self.rows) - 1 - index)
+                return self.rows[index][3]
+        return None
+
+
+class ChatBubbleDelegate(QStyledItemDelegate):
+    """Paints a row as a rounded bubble, on the right for our own messages."""
+
+    def __init__(self, view):
+        super().__init__(view)
+        self.view = view
+
+    def text_rect(self, option, text):
+        width = max(80, int(self.view.viewport().width() * BUBBLE_MAX_WIDTH)) - 2 * BUBBLE_PADDING_X
+        return option.fontMetrics.boundingRect(QRect(0, 0, width, 1 << 20), Qt.TextWordWrap, text)
+
+    def sizeHint(self, option, index):
+        rect = self.text_rect(option, index.data())
+        return QSize(rect.width() + 2 * (BUBBLE_PADDING_X + BUBBLE_MARGIN),
+                     rect.height() + 2 * (BUBBLE_PADDING_Y + BUBBLE_MARGIN))
+
+    def paint(self, painter, option, index):
+        text = index.data()
+        outgoing = index.data(OUTGOING_ROLE)
+        background, foreground = BUBBLE_COLORS.get(index.data(MSG_TYPE_ROLE), BUBBLE_COLORS["chat"])
+        if outgoing:
+            background = OUTGOING_BUBBLE_COLOR
+        rect = self.text_rect(option, text)
+        bubble = QRect(0, 0, rect.width() + 2 * BUBBLE_PADDING_X, rect.height() + 2 * BUBBLE_PADDING_Y)
+        if outgoing:
+            bubble.moveTopRight(option.rect.topRight() + QPoint(-BUBBLE_MARGIN, BUBBLE_MARGIN))
+        else:
+            bubble.moveTopLeft(option.rect.topLeft() + QPoint(BUBBLE_MARGIN, BUBBLE_MARGIN))
+        painter.save()
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(QColor(background))
+        painter.drawRoundedRect(bubble, 10, 10)
+        painter.setPen(QColor(foreground))
+        painter.drawText(bubble.adjusted(BUBBLE_PADDING_X, BUBBLE_PADDING_Y, -BUBBLE_PADDING_X, -BUBBLE_PADDING_Y),
+                         Qt.TextWordWrap, text)
+        painter.restore()
+
 # ------------------- ChatPanel -------------------
 class ChatPanel(QWidget):
+    # Emitted from network threads: (recipient, filename, bytes_written, filesize).
+    # Sizes use object because files can exceed a 32-bit int.
+    file_progress = pyqtSignal(str, str, object, object)
+    # Emitted, from any thread, when the first message of a frame is queued.
+    messages_pending = pyqtSignal()
+
     def __init__(self, identity, network=None, parent=None):
         super().__init__(parent)
         self.identity = identity
         self.network = network
+        # The list is a window of at most MAX_CHAT_ROWS over the history
+        # log. history_before is the id of the top row (None: the newest
+        # page comes next); older pages load when scrolled to the top.
+        # While history_after is set, newer rows were evicted from the
+        # bottom and load again when scrolled to the bottom.
+        self.history_before = None
+        self.history_done = False
+        self.history_after = None
+        # Messages waiting for the next frame, as model rows.
+        self.pending = []
+        self.pending_lock = threading.Lock()
+        self.flush_timer = QTimer(self)
+        self.flush_timer.setSingleShot(True)
+        self.flush_timer.setInterval(FRAME_INTERVAL_MS)
+        self.flush_timer.timeout.connect(self.flush_pending)
 
         # We name this panel "chatPanel" for QSS styling
         self.setObjectName("chatPanel")
 
         self.setup_ui()
         self.apply_teal_panel()
+        self.file_progress.connect(self.on_file_progress)
+        self.messages_pending.connect(self.schedule_flush)
 
     def setup_ui(self):
         layout = QVBoxLayout()
@@ -155,9 +361,18 @@ class ChatPanel(QWidget):
         title_label.setStyleSheet("font-size: 16px; font-weight: bold;")
         layout.addWidget(title_label)
 
-        self.chat_display = QTextEdit()
-        self.chat_display.setReadOnly(True)
-        layout.addWidget(self.chat_display)
+        self.chat_model = ChatListModel(self)
+        self.chat_view = QListView()
+        self.chat_view.setModel(self.chat_model)
+        self.chat_view.setItemDelegate(ChatBubbleDelegate(self.chat_view))
+        self.chat_view.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.chat_view.setResizeMode(QListView.Adjust)
+        # Lay rows out in batches so a long list never blocks the event loop.
+        self.chat_view.setLayoutMode(QListView.Batched)
+        self.chat_view.setSelectionMode(QAbstractItemView.NoSelection)
+        self.chat_view.setWordWrap(True)
+        self.chat_view.verticalScrollBar().valueChanged.connect(self.on_scroll)
+        layout.addWidget(self.chat_view)
 
         # Horizontal layout for message entry + Send
         input_layout = QHBoxLayout()
@@ -209,46 +424,114 @@ class ChatPanel(QWidget):
         shadow.setColor(Qt.gray)
         self.setGraphicsEffect(shadow)
 
-    def append_message(self, text, msg_type="chat", sender=None):
-        align = "left"
-        bubble_color = "orange"
-        text_color = "#333333"
-        
-
-        if msg_type == "info":
-            bubble_color = "#F5F5F5"
-            text_color = "#666666"
-        elif msg_type == "error":
-            bubble_color = "#FCE4EC"
-            text_color = "#C62828"
-        elif msg_type == "group":
-            bubble_color = "#E8F5E9"
-            text_color = "#2E7D32"
-
-        # If the message is from the local identity, align right
-        if sender and sender == self.identity:
-            align = "right"
-            bubble_color = "green"
-
-        bubble_html = textwrap.dedent(f"""
-        <div style="
-            background-color: {bubble_color};
-            color: {text_color};
-            border-radius: 10px;
-            margin: 4px;
-            padding: 6px 10px;
-            max-width: 60%;
-            text-align: left;
-            float: {align};
-            clear: both;
-        ">
-            {text}
-        </div>
-        <div style="clear: both;"></div>
-        """)
-        self.chat_display.insertHtml(bubble_html)
-        self.chat_display.moveCursor(QTextCursor.End)
-        self.chat_display.ensureCursorVisible()
+    def append_message(self, text, msg_type="chat", sender=None, history_id=None):
+        """
+        Queue a message for the list. Safe from any thread: messages are
+        gathered and added to the model once per frame. history_id is its
+        row in the history log, if it was logged.
+        """
+        with self.pending_lock:
+            self.pending.append((text, msg_type, bool(sender) and sender == self.identity, history_id))
+            first = len(self.pending) == 1
+        if first:
+            self.messages_pending.emit()
+
+    def schedule_flush(self):
+        if not self.flush_timer.isActive():
+            self.flush_timer.start()
+
+    def flush_pending(self):
+        with self.pending_lock:
+            rows, self.pending = self.pending, []
+        if not rows or self.history_after is not None:
+            # Scrolled back past evicted rows: live messages are in the
+            # log and show up when the newer pages load again.
+            return
+        at_bottom = self.at_bottom()
+        if self.chat_model.append_rows(rows):
+            self.trimmed_top()
+        if at_bottom:
+            self.chat_view.scrollToBottom()
+
+    def trimmed_top(self):
+        """Rows dropped off the top come back from the history log when scrolled up."""
+        if self.network is None or self.network.history is None:
+            return
+        self.history_before = self.chat_model.trim_to_logged_top()
+        self.history_done = False
+
+    def at_bottom(self):
+        scroll_bar = self.chat_view.verticalScrollBar()
+        return scroll_bar.value() >= scroll_bar.maximum() - 4
+
+    # ------------------- history -------------------
+    def load_history(self):
+        """Show the newest page of the network's history log, if it keeps one."""
+        if self.network is None or self.network.history is None:
+            self.history_done = True
+            return
+        self.load_older_history()
+        self.chat_view.scrollToBottom()
+
+    def on_scroll(self, value):
+        scroll_bar = self.chat_view.verticalScrollBar()
+        if value == scroll_bar.minimum() and not self.history_done:
+            self.load_older_history()
+        elif value == scroll_bar.maximum() and self.history_after is not None:
+            self.load_newer_history()
+
+    def load_older_history(self):
+        """Prepend the page before the top row, evicting from the bottom, keeping the view where it was."""
+        rows = self.network.history.page(self.history_before, DEFAULT_HISTORY_PAGE_SIZE)
+        if len(rows) < DEFAULT_HISTORY_PAGE_SIZE:
+            self.history_done = True
+        if not rows:
+            return
+        self.history_before = rows[-1]["id"]
+        top_row = self.chat_view.indexAt(QPoint(0, 0)).row()
+        self.chat_model.prepend_rows([history_row(row, self.identity) for row in reversed(rows)])
+        excess = self.chat_model.rowCount() - self.chat_model.max_rows
+        if excess > 0:
+            self.chat_model.remove_bottom(excess)
+            self.history_after = self.chat_model.trim_to_logged_bottom()
+        if top_row >= 0:
+            # Keep the row that was on top where it was.
+            self.chat_view.scrollTo(self.chat_model.index(top_row + len(rows)), QAbstractItemView.PositionAtTop)
+
+    def load_newer_history(self):
+        """Append the page after the bottom row, evicting from the top, until back at the live end."""
+        history = self.network.history
+        # Live messages that arrived meanwhile must be in the log first.
+        history.flush(1.0)
+        rows = history.page(after=self.history_after, limit=DEFAULT_HISTORY_PAGE_SIZE)
+        if len(rows) < DEFAULT_HISTORY_PAGE_SIZE:
+            self.history_after = None
+            if rows:
+                # Back at the live end: skip queued live rows this page has.
+                with self.pending_lock:
+                    self.pending = [row for row in self.pending if row[3] is None or row[3] > rows[0]["id"]]
+        elif rows:
+            self.history_after = rows[0]["id"]
+        if not rows:
+            return
+        top_row = self.chat_view.indexAt(QPoint(0, 0)).row()
+        before = self.chat_model.rowCount()
+        if self.chat_model.append_rows([history_row(row, self.identity) for row in reversed(rows)]):
+            self.trimmed_top()
+        removed = before + len(rows) - self.chat_model.rowCount()
+        if top_row - removed >= 0:
+            self.chat_view.scrollTo(self.chat_model.index(top_row - removed), QAbstractItemView.PositionAtTop)
+
+    def show_latest(self):
+        """Go back to the newest messages after scrolling past evicted ones."""
+        if self.history_after is None:
+            return
+        self.chat_model.clear()
+        self.history_before = None
+        self.history_after = None
+        self.history_done = False
+        self.load_older_history()
+        self.chat_view.scrollToBottom()
 
     def send_message(self):
         message = self.msg_entry.text().strip()
@@ -258,9 +541,25 @@ class ChatPanel(QWidget):
             QMessageBox.warning(self, "Error", "Network not initialized.")
             return
         all_peers = self.network.list_peers()
+        if self.network.outbox:
+            # Peers seen before can be written to while offline.
+            with self.network.lock:
+                known = set(self.network.known_peers)
+            all_peers = sorted(known.union(all_peers, self.network.outbox.pending()))
         if not all_peers:
             QMessageBox.warning(self, "Warning", "No connected peer available. Please connect first.")
             return
+        if message.startswith("/group "):
+            # "/group NAME TEXT" gossips the text to everyone in the overlay.
+            parts = message.split(None, 2)
+            if len(parts) < 3:
+                QMessageBox.information(self, "Info", "Usage: /group NAME TEXT")
+                return
+            self.show_latest()
+            self.network.send_group_message(parts[1], parts[2])
+            self.append_message(f"{self.identity} in [{parts[1]}]: {parts[2]}", msg_type="group", sender=self.identity)
+            self.msg_entry.clear()
+            return
         if len(all_peers) == 1:
             recipient = all_peers[0]
         else:
@@ -268,8 +567,13 @@ class ChatPanel(QWidget):
             if not ok or not recipient:
                 QMessageBox.information(self, "Info", "Recipient required.")
                 return
-        self.network.send_chat_message(recipient, message)
-        self.append_message(f"{self.identity}: {message}", msg_type="chat", sender=self.identity)
+        self.show_latest()
+        history_id = self.network.send_chat_message(recipient, message)
+        if history_id is False:
+            self.append_message(f"[ERROR] Message to {recipient} was not sent.", msg_type="error")
+            return
+        self.append_message(f"{self.identity}: {message}", msg_type="chat", sender=self.identity,
+                            history_id=history_id)
         self.msg_entry.clear()
 
     def send_file(self):
@@ -277,12 +581,9 @@ class ChatPanel(QWidget):
         if not file_path:
             return
         try:
-            with open(file_path, "rb") as f:
-                file_data = f.read()
-            encoded_data = base64.b64encode(file_data).decode("utf-8")
             filename = os.path.basename(file_path)
-            filesize = len(file_data)
-        except Exception as e:
+            filesize = os.path.getsize(file_path)
+        except OSError as e:
             QMessageBox.warning(self, "Error", f"Failed to read file: {e}")
             return
         all_peers = self.network.list_peers()
@@ -296,31 +597,38 @@ class ChatPanel(QWidget):
             if not ok or not recipient:
                 QMessageBox.information(self, "Info", "Recipient required.")
                 return
-        file_msg = {
-            "type": "file_transfer",
-            "sender": self.identity,
-            "recipient": recipient,
-            "filename": filename,
-            "filesize": filesize,
-            "content": encoded_data
-        }
         self.progress_bar.setVisible(True)
         self.progress_bar.setValue(0)
-        self.file_thread = FileTransferThread(filesize)
-        self.file_thread.progress.connect(self.progress_bar.setValue)
-        self.file_thread.finished.connect(lambda: self.on_file_transfer_complete(recipient, filename, filesize, file_msg))
-        self.file_thread.start()
+        self.network.send_file(
+            recipient, file_path,
+            progress_callback=lambda sent, total: self.file_progress.emit(recipient, filename, sent, total)
+        )
 
-    def on_file_transfer_complete(self, recipient, filename, filesize, file_msg):
-        self.network.send_chat_message(recipient, file_msg, is_dict=True)
+    def on_file_progress(self, recipient, filename, sent, total):
+        self.progress_bar.setValue(int(sent * 100 / total) if total else 100)
+        if sent >= total:
+            self.on_file_transfer_complete(recipient, filename, total)
+
+    def on_file_transfer_complete(self, recipient, filename, filesize):
         self.append_message(f"Sent '{filename}' ({filesize} bytes) to {recipient}.", msg_type="info")
         self.progress_bar.setVisible(False)
 
     def clear_chat(self):
-        self.chat_display.clear()
+        # Only the view is cleared; the history log keeps everything and
+        # shows it again on the next start.
+        with self.pending_lock:
+            self.pending = []
+        self.chat_model.clear()
+        self.history_done = True
+        self.history_after = None
 
 # ------------------- ChatWidget -------------------
 class ChatWidget(QWidget):
+    # (our username, event, peer, status) on the GUI thread: "joined",
+    # "left" and "presence" from the network, "found" and "lost" from
+    # LAN discovery.
+    peer_event = pyqtSignal(str, str, str, str)
+
     def __init__(self, send_user, send_port, listen_user, listen_port, parent=None):
         super().__init__(parent)
         self.send_user = send_user
@@ -352,62 +660,142 @@ class ChatWidget(QWidget):
         self.layout.addLayout(actions_layout)
 
     def initialize_networks(self):
-        self.network_sending = PeerNetwork(self.send_user, "0.0.0.0", self.send_port)
-        self.network_sending.message_callback = lambda msg: self.process_incoming_message(msg, "sender")
+        settings = QSettings("MyCompany", "P2PChatApp")
+        bootstrap = ()
+        host, _, port = settings.value("dhtBootstrap", "").rpartition(":")
+        if host and port.isdigit():
+            bootstrap = ((host, int(port)),)
+        config = NetworkConfig(
+            discovery=settings.value("lanDiscovery", False, type=bool),
+            discovery_auto_connect=settings.value("discoveryAutoConnect", False, type=bool),
+            dht=settings.value("dht", False, type=bool),
+            dht_bootstrap=bootstrap,
+        )
+        data_dir = QStandardPaths.writableLocation(QStandardPaths.AppDataLocation)
+        if settings.value("keepHistory", True, type=bool):
+            config.history_dir = os.path.join(data_dir, "history")
+        if settings.value("queueOffline", True, type=bool):
+            config.outbox_dir = os.path.join(data_dir, "outbox")
+        # Network threads never call into Qt: their messages are queued and
+        # handled on the GUI thread when dispatch_timer drains the queues.
+        # Each network resumes the partial downloads in its own directory only.
+        self.network_sending = PeerNetwork(self.send_user, "0.0.0.0", self.send_port, config=dataclasses.replace(
+            config, download_dir=os.path.join(data_dir, "downloads", self.send_user)))
+        self.sending_dispatcher = QueuedDispatcher(self.network_sending.metrics)
+        self.route_messages(self.network_sending, self.sending_dispatcher, self.sender_panel)
+
+        self.network_listening = PeerNetwork(self.listen_user, "0.0.0.0", self.listen_port, config=dataclasses.replace(
+            config, download_dir=os.path.join(data_dir, "downloads", self.listen_user)))
+        self.listening_dispatcher = QueuedDispatcher(self.network_listening.metrics)
+        self.route_messages(self.network_listening, self.listening_dispatcher, self.receiver_panel)
+
+        self.route_peer_events(self.network_sending, self.sending_dispatcher)
+        self.route_peer_events(self.network_listening, self.listening_dispatcher)
+
+        self.dispatch_timer = QTimer(self)
+        self.dispatch_timer.timeout.connect(self.drain_dispatchers)
+        self.dispatch_timer.start(DEFAULT_DISPATCH_INTERVAL_MS)
+
         self.network_sending.start_server()
         self.network_sending.broadcast_presence("online")
-
-        self.network_listening = PeerNetwork(self.listen_user, "0.0.0.0", self.listen_port)
-        self.network_listening.message_callback = lambda msg: self.process_incoming_message(msg, "receiver")
         self.network_listening.start_server()
         self.network_listening.broadcast_presence("online")
 
         self.sender_panel.network = self.network_sending
         self.receiver_panel.network = self.network_listening
+        self.sender_panel.load_history()
+        self.receiver_panel.load_history()
 
         self.sender_panel.append_message(f"[INFO] Chat panel for '{self.send_user}' on port {self.send_port} started.", msg_type="info")
         self.receiver_panel.append_message(f"[INFO] Chat panel for '{self.listen_user}' on port {self.listen_port} started.", msg_type="info")
 
-    def process_incoming_message(self, msg, panel_type):
-        panel = self.sender_panel if panel_type == "sender" else self.receiver_panel
+    def route_peer_events(self, network, dispatcher):
+        username = network.username
+        network.peer_callback = dispatcher.wrap(
+            lambda event, peer, status: self.peer_event.emit(username, event, peer, status))
+        if network.discovery:
+            network.discovery.peer_callback = dispatcher.wrap(
+                lambda event, peer: self.peer_event.emit(username, event, peer["username"], "discovered"))
+
+    def drain_dispatchers(self):
+        self.sending_dispatcher.drain()
+        self.listening_dispatcher.drain()
+
+    def route_messages(self, network, dispatcher, panel):
+        """Show each message type through its typed handler, on the GUI thread."""
+        for msg_type, handler in (
+            ("chat", self.show_chat),
+            ("presence", self.show_presence),
+            ("group_chat", self.show_group_chat),
+            ("file_received", self.show_file_received),
+        ):
+            network.add_handler(msg_type, dispatcher.wrap(functools.partial(handler, panel)))
+        network.message_callback = dispatcher.wrap(functools.partial(self.process_incoming_message, panel))
+
+    def show_chat(self, panel, msg, peer_username):
+        panel.append_message(f"{msg.sender}: {msg.content}", msg_type="chat", sender=msg.sender,
+                             history_id=msg.history_id)
+
+    def show_presence(self, panel, msg, peer_username):
+        panel.append_message(f"[PRESENCE] {msg.sender} is now {msg.status}.", msg_type="info")
+
+    def show_group_chat(self, panel, msg, peer_username):
+        panel.append_message(f"{msg.sender} in [{msg.group}]: {msg.content}", msg_type="group", sender=msg.sender,
+                             history_id=msg.history_id)
+
+    def show_file_received(self, panel, msg, peer_username):
+        panel.append_message(
+            f"[File Transfer] Received '{msg.filename}' ({msg.filesize} bytes) "
+            f"from {msg.sender}, saved to {msg.path}",
+            msg_type="info"
+        )
+
+    def process_incoming_message(self, panel, msg):
+        """Whatever no typed handler took: warnings and messages of other types."""
         if isinstance(msg, dict):
             msg_type = msg.get("type")
             if msg_type == "file_transfer":
-                panel.append_message(f"[File Transfer] Received: {msg}", msg_type="info")
-            elif msg_type == "group_chat":
-                sender = msg.get("sender")
-                group = msg.get("group")
-                content = msg.get("content")
-                bubble_text = f"{sender} in [{group}]: {content}"
-                panel.append_message(bubble_text, msg_type="group", sender=sender)
-            else:
-                panel.append_message(str(msg), msg_type="info")
-        else:
-            text = str(msg)
-            if "[ERROR]" in text:
-                panel.append_message(text, msg_type="error")
-            elif "[INFO]" in text or "[WARN]" in text or "[PRESENCE]" in text:
-                panel.append_message(text, msg_type="info")
-            elif "[CHAT]" in text:
-                try:
-                    _, rest = text.split("] ", 1)
-                    sender, content = rest.split(":", 1)
-                    sender = sender.strip()
-                    content = content.strip()
-                    bubble_text = f"{sender}: {content}"
-                    panel.append_message(bubble_text, msg_type="chat", sender=sender)
-                except:
-                    panel.append_message(text, msg_type="chat")
+                # Inline base64 transfers from older clients are not saved.
+                panel.append_message(
+                    f"[File Transfer] Unsupported legacy transfer of '{msg.get('filename')}' from {msg.get('sender')}",
+                    msg_type="info"
+                )
             else:
-                panel.append_message(text, msg_type="chat")
+                print(f"[WARN] Dropping message of unknown type {msg_type!r} from {msg.get('sender')}")
+            return
+        text = str(msg)
+        panel.append_message(text, msg_type="error" if "[ERROR]" in text else "info")
 
     def connect_to_peer(self):
         if not self.network_sending:
             QMessageBox.warning(self, "Error", "Sending network not initialized.")
             return
-        ip, ok = QInputDialog.getText(self, "Connect to Peer", "Enter peer IP address:")
+        discovered = [p for p in self.network_sending.discovered_peers()
+                      if p["username"] not in self.network_sending.list_peers()]
+        if discovered:
+            manual = "Enter an address..."
+            choices = [f"{p['username']} ({p['host']}:{p['port']})" for p in discovered] + [manual]
+            choice, ok = QInputDialog.getItem(self, "Connect to Peer", "Discovered peers:", choices, 0, False)
+            if not ok:
+                return
+            if choice != manual:
+                peer = discovered[choices.index(choice)]
+                self.network_sending.connect_to_peer(peer["host"], peer["port"])
+                self.sender_panel.append_message(
+                    f"[INFO] Attempting to connect to {peer['username']} at {peer['host']}:{peer['port']}...",
+                    msg_type="info"
+                )
+                return
+        ip, ok = QInputDialog.getText(self, "Connect to Peer", "Enter peer IP address or username:")
         if not ok or not ip:
             return
+        address = self.network_sending.resolve_username(ip) if self.network_sending.dht else None
+        if address:
+            self.network_sending.connect_to_peer(*address)
+            self.sender_panel.append_message(
+                f"[INFO] Attempting to connect to {ip} at {address[0]}:{address[1]}...", msg_type="info"
+            )
+            return
         port, ok = QInputDialog.getInt(self, "Connect to Peer", "Enter peer port:")
         if not ok or port <= 0:
             return
@@ -415,6 +803,7 @@ class ChatWidget(QWidget):
         self.sender_panel.append_message(f"[INFO] Attempting to connect to {ip}:{port}...", msg_type="info")
 
     def shutdown_networks(self):
+        self.dispatch_timer.stop()
         if self.network_sending:
             self.network_sending.broadcast_presence("offline")
             self.network_sending.shutdown()
@@ -445,10 +834,25 @@ class MainWindow(QMainWindow):
 
         self.peer_dock = QDockWidget("Connected Peers", self)
         self.peer_list_widget = QListWidget()
+        self.peer_list_widget.setSortingEnabled(True)
+        # Peer list state, updated from peer events rather than polled.
+        self.peer_items = {}  # mapping: peer -> QListWidgetItem
+        self.peer_links = {}  # mapping: connected peer -> our usernames connected to it
+        self.peer_states = {}  # mapping: connected peer -> presence status
+        self.peer_rtts = {}  # mapping: connected peer -> last RTT shown
+        self.discovered = {}  # mapping: discovered peer -> our usernames that heard it
         self.peer_dock.setWidget(self.peer_list_widget)
         self.peer_dock.setAllowedAreas(Qt.LeftDockWidgetArea | Qt.RightDockWidgetArea)
         self.addDockWidget(Qt.RightDockWidgetArea, self.peer_dock)
 
+        self.stats_dock = QDockWidget("Network Stats", self)
+        self.stats_tree = QTreeWidget()
+        self.stats_tree.setHeaderLabels(["Metric", "Value"])
+        self.stats_dock.setWidget(self.stats_tree)
+        self.stats_dock.setAllowedAreas(Qt.LeftDockWidgetArea | Qt.RightDockWidgetArea)
+        self.addDockWidget(Qt.RightDockWidgetArea, self.stats_dock)
+        self.splitDockWidget(self.peer_dock, self.stats_dock, Qt.Vertical)
+
         self.status_label = QLabel("No peers connected")
         self.status_indicator = QLabel("●")
         self.status_indicator.setStyleSheet("color: red; font-size: 14px;")
@@ -456,9 +860,9 @@ class MainWindow(QMainWindow):
         self.statusBar().addPermanentWidget(self.status_label)
         self.statusBar().showMessage("Enter two usernames and two ports to start.")
 
-        self.peer_timer = QTimer(self)
-        self.peer_timer.timeout.connect(self.update_peer_list)
-        self.peer_timer.start(3000)
+        self.stats_timer = QTimer(self)
+        self.stats_timer.timeout.connect(self.update_stats)
+        self.stats_timer.start(1000)
 
     def create_menu_bar(self):
         menubar = self.menuBar()
@@ -514,6 +918,8 @@ class MainWindow(QMainWindow):
         self.chat_widget = ChatWidget(send_user, send_port, listen_user, listen_port, self)
         self.stack.addWidget(self.chat_widget)
         self.stack.setCurrentWidget(self.chat_widget)
+        self.chat_widget.peer_event.connect(self.on_peer_event)
+        self.sync_peer_list()
         self.statusBar().showMessage(
             f"Chat started with sending user '{send_user}' on port {send_port}, "
             f"listening user '{listen_user}' on port {listen_port}."
@@ -523,21 +929,112 @@ class MainWindow(QMainWindow):
         if self.chat_widget:
             self.chat_widget.connect_to_peer()
 
-    def update_peer_list(self):
-        if self.chat_widget:
-            peers_sending = self.chat_widget.network_sending.list_peers() if self.chat_widget.network_sending else []
-            peers_listening = self.chat_widget.network_listening.list_peers() if self.chat_widget.network_listening else []
-            all_peers = sorted(set(peers_sending + peers_listening))
-            self.peer_list_widget.clear()
-            self.peer_list_widget.addItems(all_peers)
-
-            count = len(all_peers)
-            if count > 0:
-                self.status_indicator.setStyleSheet("color: green; font-size: 14px;")
-                self.status_label.setText(f"{count} peer(s) connected")
-            else:
-                self.status_indicator.setStyleSheet("color: red; font-size: 14px;")
-                self.status_label.setText("No peers connected")
+    # ------------------- peer list -------------------
+    def sync_peer_list(self):
+        """Replay the current peers as events, for those that joined before we listened."""
+        for network in (self.chat_widget.network_sending, self.chat_widget.network_listening):
+            for peer, status in network.peer_statuses().items():
+                self.on_peer_event(network.username, "joined", peer, status)
+            for peer in network.discovered_peers():
+                self.on_peer_event(network.username, "found", peer["username"], "discovered")
+
+    def on_peer_event(self, local_user, event, peer, status):
+        """Apply one peer event from local_user's network to the peer list, touching only that row."""
+        if event == "joined":
+            self.peer_links.setdefault(peer, set()).add(local_user)
+            self.peer_states[peer] = status
+        elif event == "left":
+            links = self.peer_links.get(peer, set())
+            links.discard(local_user)
+            if not links:
+                self.peer_links.pop(peer, None)
+                self.peer_states.pop(peer, None)
+                self.peer_rtts.pop(peer, None)
+        elif event == "presence":
+            if peer in self.peer_links:
+                self.peer_states[peer] = status
+        elif event == "found":
+            self.discovered.setdefault(peer, set()).add(local_user)
+        elif event == "lost":
+            found_by = self.discovered.get(peer, set())
+            found_by.discard(local_user)
+            if not found_by:
+                self.discovered.pop(peer, None)
+        self.refresh_peer_item(peer)
+        self.update_peer_count()
+
+    def peer_item_text(self, peer):
+        """The row text for peer, None if it should not be listed."""
+        if peer in self.peer_links:
+            details = []
+            if self.peer_rtts.get(peer) is not None:
+                details.append(f"{self.peer_rtts[peer] * 1000:.1f} ms")
+            if self.peer_states.get(peer, "online") != "online":
+                details.append(self.peer_states[peer])
+            return f"{peer} ({', '.join(details)})" if details else peer
+        own = {self.chat_widget.send_user, self.chat_widget.listen_user}
+        if peer in self.discovered and peer not in own:
+            return f"{peer} (discovered)"
+        return None
+
+    def refresh_peer_item(self, peer):
+        text = self.peer_item_text(peer)
+        item = self.peer_items.get(peer)
+        if text is None:
+            if item is not None:
+                self.peer_list_widget.takeItem(self.peer_list_widget.row(item))
+                del self.peer_items[peer]
+        elif item is None:
+            self.peer_items[peer] = QListWidgetItem(text, self.peer_list_widget)
+        elif item.text() != text:
+            item.setText(text)
+
+    def refresh_peer_rtts(self):
+        """Pick up new RTT samples; only rows whose text changes are touched."""
+        for network in (self.chat_widget.network_listening, self.chat_widget.network_sending):
+            for peer, rtt in network.peer_rtts().items():
+                if rtt is not None and self.peer_rtts.get(peer) != rtt:
+                    self.peer_rtts[peer] = rtt
+                    self.refresh_peer_item(peer)
+
+    def update_peer_count(self):
+        count = len(self.peer_links)
+        if count > 0:
+            self.status_indicator.setStyleSheet("color: green; font-size: 14px;")
+            self.status_label.setText(f"{count} peer(s) connected")
+        else:
+            self.status_indicator.setStyleSheet("color: red; font-size: 14px;")
+            self.status_label.setText("No peers connected")
+
+    def update_stats(self):
+        """Refresh the stats dock from each network's metrics registry."""
+        if not self.chat_widget:
+            return
+        self.refresh_peer_rtts()
+        expanded = {self.stats_tree.topLevelItem(i).text(0) for i in range(self.stats_tree.topLevelItemCount())
+                    if self.stats_tree.topLevelItem(i).isExpanded()}
+        self.stats_tree.clear()
+        for network in (self.chat_widget.network_sending, self.chat_widget.network_listening):
+            if not network:
+                continue
+            snapshot = network.metrics.snapshot()
+            prefix = network.metrics.prefix
+            node = QTreeWidgetItem([network.username, ""])
+            for name, entry in snapshot.items():
+                label = name[len(prefix):]
+                if entry["type"] == "histogram":
+                    value = f"p50 {entry['p50'] * 1000:g} ms, p99 {entry['p99'] * 1000:g} ms ({entry['count']})"
+                    node.addChild(QTreeWidgetItem([label, value]))
+                    continue
+                values = entry["values"]
+                item = QTreeWidgetItem([label, str(sum(values.values()))])
+                for peer, value in sorted(values.items()):
+                    if peer:
+                        item.addChild(QTreeWidgetItem([peer, str(value)]))
+                node.addChild(item)
+            self.stats_tree.addTopLevelItem(node)
+            node.setExpanded(not expanded or network.username in expanded)
+        self.stats_tree.resizeColumnToContents(0)
 
     def show_preferences(self):
         dialog = PreferencesDialog(self)
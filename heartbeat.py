@@ -0,0 +1,132 @@
+import threading
+import time
+
+from channels import CHANNEL_CONTROL, assign_channel
+
+# Seconds between pings on an idle connection; 0 disables heartbeats.
+DEFAULT_HEARTBEAT_INTERVAL = 5.0
+# Intervals without hearing anything from a peer before it is evicted.
+DEFAULT_HEARTBEAT_MISSES = 3
+# Weight of each new RTT sample in the moving average (as in TCP's SRTT).
+DEFAULT_RTT_ALPHA = 0.125
+
+HEARTBEAT_MESSAGE_TYPES = ("ping", "pong")
+for _msg_type in HEARTBEAT_MESSAGE_TYPES:
+    assign_channel(_msg_type, CHANNEL_CONTROL)
+
+# Liveness states reported to liveness_callback.
+ALIVE = "alive"
+SUSPECT = "suspect"
+DEAD = "dead"
+
+
+class HeartbeatMonitor:
+    """
+    Application-level ping/pong on every connection that negotiated it.
+
+    One thread pings each peer every interval. Any frame from a peer counts
+    as a sign of life, so busy connections are never evicted just because a
+    pong is stuck behind other traffic. A peer silent for one interval more
+    than expected becomes suspect; after `misses` intervals it is
+    disconnected, long before a half-open TCP connection would error.
+
+    The pong echoes our own send timestamp, giving an RTT sample that is
+    smoothed into conn.rtt.
+    """
+
+    def __init__(self, network, interval=DEFAULT_HEARTBEAT_INTERVAL, misses=DEFAULT_HEARTBEAT_MISSES,
+                 alpha=DEFAULT_RTT_ALPHA):
+        self.network = network
+        self.interval = interval
+        self.misses = misses
+        self.alpha = alpha
+        self.stopped = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.evictions = 0
+        # Optional callable(peer_username, state, rtt) called on every
+        # liveness change; state is ALIVE, SUSPECT or DEAD.
+        self.liveness_callback = None
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    def peer_connected(self, conn):
+        conn.last_seen = time.perf_counter()
+        conn.liveness = ALIVE
+        if conn.heartbeats:
+            self._ensure_running()
+
+    def _ensure_running(self):
+        with self.lock:
+            if self.thread is None and not self.stopped.is_set():
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.tick()
+            except Exception as e:
+                print(f"[ERROR] Heartbeat: {e}")
+
+    def tick(self):
+        """Check every connection once and ping the live ones."""
+        with self.network.lock:
+            conns = list(self.network.connections.items())
+        now = time.perf_counter()
+        for peer_username, conn in conns:
+            if not conn.heartbeats or conn.closed:
+                continue
+            silent = now - max(conn.received_at, conn.last_seen)
+            # A peer answering every ping is heard from about once per interval.
+            missed = max(0, round(silent / self.interval) - 1)
+            if missed >= self.misses:
+                self._evict(peer_username, conn, silent)
+                continue
+            if missed and conn.liveness == ALIVE:
+                self._set_liveness(peer_username, conn, SUSPECT)
+            elif not missed and conn.liveness == SUSPECT:
+                self._set_liveness(peer_username, conn, ALIVE)
+            conn.ping_seq += 1
+            try:
+                conn.send_message({"type": "ping", "seq": conn.ping_seq, "sent": now}, droppable=True)
+            except OSError as e:
+                print(f"[ERROR] Sending heartbeat to {peer_username}: {e}")
+
+    def _evict(self, peer_username, conn, silent):
+        print(f"[WARN] No heartbeat from {peer_username} for {silent:.1f}s, disconnecting")
+        with self.lock:
+            self.evictions += 1
+        conn.abort()
+        self.network._unregister_connection(conn)
+        self._set_liveness(peer_username, conn, DEAD)
+
+    def _set_liveness(self, peer_username, conn, state):
+        conn.liveness = state
+        if self.liveness_callback:
+            self.liveness_callback(peer_username, state, conn.rtt)
+
+    def handle_message(self, conn, message):
+        sent = message.get("sent")
+        if not isinstance(sent, (int, float)):
+            print(f"[WARN] Ignoring invalid {message.get('type')} from {conn.peer_username}")
+            return
+        if message.get("type") == "ping":
+            try:
+                conn.send_message({"type": "pong", "seq": message.get("seq"), "sent": sent})
+            except OSError as e:
+                print(f"[ERROR] Answering heartbeat from {conn.peer_username}: {e}")
+            return
+        now = time.perf_counter()
+        sample = now - sent
+        if sample < 0:
+            return
+        conn.rtt = sample if conn.rtt is None else (1 - self.alpha) * conn.rtt + self.alpha * sample
+        conn.last_seen = now
+        if conn.liveness == SUSPECT:
+            self._set_liveness(conn.peer_username, conn, ALIVE)
@@ -1,21 +1,379 @@
+"""
+Headless peer daemon: runs one or more PeerNetwork instances without Qt.
+
+Commands are read line by line from stdin and, with --control-port, from
+any client connected to the control socket (e.g. `nc 127.0.0.1 6000`).
+Every command gets exactly one reply line starting with OK or ERR, which
+makes the daemon easy to drive from scripts and load tests.
+
+    python main.py --username alice --port 5000
+    python main.py --username bob --port 5001 --connect 127.0.0.1:5000 --control-port 6001
+    python main.py --username load --count 50 --port 7000 --engine selector --no-stdin --control-port 6002
+"""
+import argparse
+import dataclasses
 import json
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+from admission import DEFAULT_MAX_CONNECTIONS
+from connection_manager import DEFAULT_RECONNECT_MAX_ATTEMPTS
+from config import NetworkConfig
+from metrics import MetricsServer
+from network import ENGINES, PeerNetwork
+
+# Usage of each command; any command may be prefixed with @username to
+# target one of several local peers.
+COMMANDS = (
+    "peers",
+    "discovered",
+    "connect HOST:PORT|USER",
+    "resolve USER",
+    "msg USER TEXT",
+    "group NAME TEXT",
+    "presence STATUS",
+    "send USER PATH",
+    "wait USER [SECONDS]",
+    "history [USER|#GROUP] [COUNT] [BEFORE_ID]",
+    "outbox",
+    "stats",
+    "whoami",
+    "quit",
+)
+
+
+def parse_address(text):
+    host, _, port = text.rpartition(":")
+    if not host or not port.isdigit():
+        raise ValueError(f"Expected HOST:PORT, got {text!r}")
+    return host, int(port)
+
+
+class PeerDaemon:
+    """Owns the networks and executes text commands against them."""
+
+    def __init__(self, networks):
+        self.networks = {network.username: network for network in networks}
+        self.default = networks[0]
+        self.stopped = threading.Event()
+        self.output_lock = threading.Lock()
+        self.control_socket = None
+        self.metrics_server = None
+        for network in networks:
+            network.message_callback = self._make_callback(network)
+            network.heartbeats.liveness_callback = self._make_liveness_callback(network)
+            network.peer_callback = self._make_peer_callback(network)
+
+    def _make_callback(self, network):
+        prefix = f"[{network.username}] " if len(self.networks) > 1 else ""
+
+        def on_message(output):
+            if isinstance(output, dict):
+                output = json.dumps(output)
+            self.emit(prefix + output)
+        return on_message
+
+    def _make_liveness_callback(self, network):
+        prefix = f"[{network.username}] " if len(self.networks) > 1 else ""
+
+        def on_liveness(peer_username, state, rtt):
+            rtt_text = f" (rtt {rtt * 1000:.1f} ms)" if rtt is not None else ""
+            self.emit(f"{prefix}[HEARTBEAT] {peer_username} is {state}{rtt_text}")
+        return on_liveness
+
+    def _make_peer_callback(self, network):
+        prefix = f"[{network.username}] " if len(self.networks) > 1 else ""
+
+        def on_peer(event, peer_username, status):
+            self.emit(f"{prefix}[PEER] {peer_username} {event} ({status})")
+        return on_peer
+
+    def emit(self, line):
+        with self.output_lock:
+            print(line, flush=True)
+
+    def start(self, connect_to=()):
+        for network in self.networks.values():
+            network.start_server()
+        for host, port in connect_to:
+            for network in self.networks.values():
+                network.connect_to_peer(host, port)
+
+    # ------------------- commands -------------------
+    def execute(self, line):
+        """Run one command line and return its reply line."""
+        words = line.split(None, 1)
+        if not words:
+            return "OK"
+        network = self.default
+        if words[0].startswith("@"):
+            network = self.networks.get(words[0][1:])
+            if network is None:
+                return f"ERR unknown username {words[0][1:]}"
+            words = words[1].split(None, 1) if len(words) > 1 else []
+            if not words:
+                return "ERR missing command"
+        handler = getattr(self, "cmd_" + words[0].lower(), None)
+        if handler is None:
+            return f"ERR unknown command {words[0]!r}, try help"
+        rest = words[1] if len(words) > 1 else ""
+        try:
+            return handler(network, rest.split(), rest)
+        except (ValueError, OSError) as e:
+            return f"ERR {e}"
+
+    # Handlers get the target network, the argument words and the raw
+    # argument text.
+    def cmd_help(self, network, args, text):
+        return "OK " + "; ".join(COMMANDS)
+
+    def cmd_peers(self, network, args, text):
+        return "OK " + " ".join(network.list_peers())
+
+    def cmd_discovered(self, network, args, text):
+        return "OK " + " ".join(f"{p['username']}@{p['host']}:{p['port']}" for p in network.discovered_peers())
+
+    def cmd_whoami(self, network, args, text):
+        return "OK " + " ".join(f"{n.username}@{n.host}:{n.port}" for n in self.networks.values())
+
+    def cmd_connect(self, network, args, text):
+        if len(args) != 1:
+            raise ValueError("usage: connect HOST:PORT|USER")
+        if ":" in args[0]:
+            network.connect_to_peer(*parse_address(args[0]))
+            return "OK"
+        address = network.resolve_username(args[0])
+        if address is None:
+            raise ValueError(f"cannot resolve {args[0]}")
+        network.connect_to_peer(*address)
+        return f"OK {address[0]}:{address[1]}"
+
+    def cmd_resolve(self, network, args, text):
+        if len(args) != 1:
+            raise ValueError("usage: resolve USER")
+        address = network.resolve_username(args[0])
+        if address is None:
+            raise ValueError(f"cannot resolve {args[0]}")
+        return f"OK {address[0]}:{address[1]}"
+
+    def cmd_msg(self, network, args, text):
+        if len(args) < 2:
+            raise ValueError("usage: msg USER TEXT")
+        # Keep the text as typed, inner spaces included.
+        text = text.split(None, 1)[1]
+        connected = args[0] in network.list_peers()
+        if not connected and network.outbox is None:
+            raise ValueError(f"not connected to {args[0]}")
+        if network.send_chat_message(args[0], text) is False:
+            raise ValueError(f"message to {args[0]} was not sent")
+        return "OK" if connected else "OK queued"
+
+    def cmd_group(self, network, args, text):
+        if len(args) < 2:
+            raise ValueError("usage: group NAME TEXT")
+        return "OK " + network.send_group_message(args[0], text.split(None, 1)[1])
+
+    def cmd_presence(self, network, args, text):
+        if len(args) != 1:
+            raise ValueError("usage: presence STATUS")
+        network.broadcast_presence(args[0])
+        return "OK"
+
+    def cmd_send(self, network, args, text):
+        if len(args) != 2:
+            raise ValueError("usage: send USER PATH")
+        transfer_id = network.send_file(args[0], args[1])
+        if transfer_id is None:
+            raise ValueError(f"not connected to {args[0]}")
+        return f"OK {transfer_id}"
+
+    def cmd_wait(self, network, args, text):
+        if len(args) not in (1, 2):
+            raise ValueError("usage: wait USER [SECONDS]")
+        deadline = time.monotonic() + (float(args[1]) if len(args) == 2 else 10.0)
+        while args[0] not in network.list_peers():
+            if time.monotonic() > deadline or self.stopped.is_set():
+                return f"ERR timed out waiting for {args[0]}"
+            time.sleep(0.01)
+        return "OK"
+
+    def cmd_history(self, network, args, text):
+        if network.history is None:
+            raise ValueError("history is off, start with --history-dir")
+        if len(args) > 3:
+            raise ValueError("usage: history [USER|#GROUP] [COUNT] [BEFORE_ID]")
+        peer = group = None
+        if args and not args[0].isdigit():
+            target = args.pop(0)
+            if target.startswith("#"):
+                group = target[1:]
+            else:
+                peer = target
+        limit = int(args[0]) if args else 20
+        before = int(args[1]) if len(args) > 1 else None
+        return "OK " + json.dumps(network.history.page(before, limit, peer=peer, group=group))
+
+    def cmd_outbox(self, network, args, text):
+        if network.outbox is None:
+            raise ValueError("outbox is off, start with --outbox-dir")
+        return "OK " + json.dumps(dict(network.outbox.stats(), peers=network.outbox.pending()))
+
+    def cmd_stats(self, network, args, text):
+        return "OK " + json.dumps({
+            "peers": network.list_peers(),
+            "rtt": network.peer_rtts(),
+            "queues": network.queue_stats(),
+            "compression": network.compression_stats(),
+            "gossip": network.gossip.stats(),
+            "metrics": network.metrics.snapshot(),
+        })
+
+    def cmd_quit(self, network, args, text):
+        self.stopped.set()
+        return "OK"
+
+    # ------------------- command sources -------------------
+    def serve_stdin(self, keep_running):
+        """Read commands from stdin; EOF stops the daemon unless keep_running."""
+        for line in sys.stdin:
+            self.emit(self.execute(line.strip()))
+            if self.stopped.is_set():
+                return
+        if not keep_running:
+            self.stopped.set()
+
+    def serve_control(self, host, port):
+        self.control_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.control_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.control_socket.bind((host, port))
+        self.control_socket.listen(5)
+        print(f"[INFO] Control socket listening on {host}:{port}")
+        threading.Thread(target=self._accept_control, daemon=True).start()
+
+    def _accept_control(self):
+        while not self.stopped.is_set():
+            try:
+                client, _ = self.control_socket.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._handle_control, args=(client,), daemon=True).start()
+
+    def _handle_control(self, client):
+        with client, client.makefile("r", encoding="utf-8") as lines:
+            for line in lines:
+                try:
+                    client.sendall((self.execute(line.strip()) + "\n").encode("utf-8"))
+                except OSError:
+                    return
+                if self.stopped.is_set():
+                    return
+
+    def serve_metrics(self, host, port):
+        """One HTTP endpoint for the metrics of every local peer, labelled by node."""
+        registries = [network.metrics for network in self.networks.values()]
+        self.metrics_server = MetricsServer(registries, host, port).start()
+
+    def shutdown(self):
+        self.stopped.set()
+        if self.control_socket:
+            self.control_socket.close()
+        if self.metrics_server:
+            self.metrics_server.stop()
+        for network in self.networks.values():
+            network.shutdown()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--username", required=True, help="peer username (suffixed 1..N with --count)")
+    parser.add_argument("--host", default="0.0.0.0", help="address to listen on")
+    parser.add_argument("--port", type=int, default=5000, help="listen port (consecutive ports with --count)")
+    parser.add_argument("--count", type=int, default=1, help="number of peers to run in this process")
+    parser.add_argument("--engine", choices=ENGINES, default="threaded")
+    parser.add_argument("--connect", action="append", default=[], metavar="HOST:PORT",
+                        help="peer to connect every local peer to; may be repeated")
+    parser.add_argument("--download-dir", default="downloads",
+                        help="where received files go (DIR/USERNAME with --count)")
+    parser.add_argument("--history-dir", default="", help="log chat history to DIR/USERNAME.sqlite3")
+    parser.add_argument("--outbox-dir", default="",
+                        help="queue messages for offline peers in DIR/USERNAME.outbox.sqlite3")
+    parser.add_argument("--control-host", default="127.0.0.1")
+    parser.add_argument("--control-port", type=int, help="also accept commands on this TCP port")
+    parser.add_argument("--discovery", action="store_true", help="announce and find peers by UDP multicast")
+    parser.add_argument("--discovery-interface", default="0.0.0.0",
+                        help="interface address for discovery; 127.0.0.1 keeps it on this host")
+    parser.add_argument("--auto-connect", action="store_true", help="connect to discovered peers")
+    parser.add_argument("--dht", action="store_true", help="join the username directory DHT (UDP, same port)")
+    parser.add_argument("--dht-bootstrap", action="append", default=[], metavar="HOST:PORT",
+                        help="DHT node to join through; may be repeated")
+    parser.add_argument("--reconnect-attempts", type=int, default=DEFAULT_RECONNECT_MAX_ATTEMPTS,
+                        help="redials of a dropped peer before giving up, 0 to keep trying")
+    parser.add_argument("--max-connections", type=int, default=DEFAULT_MAX_CONNECTIONS,
+                        help="most peer connections each local peer accepts or opens")
+    parser.add_argument("--peer-message-rate", type=float, default=0,
+                        help="messages per second read from each peer, 0 for no limit")
+    parser.add_argument("--peer-byte-rate", type=float, default=0,
+                        help="bytes per second read from each peer, 0 for no limit")
+    parser.add_argument("--metrics-host", default="127.0.0.1")
+    parser.add_argument("--metrics-port", type=int, help="serve /metrics and /metrics.json over HTTP on this port")
+    parser.add_argument("--no-stdin", action="store_true", help="do not read commands from stdin")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    connect_to = [parse_address(address) for address in args.connect]
+    config = NetworkConfig(
+        download_dir=args.download_dir,
+        history_dir=args.history_dir,
+        outbox_dir=args.outbox_dir,
+        reconnect_max_attempts=args.reconnect_attempts,
+        max_connections=args.max_connections,
+        peer_message_rate=args.peer_message_rate,
+        peer_byte_rate=args.peer_byte_rate,
+        discovery=args.discovery,
+        discovery_interface=args.discovery_interface,
+        discovery_auto_connect=args.auto_connect,
+        dht=args.dht,
+        dht_bootstrap=tuple(parse_address(address) for address in args.dht_bootstrap),
+    )
+    if args.count == 1:
+        names = [(args.username, args.port)]
+    else:
+        names = [(f"{args.username}{i + 1}", args.port + i) for i in range(args.count)]
+    networks = []
+    for name, port in names:
+        # Several local peers each get their own download directory, so none
+        # resumes another's partial downloads.
+        peer_config = config
+        if args.count > 1:
+            peer_config = dataclasses.replace(config, download_dir=os.path.join(args.download_dir, name))
+        networks.append(PeerNetwork(name, args.host, port, engine=args.engine, config=peer_config))
+    daemon = PeerDaemon(networks)
+
+    def stop(signum, frame):
+        daemon.stopped.set()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    daemon.start(connect_to)
+    if args.control_port is not None:
+        daemon.serve_control(args.control_host, args.control_port)
+    if args.metrics_port is not None:
+        daemon.serve_metrics(args.metrics_host, args.metrics_port)
+    if not args.no_stdin:
+        keep_running = args.control_port is not None
+        threading.Thread(target=daemon.serve_stdin, args=(keep_running,), daemon=True).start()
+    elif args.control_port is None:
+        print("[INFO] No command source; running until interrupted.")
+    while not daemon.stopped.wait(0.5):
+        pass
+    daemon.shutdown()
+
 
-def encode_message(message_dict):
-    """
-    Encode a dictionary into a JSON string and then to bytes.
-    """
-    try:
-        return json.dumps(message_dict).encode('utf-8')
-    except Exception as e:
-        print("Error encoding message:", e)
-        return None
-
-def decode_message(message_bytes):
-    """
-    Decode bytes into a JSON object (dictionary).
-    """
-    try:
-        return json.loads(message_bytes.decode('utf-8'))
-    except Exception as e:
-        print("Error decoding message:", e)
-        return None
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,138 @@
 import json
+import struct
 
-def encode_message(message_dict):
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JsonCodec:
+    """The original encoding: UTF-8 JSON text. Safe for newline framing."""
+    name = "json"
+    priority = 0
+    binary = False
+
+    def encode(self, message_dict):
+        return json.dumps(message_dict).encode('utf-8')
+
+    def decode(self, message_bytes):
+        return json.loads(str(message_bytes, 'utf-8'))
+
+
+class MsgpackCodec:
+    """MessagePack encoding, available when the msgpack package is installed."""
+    name = "msgpack"
+    priority = 10
+    binary = True
+
+    def encode(self, message_dict):
+        return msgpack.packb(message_dict, use_bin_type=True)
+
+    def decode(self, message_bytes):
+        return msgpack.unpackb(message_bytes, raw=False)
+
+
+class CompactCodec:
+    """
+    Hand-rolled struct layout for the high-rate chat and presence shapes.
+    Any other message is sent as a tag byte followed by JSON.
+    """
+    name = "compact"
+    priority = 20
+    binary = True
+
+    TAG_JSON = 0
+    TAG_CHAT = 1
+    TAG_PRESENCE = 2
+
+    CHAT_KEYS = frozenset(("type", "sender", "recipient", "content"))
+    PRESENCE_KEYS = frozenset(("type", "sender", "status"))
+
+    # tag, sender length, recipient length, content length
+    CHAT_HEADER = struct.Struct("!BHHI")
+    # tag, sender length, status length
+    PRESENCE_HEADER = struct.Struct("!BHH")
+
+    def encode(self, message_dict):
+        msg_type = message_dict.get("type")
+        # Only all-str fields fit the struct layouts; anything else goes as JSON.
+        if msg_type == "chat" and message_dict.keys() == self.CHAT_KEYS and self._all_str(message_dict):
+            sender = message_dict["sender"].encode('utf-8')
+            recipient = message_dict["recipient"].encode('utf-8')
+            content = message_dict["content"].encode('utf-8')
+            if len(sender) <= 0xFFFF and len(recipient) <= 0xFFFF:
+                return self.CHAT_HEADER.pack(self.TAG_CHAT, len(sender), len(recipient), len(content)) + sender + recipient + content
+        elif msg_type == "presence" and message_dict.keys() == self.PRESENCE_KEYS and self._all_str(message_dict):
+            sender = message_dict["sender"].encode('utf-8')
+            status = message_dict["status"].encode('utf-8')
+            if len(sender) <= 0xFFFF and len(status) <= 0xFFFF:
+                return self.PRESENCE_HEADER.pack(self.TAG_PRESENCE, len(sender), len(status)) + sender + status
+        return bytes((self.TAG_JSON,)) + json.dumps(message_dict).encode('utf-8')
+
+    @staticmethod
+    def _all_str(message_dict):
+        return all(type(value) is str for value in message_dict.values())
+
+    def decode(self, message_bytes):
+        view = memoryview(message_bytes)
+        tag = view[0]
+        if tag == self.TAG_CHAT:
+            _, sender_len, recipient_len, content_len = self.CHAT_HEADER.unpack_from(view)
+            pos = self.CHAT_HEADER.size
+            sender = str(view[pos:pos + sender_len], 'utf-8')
+            pos += sender_len
+            recipient = str(view[pos:pos + recipient_len], 'utf-8')
+            pos += recipient_len
+            content = str(view[pos:pos + content_len], 'utf-8')
+            return {"type": "chat", "sender": sender, "recipient": recipient, "content": content}
+        if tag == self.TAG_PRESENCE:
+            _, sender_len, status_len = self.PRESENCE_HEADER.unpack_from(view)
+            pos = self.PRESENCE_HEADER.size
+            sender = str(view[pos:pos + sender_len], 'utf-8')
+            pos += sender_len
+            status = str(view[pos:pos + status_len], 'utf-8')
+            return {"type": "presence", "sender": sender, "status": status}
+        if tag == self.TAG_JSON:
+            return json.loads(str(view[1:], 'utf-8'))
+        raise ValueError(f"Unknown compact message tag {tag}")
+
+
+CODECS = {}  # mapping: codec name -> codec instance
+
+
+def register_codec(codec):
+    """Make a codec available for negotiation under codec.name."""
+    CODECS[codec.name] = codec
+
+
+def available_codecs():
+    """Names of all registered codecs, most preferred first."""
+    return tuple(name for name, codec in sorted(CODECS.items(), key=lambda item: -item[1].priority))
+
+
+register_codec(JsonCodec())
+register_codec(CompactCodec())
+if msgpack is not None:
+    register_codec(MsgpackCodec())
+
+
+def encode_message(message_dict, codec="json"):
     """
-    Encode a dictionary into a JSON string and then to bytes.
+    Encode a dictionary into bytes using the named codec (JSON by default).
     """
     try:
-        return json.dumps(message_dict).encode('utf-8')
+        return CODECS[codec].encode(message_dict)
     except Exception as e:
         print("Error encoding message:", e)
         return None
 
-def decode_message(message_bytes):
+def decode_message(message_bytes, codec="json"):
     """
-    Decode bytes into a JSON object (dictionary).
+    Decode bytes (or a memoryview frame) into a dictionary using the named codec.
     """
     try:
-        return json.loads(message_bytes.decode('utf-8'))
+        return CODECS[codec].decode(message_bytes)
     except Exception as e:
         print("Error decoding message:", e)
         return None
@@ -0,0 +1,194 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+# Rows written per transaction at most, and the longest a message waits in
+# memory before its batch is committed.
+DEFAULT_HISTORY_BATCH_SIZE = 256
+DEFAULT_HISTORY_FLUSH_INTERVAL = 0.2
+# Rows returned by one history page.
+DEFAULT_HISTORY_PAGE_SIZE = 50
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    kind TEXT NOT NULL,
+    direction TEXT NOT NULL,
+    peer TEXT,
+    grp TEXT,
+    sender TEXT,
+    content TEXT,
+    msg_id TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_peer ON messages (peer, id);
+CREATE INDEX IF NOT EXISTS messages_grp ON messages (grp, id);
+CREATE INDEX IF NOT EXISTS messages_ts ON messages (ts);
+"""
+
+COLUMNS = ("id", "ts", "kind", "direction", "peer", "grp", "sender", "content", "msg_id")
+INSERT = ("INSERT INTO messages (id, ts, kind, direction, peer, grp, sender, content, msg_id) "
+          "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)")
+
+
+def history_path(directory, username):
+    return os.path.join(directory, f"{username}.sqlite3")
+
+
+class MessageStore:
+    """
+    Append-only chat history in an SQLite database in WAL mode.
+
+    append() only puts the row on a queue, so network threads never wait
+    on the disk; a single writer thread commits whatever has queued up in
+    one transaction, up to batch_size rows, at least every flush_interval
+    seconds. Reads open their own connection per thread and, thanks to
+    WAL, run alongside the writer.
+
+    Row ids are handed out by append() itself, so a caller knows where a
+    message sits in the log before it is written.
+
+    Pages are keyset queries on the row id (newest first, strictly older
+    than `before` or newer than `after`), so fetching page 1000 costs the
+    same as page 1 and only `limit` rows are ever in memory.
+    """
+
+    def __init__(self, path, batch_size=DEFAULT_HISTORY_BATCH_SIZE, flush_interval=DEFAULT_HISTORY_FLUSH_INTERVAL):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        db = self._connect()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(SCHEMA)
+        last_id = db.execute("SELECT MAX(id) FROM messages").fetchone()[0]
+        db.close()
+        self.next_id = (last_id or 0) + 1
+        self.id_lock = threading.Lock()
+        self.pending = queue.Queue()
+        self.readers = threading.local()
+        self.closed = False
+        self.written = 0
+        self.batches = 0
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        # WAL is durable against crashes at NORMAL; a power loss can only
+        # lose the last few batches.
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    # ------------------- writing -------------------
+    def append(self, kind, direction, peer=None, group=None, sender=None, content=None, msg_id=None, ts=None):
+        """Queue one message for the log. direction is "in" or "out". Returns the row id it will have."""
+        if self.closed:
+            return None
+        with self.id_lock:
+            row_id = self.next_id
+            self.next_id += 1
+            self.pending.put((row_id, ts or time.time(), kind, direction, peer, group, sender, content, msg_id))
+        return row_id
+
+    def backlog(self):
+        return self.pending.qsize()
+
+    def flush(self, timeout=None):
+        """Wait until everything appended so far is committed."""
+        done = threading.Event()
+        self.pending.put(done)
+        return done.wait(timeout)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.pending.put(None)
+        self.writer.join()
+
+    def _write_loop(self):
+        db = self._connect()
+        try:
+            stop = False
+            while not stop:
+                item = self.pending.get()
+                rows, waiters = [], []
+                deadline = time.monotonic() + self.flush_interval
+                while True:
+                    if item is None:
+                        stop = True
+                    elif isinstance(item, threading.Event):
+                        waiters.append(item)
+                    else:
+                        rows.append(item)
+                    if stop or waiters or len(rows) >= self.batch_size:
+                        break
+                    try:
+                        item = self.pending.get(timeout=max(0.0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        break
+                if rows:
+                    self._commit(db, rows)
+                for waiter in waiters:
+                    waiter.set()
+        finally:
+            db.close()
+
+    def _commit(self, db, rows):
+        try:
+            with db:
+                db.executemany(INSERT, rows)
+        except sqlite3.Error as e:
+            print(f"[ERROR] Writing {len(rows)} messages to history: {e}")
+            return
+        self.written += len(rows)
+        self.batches += 1
+
+    # ------------------- reading -------------------
+    def _reader(self):
+        db = getattr(self.readers, "db", None)
+        if db is None:
+            db = self.readers.db = self._connect()
+        return db
+
+    def page(self, before=None, limit=DEFAULT_HISTORY_PAGE_SIZE, peer=None, group=None, until=None, after=None):
+        """
+        Up to `limit` messages older than id `before` (None: the newest),
+        newest first, as dicts. Optionally only those with one peer, in one
+        group, or sent at or before timestamp `until`. Pass the last row's id
+        as `before` to get the next older page. With `after`, the page is
+        the oldest `limit` messages newer than that id instead, still
+        returned newest first; pass the first row's id to go on.
+        """
+        clauses, params = [], []
+        if before is not None:
+            clauses.append("id < ?")
+            params.append(before)
+        if after is not None:
+            clauses.append("id > ?")
+            params.append(after)
+        if peer is not None:
+            clauses.append("peer = ?")
+            params.append(peer)
+        if group is not None:
+            clauses.append("grp = ?")
+            params.append(group)
+        if until is not None:
+            clauses.append("ts <= ?")
+            params.append(until)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        order = "ASC" if after is not None else "DESC"
+        rows = self._reader().execute(
+            f"SELECT {', '.join(COLUMNS)} FROM messages {where} ORDER BY id {order} LIMIT ?", params + [limit]
+        ).fetchall()
+        if after is not None:
+            rows.reverse()
+        return [dict(zip(COLUMNS, row)) for row in rows]
+
+    def stats(self):
+        return {"written": self.written, "batches": self.batches, "backlog": self.backlog()}
@@ -0,0 +1,70 @@
+MESSAGE_TYPES = {}  # mapping: message type -> Message subclass
+
+
+def register_message_type(cls):
+    """Class decorator: build messages of type cls.type as cls instances."""
+    MESSAGE_TYPES[cls.type] = cls
+    return cls
+
+
+def typed_message(message):
+    """The typed object for a decoded message dict, or None if its type has no class."""
+    cls = MESSAGE_TYPES.get(message.get("type"))
+    return cls.from_dict(message) if cls else None
+
+
+class Message:
+    """
+    Base of the typed messages handed to registered handlers. Subclasses
+    list their fields in __slots__; keys a message carries beyond those
+    (e.g. extra_fields of a group message) are kept in `extra`. A received
+    message that was logged to the history has its row id in
+    `history_id`; it is local and never sent.
+    """
+    __slots__ = ("extra", "history_id")
+    type = None
+
+    @classmethod
+    def from_dict(cls, message):
+        obj = cls.__new__(cls)
+        fields = cls.__slots__
+        for name in fields:
+            setattr(obj, name, message.get(name))
+        obj.extra = {key: value for key, value in message.items() if key != "type" and key not in fields}
+        obj.history_id = None
+        return obj
+
+    def to_dict(self):
+        message = {"type": self.type}
+        message.update((name, getattr(self, name)) for name in self.__slots__)
+        message.update(self.extra)
+        return message
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+@register_message_type
+class ChatMessage(Message):
+    __slots__ = ("sender", "recipient", "content")
+    type = "chat"
+
+
+@register_message_type
+class PresenceMessage(Message):
+    __slots__ = ("sender", "status")
+    type = "presence"
+
+
+@register_message_type
+class GroupChatMessage(Message):
+    __slots__ = ("id", "ttl", "origin", "sender", "group", "content")
+    type = "group_chat"
+
+
+@register_message_type
+class FileReceivedMessage(Message):
+    """Raised locally when an incoming file transfer has been written to `path`."""
+    __slots__ = ("sender", "filename", "filesize", "path")
+    type = "file_received"
@@ -0,0 +1,232 @@
+import bisect
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds (seconds) of the latency histogram buckets.
+DEFAULT_LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+)
+
+
+class Counter:
+    """
+    Monotonic count, optionally split per peer. Either incremented
+    directly, or (for hot-path counts kept on the connections themselves)
+    filled in by a collect function returning {peer: total} at scrape time.
+    """
+    kind = "counter"
+
+    def __init__(self, name, help_text, collect=None):
+        self.name = name
+        self.help = help_text
+        self.collect = collect
+        self.lock = threading.Lock()
+        self.values = {}  # mapping: peer username (None for global) -> value
+
+    def inc(self, amount=1, peer=None):
+        with self.lock:
+            self.values[peer] = self.values.get(peer, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        if self.collect:
+            for peer, value in self.collect().items():
+                values[peer] = values.get(peer, 0) + value
+        return values
+
+
+class Gauge(Counter):
+    """Current value, set directly or read through collect at scrape time."""
+    kind = "gauge"
+
+    def set(self, value, peer=None):
+        with self.lock:
+            self.values[peer] = value
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        if self.collect:
+            collected = self.collect()
+            values.update(collected if isinstance(collected, dict) else {None: collected})
+        return values
+
+
+class Histogram:
+    """Fixed-bucket histogram of durations in seconds."""
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=DEFAULT_LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += seconds
+            self.count += 1
+
+    def quantile(self, fraction, counts=None, count=None):
+        """Upper bound of the bucket holding the given quantile."""
+        if counts is None:
+            with self.lock:
+                counts, count = list(self.counts), self.count
+        if not count:
+            return 0.0
+        rank = fraction * count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def snapshot(self):
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative = []
+        seen = 0
+        for bucket_count in counts:
+            seen += bucket_count
+            cumulative.append(seen)
+        return {
+            "count": count,
+            "sum": total,
+            "buckets": dict(zip([str(b) for b in self.buckets] + ["+Inf"], cumulative)),
+            "p50": self.quantile(0.5, counts, count),
+            "p99": self.quantile(0.99, counts, count),
+        }
+
+
+class MetricsRegistry:
+    """The metrics of one node (PeerNetwork), looked up by name."""
+
+    def __init__(self, node, prefix="p2p_"):
+        self.node = node
+        self.prefix = prefix
+        self.metrics = {}  # mapping: full metric name -> metric, in registration order
+
+    def _register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, collect=None):
+        return self._register(Counter(self.prefix + name, help_text, collect))
+
+    def gauge(self, name, help_text, collect=None):
+        return self._register(Gauge(self.prefix + name, help_text, collect))
+
+    def histogram(self, name, help_text, buckets=DEFAULT_LATENCY_BUCKETS):
+        return self._register(Histogram(self.prefix + name, help_text, buckets))
+
+    def snapshot(self):
+        """JSON-friendly view: {name: {"type", "help", "values" or histogram fields}}."""
+        result = {}
+        for name, metric in self.metrics.items():
+            entry = {"type": metric.kind, "help": metric.help}
+            if metric.kind == "histogram":
+                entry.update(metric.snapshot())
+            else:
+                entry["values"] = {peer or "": value for peer, value in metric.samples().items()}
+            result[name] = entry
+        return result
+
+
+def _escape_label(value):
+    """Escape backslashes, double quotes and newlines, as the text exposition format requires."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(node, peer=None, extra=None):
+    labels = [f'node="{_escape_label(node)}"']
+    if peer:
+        labels.append(f'peer="{_escape_label(peer)}"')
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}"
+
+
+def render_prometheus(registries):
+    """Prometheus text exposition of several registries, one node label each."""
+    lines = []
+    names = []
+    for registry in registries:
+        for name in registry.metrics:
+            if name not in names:
+                names.append(name)
+    for name in names:
+        owners = [registry for registry in registries if name in registry.metrics]
+        metric = owners[0].metrics[name]
+        lines.append(f"# HELP {name} {metric.help}")
+        lines.append(f"# TYPE {name} {metric.kind}")
+        for registry in owners:
+            metric = registry.metrics[name]
+            if metric.kind == "histogram":
+                snapshot = metric.snapshot()
+                for bound, count in snapshot["buckets"].items():
+                    labels = _labels(registry.node, extra=f'le="{bound}"')
+                    lines.append(f"{name}_bucket{labels} {count}")
+                lines.append(f"{name}_sum{_labels(registry.node)} {snapshot['sum']}")
+                lines.append(f"{name}_count{_labels(registry.node)} {snapshot['count']}")
+            else:
+                for peer, value in metric.samples().items():
+                    lines.append(f"{name}{_labels(registry.node, peer)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """
+    Local HTTP endpoint for one or more registries:
+    /metrics in Prometheus text format, /metrics.json as JSON.
+    """
+
+    def __init__(self, registries, host="127.0.0.1", port=9100):
+        self.registries = list(registries)
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body = render_prometheus(server.registries).encode("utf-8")
+                    content_type = "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    snapshot = {registry.node: registry.snapshot() for registry in server.registries}
+                    body = json.dumps(snapshot).encode("utf-8")
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def address(self):
+        return self.httpd.server_address
+
+    def start(self):
+        self.thread.start()
+        host, port = self.address[:2]
+        print(f"[INFO] Metrics available at http://{host}:{port}/metrics")
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
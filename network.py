@@ -1,51 +1,251 @@
 import socket
 import threading
-from message import encode_message, decode_message
+import time
+import uuid
+from message import CODECS, decode_message
+from message_types import typed_message
+from config import NetworkConfig
+from connection import ThreadedConnection, tune_socket
+from outbound import OutboundQueue
+from compression import COMPRESSORS
+from channels import CHANNELS, CHANNEL_CHAT, CHANNEL_BULK
+from framing import (
+    FRAMINGS, FRAME_HEADER, FLAG_COMPRESSED, FLAG_FILE_CHUNK, CHANNEL_MASK, CHANNEL_SHIFT,
+    FrameDecoder, FrameError,
+)
+from file_transfer import FILE_MESSAGE_TYPES, FileTransferManager
+from heartbeat import HEARTBEAT_MESSAGE_TYPES, HeartbeatMonitor
+from connection_manager import ConnectionManager
+from admission import AdmissionControl, ReceiveLimiter
+from gossip import GOSSIP_MESSAGE_TYPES, GossipRelay
+from discovery import DiscoveryService
+from dht import DHTNode
+from message_store import MessageStore, history_path
+from outbox import Outbox, outbox_path
+from selector_engine import SelectorEngine
+from metrics import MetricsRegistry, MetricsServer
+
+# "threaded" runs one thread per socket; "selector" multiplexes every socket
+# on a single event loop thread and scales to thousands of peers.
+ENGINES = ("threaded", "selector")
 
 class PeerNetwork:
-    def __init__(self, username, host, port):
+    def __init__(self, username, host, port, engine="threaded", config=None):
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine!r}, expected one of {ENGINES}")
         self.username = username
+        # Tells the peers apart a restart of this process and a second
+        # socket from the same one.
+        self.instance_id = uuid.uuid4().hex
         self.host = host
         self.port = port
         self.server_socket = None
-        self.connections = {}  # mapping: username -> socket
+        self.connections = {}  # mapping: username -> PeerConnection
         self.lock = threading.Lock()
         self.running = True
+        # Chat output of messages no handler takes: text lines for chat and
+        # presence, the decoded dict otherwise.
         self.message_callback = None
+        self.handlers = {}  # mapping: message type -> tuple of handlers, see add_handler
+        # Optional callable(event, peer_username, status) with event
+        # "joined", "left" or "presence", called from network threads.
+        self.peer_callback = None
+        self.peer_status = {}  # mapping: username -> last presence status
+        self.engine = engine
+        self.config = config or NetworkConfig()
+        self.selector_engine = SelectorEngine(self) if engine == "selector" else None
+        self.file_transfers = FileTransferManager(
+            self, self.config.download_dir, self.config.file_chunk_size, self.config.file_send_mode
+        )
+        self.heartbeats = HeartbeatMonitor(
+            self, self.config.heartbeat_interval, self.config.heartbeat_misses, self.config.rtt_alpha
+        )
+        self.gossip = GossipRelay(
+            self, self.config.gossip_ttl, self.config.gossip_fanout,
+            self.config.seen_cache_size, self.config.seen_cache_seconds,
+        )
+        self.discovery = None
+        if self.config.discovery:
+            self.discovery = DiscoveryService(
+                self, self.config.discovery_group, self.config.discovery_port, self.config.discovery_interface,
+                self.config.discovery_interval, self.config.discovery_max_rate, self.config.discovery_auto_connect,
+            )
+        self.dht = None
+        if self.config.dht:
+            self.dht = DHTNode(
+                self, self.config.dht_port or port, self.config.dht_k, self.config.dht_alpha,
+                self.config.dht_refresh_interval, self.config.dht_record_ttl, self.config.dht_rpc_timeout,
+            )
+        self.admission = AdmissionControl(self, self.config.max_connections, self.config.max_pending_connections)
+        self.connection_manager = ConnectionManager(
+            self, self.config.reconnect_initial_delay, self.config.reconnect_max_delay,
+            self.config.reconnect_max_attempts,
+        )
+        self.history = None
+        if self.config.history_dir:
+            self.history = MessageStore(
+                history_path(self.config.history_dir, username),
+                self.config.history_batch_size, self.config.history_flush_interval,
+            )
+        self.outbox = None
+        if self.config.outbox_dir:
+            self.outbox = Outbox(
+                self, outbox_path(self.config.outbox_dir, username),
+                self.config.outbox_max_messages, self.config.outbox_max_age, self.config.outbox_batch_size,
+            )
+        self.metrics_server = None
+        self._setup_metrics()
+
+    def _setup_metrics(self):
+        """
+        Register this peer's metrics. Hot-path counts live as plain ints on
+        each connection and queue and are only summed up when scraped; the
+        totals of closed connections are kept so counters never go back.
+        """
+        self.metrics = MetricsRegistry(self.username)
+        self.known_peers = set()
+        self.retired_counts = {}  # mapping: username -> {count name: total of closed connections}
+        counted = (
+            ("frames_in_total", "Frames received.", lambda conn: conn.frames_in),
+            ("bytes_in_total", "Bytes received.", lambda conn: conn.bytes_in),
+            ("frames_out_total", "Frames written to the socket.", lambda conn: conn.queue.frames_sent),
+            ("bytes_out_total", "Bytes written to the socket.", lambda conn: conn.queue.bytes_sent),
+            ("dropped_messages_total", "Frames dropped by the send queue.", lambda conn: conn.queue.dropped_frames),
+            ("throttled_reads_total", "Pauses in reading from a peer over its rate limit.",
+             lambda conn: conn.limiter.throttled if conn.limiter else 0),
+            ("throttled_seconds_total", "Seconds spent not reading from a peer over its rate limit.",
+             lambda conn: conn.limiter.throttled_seconds if conn.limiter else 0.0),
+        )
+        self.connection_counts = {name: read for name, _, read in counted}
+        for name, help_text, read in counted:
+            self.metrics.counter(name, help_text, self._collect_counts(name, read))
+        self.decode_errors = self.metrics.counter("decode_errors_total", "Frames that did not decode to a message.")
+        self.reconnects = self.metrics.counter("reconnects_total", "Connections from an already known username.")
+        self.metrics.counter("connections_rejected_total", "Sockets closed because a connection limit was reached.",
+                             lambda: {None: self.admission.rejected})
+        self.metrics.counter("handshake_timeouts_total", "Sockets closed for not introducing themselves in time.",
+                             lambda: {None: self.admission.handshake_timeouts})
+        self.metrics.gauge("pending_handshakes", "Sockets admitted and still in the introduce handshake.",
+                           lambda: self.admission.pending)
+        self.metrics.counter("heartbeat_evictions_total", "Peers disconnected for missing heartbeats.",
+                             lambda: {None: self.heartbeats.evictions})
+        self.metrics.counter("reconnect_attempts_total", "Redials of peers whose connection dropped.",
+                             lambda: {None: self.connection_manager.attempts})
+        for name in ("published", "delivered", "relayed", "duplicates"):
+            self.metrics.counter(f"gossip_{name}_total", f"Group messages {name} by the gossip relay.",
+                                 lambda name=name: {None: self.gossip.stats()[name]})
+        self.metrics.gauge("discovered_peers", "Peers in the LAN discovery table.",
+                           lambda: len(self.discovery.table) if self.discovery else 0)
+        self.metrics.gauge("dht_contacts", "Contacts in the DHT routing table.",
+                           lambda: len(self.dht.table) if self.dht else 0)
+        self.metrics.gauge("dht_records", "DHT records stored on this node.",
+                           lambda: len(self.dht.records) if self.dht else 0)
+        self.metrics.counter("dht_rpcs_total", "DHT requests sent.",
+                             lambda: {None: self.dht.rpcs_sent if self.dht else 0})
+        self.metrics.counter("dht_lookups_total", "Iterative DHT lookups.",
+                             lambda: {None: self.dht.lookups if self.dht else 0})
+        self.metrics.counter("history_written_total", "Messages committed to the history log.",
+                             lambda: {None: self.history.written if self.history else 0})
+        self.metrics.gauge("history_backlog", "Messages waiting to be written to the history log.",
+                           lambda: self.history.backlog() if self.history else 0)
+        self.metrics.gauge("outbox_messages", "Messages queued for a peer that is not connected.",
+                           lambda: self.outbox.pending() if self.outbox else {})
+        for name in ("delivered", "dropped", "expired"):
+            self.metrics.counter(f"outbox_{name}_total", f"Queued messages {name} by the outbox.",
+                                 lambda name=name: {None: self.outbox.stats()[name] if self.outbox else 0})
+        self.duplicates = self.metrics.counter("duplicate_connections_total",
+                                               "Second connections to an already connected peer that were closed.")
+        self.metrics.gauge("connections", "Connected peers.", lambda: len(self.connections))
+        self.metrics.gauge("threads", "Live threads in this process.", threading.active_count)
+        self.metrics.gauge("send_queue_bytes", "Bytes queued or in flight per peer.",
+                           self._collect_connections(lambda conn: conn.queue.depth_bytes))
+        self.metrics.gauge("send_queue_frames", "Frames queued or in flight per peer.",
+                           self._collect_connections(lambda conn: len(conn.queue)))
+        self.metrics.gauge("rtt_seconds", "Smoothed heartbeat round-trip time per peer.",
+                           lambda: {peer: rtt for peer, rtt in self.peer_rtts().items() if rtt is not None})
+        self.receive_latency = self.metrics.histogram(
+            "receive_to_callback_seconds", "Time from recv() to delivery of the message.")
+        self.send_latency = self.metrics.histogram(
+            "enqueue_to_wire_seconds", "Time from queueing a frame to its last byte written.")
+
+    def _collect_connections(self, read):
+        def collect():
+            with self.lock:
+                conns = list(self.connections.items())
+            return {peer_username: read(conn) for peer_username, conn in conns}
+        return collect
+
+    def _collect_counts(self, name, read):
+        live = self._collect_connections(read)
+
+        def collect():
+            totals = live()
+            with self.lock:
+                for peer_username, counts in self.retired_counts.items():
+                    totals[peer_username] = totals.get(peer_username, 0) + counts[name]
+            return totals
+        return collect
+
+    def _retire_counts(self, peer_username, conn):
+        """Fold the counters of a connection that is going away into the per-peer totals."""
+        with self.lock:
+            counts = self.retired_counts.setdefault(peer_username, dict.fromkeys(self.connection_counts, 0))
+            for name, read in self.connection_counts.items():
+                counts[name] += read(conn)
+
+    def start_metrics_server(self, port, host="127.0.0.1"):
+        """Serve this peer's metrics over HTTP: /metrics (Prometheus) and /metrics.json."""
+        self.metrics_server = MetricsServer([self.metrics], host, port).start()
+        return self.metrics_server
 
     def start_server(self):
         """Start the server socket to listen for incoming connections."""
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
-        print(f"[INFO] Server listening on {self.host}:{self.port}")
+        if self.selector_engine:
+            self.selector_engine.start_server(self.host, self.port, self.config.listen_backlog)
+            print(f"[INFO] Server listening on {self.host}:{self.port}")
+        else:
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            # Accepted sockets inherit buffer sizes set before listen().
+            self._tune_socket(self.server_socket)
+            self.server_socket.bind((self.host, self.port))
+            self.server_socket.listen(self.config.listen_backlog)
+            print(f"[INFO] Server listening on {self.host}:{self.port}")
 
-        # Start a thread to accept incoming connections
-        threading.Thread(target=self.accept_connections, daemon=True).start()
+            # Start a thread to accept incoming connections
+            threading.Thread(target=self.accept_connections, daemon=True).start()
+        if self.discovery:
+            self.discovery.start()
+        if self.dht:
+            self.dht.start(self.config.dht_bootstrap)
 
     def accept_connections(self):
         while self.running:
+            # At the handshake limit, leave new connections in the listen backlog.
+            if not self.admission.wait_accepting(1.0):
+                continue
             try:
                 conn, addr = self.server_socket.accept()
+                if not self.admission.admit(addr):
+                    conn.close()
+                    continue
                 print(f"[INFO] Accepted connection from {addr}")
                 threading.Thread(target=self.handle_connection, args=(conn, addr), daemon=True).start()
             except Exception as e:
                 print(f"[ERROR] Accepting connection: {e}")
 
-    def handle_connection(self, conn, addr):
-        buffer = b""
+    def handle_connection(self, sock, addr):
+        self._tune_socket(sock)
+        conn = ThreadedConnection(sock, addr, self._new_decoder(), self._new_queue())
         try:
             # Wait for introduction message.
-            while b'\n' not in buffer:
-                data = conn.recv(4096)
-                if not data:
-                    conn.close()
-                    return
-                buffer += data
-
-            line, buffer = buffer.split(b'\n', 1)
-            message = decode_message(line)
+            try:
+                message = self._read_introduce(conn)
+            finally:
+                self.admission.release()
+            if message is None:
+                conn.close()
+                return
             if message and message.get("type") == "introduce":
                 peer_username = message.get("username")
                 print(f"[INFO] Connection request from {peer_username} at {addr}")
@@ -54,19 +254,12 @@ class PeerNetwork:
                     accepted = self.connection_request_callback(peer_username, addr)
                 if accepted:
                     print(f"[INFO] Connection accepted from {peer_username} at {addr}")
-                    introduce_msg = {"type": "introduce", "username": self.username}
-                    conn.sendall(encode_message(introduce_msg) + b'\n')
-                    with self.lock:
-                        self.connections[peer_username] = conn
-                    while self.running:
-                        data = conn.recv(4096)
-                        if not data:
-                            print(f"[INFO] Connection closed by {peer_username}")
-                            break
-                        buffer += data
-                        while b'\n' in buffer:
-                            line, buffer = buffer.split(b'\n', 1)
-                            self.process_message(line, peer_username)
+                    options = self._negotiate(message)
+                    conn.send_message(self._introduce_message(options))
+                    self._apply_options(conn, options, message)
+                    conn.peer_username = peer_username
+                    if self._register_connection(peer_username, conn):
+                        self._read_loop(conn)
                 else:
                     print(f"[INFO] Connection rejected from {peer_username} at {addr}")
                     conn.close()
@@ -74,41 +267,58 @@ class PeerNetwork:
             else:
                 print(f"[WARN] Did not receive valid introduction from {addr}. Closing connection.")
         except Exception as e:
-            print(f"[ERROR] Handling connection from {addr}: {e}")
+            # A socket we closed on purpose, e.g. a losing duplicate, is no error.
+            if not conn.closed:
+                print(f"[ERROR] Handling connection from {addr}: {e}")
         finally:
             conn.close()
-            with self.lock:
-                to_remove = None
-                for user, sock in self.connections.items():
-                    if sock == conn:
-                        to_remove = user
-                        break
-                if to_remove:
-                    del self.connections[to_remove]
-
-    def connect_to_peer(self, peer_host, peer_port):
-        """Initiate connection to a peer given host and port."""
+            self._unregister_connection(conn)
+
+    def connect_to_peer(self, peer_host, peer_port=None):
+        """
+        Initiate connection to a peer given host and port. Given only a
+        username instead, its address is looked up in the DHT first.
+        """
+        if peer_port is None:
+            try:
+                address = self.resolve_username(peer_host)
+            except Exception as e:
+                print(f"[ERROR] Resolving {peer_host}: {e}")
+                return False
+            if address is None:
+                print(f"[ERROR] Could not resolve {peer_host} to an address")
+                return False
+            peer_host, peer_port = address
+        if self.selector_engine:
+            # The handshake completes asynchronously on the event loop.
+            self.selector_engine.connect(peer_host, peer_port)
+            return
+        if not self.admission.admit((peer_host, peer_port), inbound=False):
+            return
+        admitted = True
         try:
-            conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            conn.connect((peer_host, peer_port))
-            introduce_msg = {"type": "introduce", "username": self.username}
-            conn.sendall(encode_message(introduce_msg) + b'\n')
-
-            data = b""
-            while b'\n' not in data:
-                part = conn.recv(4096)
-                if not part:
-                    break
-                data += part
-            if data:
-                line, _ = data.split(b'\n', 1)
-                message = decode_message(line)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._tune_socket(sock)
+            sock.settimeout(self.config.handshake_timeout or None)
+            sock.connect((peer_host, peer_port))
+            sock.settimeout(None)
+            conn = ThreadedConnection(sock, (peer_host, peer_port), self._new_decoder(), self._new_queue())
+            conn.initiator = True
+            conn.send_message(self._introduce_message())
+
+            message = self._read_introduce(conn)
+            self.admission.release()
+            admitted = False
+            if message is not None:
                 if message and message.get("type") == "introduce":
                     peer_username = message.get("username")
                     print(f"[INFO] Connected to peer: {peer_username} at {peer_host}:{peer_port}")
-                    with self.lock:
-                        self.connections[peer_username] = conn
-                    threading.Thread(target=self.listen_to_peer, args=(conn, peer_username), daemon=True).start()
+                    self._apply_options(conn, self._accepted_options(message), message)
+                    conn.peer_username = peer_username
+                    if self._register_connection(peer_username, conn):
+                        threading.Thread(target=self.listen_to_peer, args=(conn, peer_username), daemon=True).start()
+                    else:
+                        conn.close()
                 else:
                     print("[ERROR] Did not receive valid introduction from peer.")
                     conn.close()
@@ -119,55 +329,402 @@ class PeerNetwork:
             print(f"[ERROR] Connecting to peer {peer_host}:{peer_port} - Connection refused.")
         except Exception as e:
             print(f"[ERROR] Connecting to peer {peer_host}:{peer_port} - {e}")
+        finally:
+            if admitted:
+                self.admission.release()
 
     def listen_to_peer(self, conn, peer_username):
-        buffer = b""
         try:
-            while self.running:
-                data = conn.recv(4096)
-                if not data:
-                    print(f"[INFO] Connection closed by {peer_username}")
-                    break
-                buffer += data
-                while b'\n' in buffer:
-                    line, buffer = buffer.split(b'\n', 1)
-                    self.process_message(line, peer_username)
+            self._read_loop(conn)
         except Exception as e:
-            print(f"[ERROR] Listening to peer {peer_username}: {e}")
+            if not conn.closed:
+                print(f"[ERROR] Listening to peer {peer_username}: {e}")
         finally:
             conn.close()
-            with self.lock:
-                if peer_username in self.connections:
-                    del self.connections[peer_username]
+            self._unregister_connection(conn)
 
-    def process_message(self, data, peer_username):
-        message = decode_message(data)
-        if not message:
-            output = "[WARN] Received invalid message."
+    def _read_introduce(self, conn):
+        """
+        Block until the first frame arrives. Returns its decoded dict, or
+        None on EOF or when it takes longer than the handshake timeout.
+        """
+        timeout = self.config.handshake_timeout
+        # One deadline for the whole handshake, so a peer trickling in a
+        # byte at a time cannot hold its pending slot for ever.
+        deadline = time.monotonic() + timeout if timeout else None
+        try:
+            while True:
+                frame = conn.decoder.next_frame()
+                if frame is not None:
+                    return decode_message(frame[1]) or {}
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise socket.timeout()
+                    conn.sock.settimeout(remaining)
+                if not conn.decoder.recv_into(conn.sock):
+                    return None
+        except socket.timeout:
+            self.admission.handshake_timed_out(conn.addr, timeout)
+            return None
+        finally:
+            conn.sock.settimeout(None)
+
+    def _read_loop(self, conn):
+        decoder = conn.decoder
+        # Frames that arrived together with the introduction.
+        self._handle_buffered(conn)
+        while self.running:
+            if not decoder.recv_into(conn.sock):
+                print(f"[INFO] Connection closed by {conn.peer_username}")
+                break
+            conn.received_at = time.perf_counter()
+            self._handle_buffered(conn)
+
+    def _handle_buffered(self, conn):
+        """Handle every complete frame buffered on conn, pausing whenever it is over its rate limit."""
+        limiter = conn.limiter
+        for flags, frame in conn.decoder.frames():
+            self._handle_frame(conn, flags, frame)
+            if limiter:
+                delay = limiter.charge(1, FRAME_HEADER.size + len(frame))
+                if delay:
+                    # Only this peer's reader waits; TCP pushes back on the sender.
+                    time.sleep(delay)
+
+    def _handle_frame(self, conn, flags, frame):
+        """Dispatch one received frame. The frame view is only valid during this call."""
+        conn.frames_in += 1
+        conn.bytes_in += len(frame)
+        if conn.channels:
+            channel = (flags & CHANNEL_MASK) >> CHANNEL_SHIFT
+            increment = conn.consume_window(channel, FRAME_HEADER.size + len(frame))
+            if increment:
+                self._send_window_update(conn, channel, increment)
+            frame = conn.reassemble(channel, flags, frame)
+            if frame is None:
+                return
+        if flags & FLAG_COMPRESSED:
+            frame = conn.decompress(frame)
+        if flags & FLAG_FILE_CHUNK:
+            self.file_transfers.handle_chunk(frame, conn.peer_username)
+            return
+        message = decode_message(frame, conn.codec)
+        msg_type = message.get("type") if message else None
+        if msg_type == "window_update":
+            self._on_window_update(conn, message)
+            return
+        if msg_type in HEARTBEAT_MESSAGE_TYPES:
+            self.heartbeats.handle_message(conn, message)
+            return
+        self._dispatch_message(message, conn.peer_username)
+        if conn.received_at:
+            self.receive_latency.observe(time.perf_counter() - conn.received_at)
+
+    def _send_window_update(self, conn, channel, increment):
+        try:
+            conn.send_message({"type": "window_update", "channel": channel, "increment": increment})
+        except OSError as e:
+            print(f"[ERROR] Sending window update to {conn.peer_username}: {e}")
+
+    def _on_window_update(self, conn, message):
+        channel = message.get("channel")
+        increment = message.get("increment")
+        if channel not in CHANNELS or not isinstance(increment, int) or increment <= 0:
+            print(f"[WARN] Ignoring invalid window update from {conn.peer_username}")
+            return
+        conn.queue.add_credit(channel, increment)
+        conn._wake_writer()
+
+    def _new_decoder(self):
+        # Every connection starts out newline-delimited for the handshake.
+        return FrameDecoder("newline", self.config.recv_size, self.config.max_frame_size)
+
+    def _new_queue(self):
+        return OutboundQueue(
+            self.config.send_queue_high_watermark,
+            self.config.send_queue_low_watermark,
+            self.config.send_queue_overflow,
+            self.config.send_queue_block_timeout,
+            self.config.coalesce,
+            self.config.coalesce_window,
+            self.config.coalesce_max_bytes,
+            self.send_latency,
+        )
+
+    def _new_limiter(self):
+        config = self.config
+        if not (config.peer_message_rate or config.peer_byte_rate):
+            return None
+        return ReceiveLimiter(config.peer_message_rate, config.peer_message_burst,
+                              config.peer_byte_rate, config.peer_byte_burst)
+
+    def _tune_socket(self, sock):
+        try:
+            tune_socket(sock, self.config)
+        except OSError as e:
+            print(f"[WARN] Could not apply socket options: {e}")
+
+    def _introduce_message(self, options=None):
+        """
+        Build our introduce message. Without options this is the offer sent
+        by the connecting side; with options it is the acceptor's reply.
+        """
+        introduce_msg = {"type": "introduce", "username": self.username, "instance": self.instance_id,
+                         "listen_port": self.port}
+        if options is None:
+            introduce_msg["framings"] = list(self.config.framings)
+            introduce_msg["codecs"] = list(self.config.codecs)
+            introduce_msg["compressions"] = list(self.config.compressions)
+            introduce_msg["heartbeats"] = self.heartbeats.enabled
         else:
-            msg_type = message.get("type")
-            if msg_type == "chat":
-                sender = message.get("sender")
-                content = message.get("content")
-                output = f"[CHAT] {sender}: {content}"
-            elif msg_type == "presence":
-                sender = message.get("sender")
-                status = message.get("status")
-                output = f"[PRESENCE] {sender} is now {status}."
+            introduce_msg.update(options)
+        if self.dht:
+            # Lets the peer add us to its routing table.
+            introduce_msg["dht_port"] = self.dht.port
+        if self.config.channels and (options is None or options.get("channels")):
+            # JSON object keys are strings.
+            introduce_msg["channel_windows"] = {str(c): w for c, w in self._channel_windows().items()}
+        return introduce_msg
+
+    def _channel_windows(self):
+        return {CHANNEL_CHAT: self.config.chat_window, CHANNEL_BULK: self.config.bulk_window}
+
+    def _peer_windows(self, message):
+        windows = {}
+        for channel, window in (message.get("channel_windows") or {}).items():
+            if int(channel) in CHANNELS:
+                windows[int(channel)] = int(window)
+        return windows
+
+    def _negotiate(self, offer):
+        """Pick the options for a connection from the peer's introduce offer."""
+        offered = offer.get("framings") or ["newline"]
+        framing = next((f for f in self.config.framings if f in offered), "newline")
+        codec = "json"
+        compression = None
+        channels = False
+        # Binary codecs may contain newline bytes, and the compressed flag
+        # lives in the frame header, so both need length framing.
+        if framing == "length":
+            offered = offer.get("codecs") or ["json"]
+            codec = next((c for c in self.config.codecs if c in offered and c in CODECS), "json")
+            offered = offer.get("compressions") or []
+            compression = next((c for c in self.config.compressions if c in offered and c in COMPRESSORS), None)
+            channels = self.config.channels and bool(offer.get("channel_windows"))
+        heartbeats = self.heartbeats.enabled and bool(offer.get("heartbeats"))
+        return {"framing": framing, "codec": codec, "compression": compression, "channels": channels,
+                "heartbeats": heartbeats}
+
+    def _accepted_options(self, reply):
+        """Read the acceptor's choices; older peers send none and mean the defaults."""
+        framing = reply.get("framing", "newline")
+        if framing not in FRAMINGS:
+            raise FrameError(f"Peer chose unsupported framing {framing!r}")
+        codec = reply.get("codec", "json")
+        if codec not in CODECS or (CODECS[codec].binary and framing != "length"):
+            raise ValueError(f"Peer chose unsupported codec {codec!r}")
+        compression = reply.get("compression")
+        if compression and (compression not in COMPRESSORS or framing != "length"):
+            raise ValueError(f"Peer chose unsupported compression {compression!r}")
+        channels = bool(reply.get("channels"))
+        if channels and (framing != "length" or not self.config.channels):
+            raise ValueError("Peer enabled channels we did not offer")
+        heartbeats = self.heartbeats.enabled and bool(reply.get("heartbeats"))
+        return {"framing": framing, "codec": codec, "compression": compression, "channels": channels,
+                "heartbeats": heartbeats}
+
+    def _apply_options(self, conn, options, peer_message):
+        """Configure conn as negotiated; peer_message is the peer's introduce (offer or reply)."""
+        conn.set_framing(options["framing"])
+        conn.codec = options["codec"]
+        conn.set_compression(options["compression"], self.config.compression_threshold)
+        conn.heartbeats = options["heartbeats"]
+        conn.peer_instance = peer_message.get("instance")
+        conn.peer_dht_port = peer_message.get("dht_port")
+        conn.peer_listen_port = peer_message.get("listen_port")
+        conn.limiter = self._new_limiter()
+        if options["channels"]:
+            conn.enable_channels(self._channel_windows(), self._peer_windows(peer_message), self.config.fragment_size)
+
+    def _register_connection(self, peer_username, conn):
+        """
+        Make conn the connection to peer_username. Returns False if an
+        existing connection to that peer wins instead; the caller then
+        closes conn without reading from it.
+        """
+        with self.lock:
+            previous = self.connections.get(peer_username)
+            if previous is not None and self._keep_existing(previous, conn):
+                keep = False
             else:
-                # For file_transfer, group_chat, etc., pass the raw dict
-                output = message
+                keep = True
+                self.connections[peer_username] = conn
+                reconnected = previous is None and peer_username in self.known_peers
+                self.known_peers.add(peer_username)
+                status = self.peer_status.setdefault(peer_username, "online")
+        if previous is not None:
+            loser = conn if not keep else previous
+            print(f"[INFO] Duplicate connection with {peer_username}, "
+                  f"keeping the one opened by {self._dialer(previous if not keep else conn)}")
+            self.duplicates.inc(peer=peer_username)
+            if keep:
+                self._retire_counts(peer_username, loser)
+                loser.close()
+        if not keep:
+            return False
+        if reconnected:
+            self.reconnects.inc(peer=peer_username)
+        self.heartbeats.peer_connected(conn)
+        self.connection_manager.peer_connected(conn)
+        if self.dht and isinstance(conn.peer_dht_port, int):
+            self.dht.add_node(conn.addr[0], conn.peer_dht_port)
+        self.file_transfers.peer_connected(peer_username)
+        if self.outbox:
+            self.outbox.peer_connected(peer_username)
+        if previous is None:
+            self._notify_peer("joined", peer_username, status)
+        return True
+
+    def _dialer(self, conn):
+        return self.username if conn.initiator else conn.peer_username
+
+    def _keep_existing(self, existing, conn):
+        """
+        Settle two connections to the same peer. If the peer restarted
+        (another instance) or the old socket is failing, the new one
+        replaces it. Otherwise both ends opened a connection at the same
+        time, and both keep the one dialed by the lower username, so
+        exactly one socket survives on either side.
+        """
+        if existing.closed or existing.liveness != "alive" or existing.peer_instance != conn.peer_instance:
+            return False
+        if self._dialer(existing) == self._dialer(conn):
+            return False
+        return self._dialer(existing) == min(self.username, conn.peer_username)
+
+    def _unregister_connection(self, conn):
+        """Forget conn, unless its username has since been taken by a newer socket."""
+        removed = None
+        with self.lock:
+            for user, sock in self.connections.items():
+                if sock is conn:
+                    removed = user
+                    del self.connections[user]
+                    self.peer_status.pop(user, None)
+                    break
+        if removed:
+            self._notify_peer("left", removed, "offline")
+            self._retire_counts(removed, conn)
+            self.file_transfers.peer_disconnected(removed)
+            if self.running and self.config.reconnect:
+                self.connection_manager.peer_disconnected(removed)
+
+    def process_message(self, data, peer_username, codec="json"):
+        self._dispatch_message(decode_message(data, codec), peer_username)
+
+    def _dispatch_message(self, message, peer_username):
+        if not message:
+            self.decode_errors.inc(peer=peer_username)
+            self._deliver("[WARN] Received invalid message.")
+            return
+        msg_type = message.get("type")
+        if msg_type in FILE_MESSAGE_TYPES:
+            self.file_transfers.handle_message(message, peer_username)
+            return
+        if msg_type in GOSSIP_MESSAGE_TYPES and not self.gossip.handle_message(message, peer_username):
+            return
+        history_id = None
+        if msg_type == "chat":
+            if self.history:
+                history_id = self.history.append("chat", "in", peer=peer_username, sender=message.get("sender"),
+                                                 content=message.get("content"))
+        elif msg_type == "presence":
+            status = message.get("status")
+            with self.lock:
+                known = peer_username in self.connections
+                if known:
+                    self.peer_status[peer_username] = status
+            if known:
+                self._notify_peer("presence", peer_username, status)
+        elif msg_type == "group_chat" and self.history:
+            history_id = self.history.append("group", "in", peer=peer_username, group=message.get("group"),
+                                             sender=message.get("sender"), content=message.get("content"),
+                                             msg_id=message.get("id"))
+        self._deliver_message(message, peer_username, history_id)
+
+    # ------------------- application handlers -------------------
+    def add_handler(self, msg_type, handler):
+        """
+        Call handler(message, peer_username) for every received message of
+        msg_type, from a network thread, instead of message_callback. The
+        message is the typed object from message_types when the type has
+        one, else the decoded dict.
+        """
+        with self.lock:
+            self.handlers[msg_type] = self.handlers.get(msg_type, ()) + (handler,)
+
+    def remove_handler(self, msg_type, handler):
+        with self.lock:
+            handlers = tuple(h for h in self.handlers.get(msg_type, ()) if h is not handler)
+            if handlers:
+                self.handlers[msg_type] = handlers
+            else:
+                self.handlers.pop(msg_type, None)
+
+    def _deliver_message(self, message, peer_username, history_id=None):
+        msg_type = message.get("type")
+        handlers = self.handlers.get(msg_type)
+        if not handlers:
+            self._deliver(self._callback_output(message))
+            return
+        typed = typed_message(message)
+        if typed is None:
+            typed = message
+        else:
+            typed.history_id = history_id
+        for handler in handlers:
+            try:
+                handler(typed, peer_username)
+            except Exception as e:
+                print(f"[ERROR] Handler for {msg_type} from {peer_username} failed: {e}")
+
+    def _callback_output(self, message):
+        """What message_callback gets for a message no handler took: a text line or the raw dict."""
+        msg_type = message.get("type")
+        if msg_type == "chat":
+            return f"[CHAT] {message.get('sender')}: {message.get('content')}"
+        if msg_type == "presence":
+            return f"[PRESENCE] {message.get('sender')} is now {message.get('status')}."
+        # For group_chat, file_received, etc., pass the raw dict
+        return message
+
+    def _notify_peer(self, event, peer_username, status):
+        if self.peer_callback:
+            try:
+                self.peer_callback(event, peer_username, status)
+            except Exception as e:
+                print(f"[ERROR] Peer {event} callback for {peer_username} failed: {e}")
+
+    def _deliver(self, output):
         if self.message_callback:
             self.message_callback(output)
         else:
             print(output)
 
     def send_chat_message(self, recipient_username, content, msg_type="chat", extra_fields=None, is_dict=False):
+        """
+        Send a message to a connected peer. With an outbox, chat messages to
+        a peer that is not connected, or that still has queued messages,
+        are queued and delivered in order once it connects. Returns the
+        history id of a logged chat message, None for one sent or queued
+        but not logged, and False if it could not be sent.
+        """
         with self.lock:
             conn = self.connections.get(recipient_username)
-        if not conn:
+        if not conn and not (self.outbox and msg_type == "chat" and not is_dict):
             print(f"[ERROR] No connection found for {recipient_username}")
-            return
+            return False
         if is_dict:
             chat_msg = content
         else:
@@ -179,38 +736,150 @@ class PeerNetwork:
             }
             if extra_fields:
                 chat_msg.update(extra_fields)
-        try:
-            conn.sendall(encode_message(chat_msg) + b'\n')
-        except Exception as e:
-            print(f"[ERROR] Sending chat message to {recipient_username}: {e}")
+        if not conn:
+            first = not self.outbox.holds(recipient_username)
+            if not self.outbox.put(recipient_username, chat_msg):
+                return False
+            if first:
+                print(f"[INFO] {recipient_username} is offline, queueing messages until they connect.")
+        elif not (self.outbox and chat_msg.get("type") == "chat"
+                  and self.outbox.put(recipient_username, chat_msg, only_if_queued=True)):
+            try:
+                sent = conn.send_message(chat_msg)
+            except Exception as e:
+                print(f"[ERROR] Sending chat message to {recipient_username}: {e}")
+                return False
+            if not sent:
+                # Not logged, so the history never shows a message that was dropped.
+                print(f"[ERROR] Sending chat message to {recipient_username}: message dropped")
+                return False
+        if self.history and chat_msg.get("type") == "chat":
+            return self.history.append("chat", "out", peer=recipient_username, sender=self.username,
+                                       content=chat_msg.get("content"))
+        return None
+
+    def send_group_message(self, group, content, extra_fields=None):
+        """Gossip a group_chat message to every peer reachable through the overlay. Returns its id."""
+        msg_id = self.gossip.publish(group, content, extra_fields)
+        if self.history:
+            self.history.append("group", "out", group=group, sender=self.username, content=content, msg_id=msg_id)
+        return msg_id
+
+    def send_file(self, recipient_username, file_path, progress_callback=None):
+        """
+        Stream a file to a connected peer in chunks. progress_callback, if
+        given, is called with (bytes_written, filesize) from a network thread.
+        """
+        if recipient_username not in self.list_peers():
+            print(f"[ERROR] No connection found for {recipient_username}")
+            return None
+        return self.file_transfers.send_file(recipient_username, file_path, progress_callback)
 
     def list_peers(self):
         with self.lock:
             return list(self.connections.keys())
 
+    def peer_statuses(self):
+        """Last presence status ("online" until told otherwise) per connected peer."""
+        with self.lock:
+            return dict(self.peer_status)
+
+    def resolve_username(self, username):
+        """
+        (host, port) of username: where a connected peer accepts
+        connections, else the address we last dialed it at, else a DHT
+        lookup. None if unknown.
+        """
+        with self.lock:
+            conn = self.connections.get(username)
+        if conn is not None:
+            if conn.initiator:
+                return conn.addr
+            # An inbound socket comes from an ephemeral port; use the one it advertised.
+            if isinstance(conn.peer_listen_port, int):
+                return conn.addr[0], conn.peer_listen_port
+        address = self.connection_manager.known_addresses().get(username)
+        if address is None and self.dht:
+            address = self.dht.resolve(username)
+        return address
+
+    def discovered_peers(self):
+        """Peers announced on the LAN (username, host, port), connected or not."""
+        return self.discovery.peers() if self.discovery else []
+
+    def queue_stats(self):
+        """Outbound queue depth and drop counters per connected peer."""
+        with self.lock:
+            conns = list(self.connections.items())
+        return {peer_username: conn.queue.stats() for peer_username, conn in conns}
+
+    def compression_stats(self):
+        """Compression ratio and CPU time per connected peer."""
+        with self.lock:
+            conns = list(self.connections.items())
+        stats = {}
+        for peer_username, conn in conns:
+            stats[peer_username] = conn.compression_stats.as_dict()
+            stats[peer_username]["compression"] = conn.compression
+        return stats
+
+    def peer_rtts(self):
+        """Smoothed round-trip time in seconds per connected peer (None before the first pong)."""
+        with self.lock:
+            conns = list(self.connections.items())
+        return {peer_username: conn.rtt for peer_username, conn in conns}
+
+    def peer_rtt(self, peer_username):
+        with self.lock:
+            conn = self.connections.get(peer_username)
+        return conn.rtt if conn else None
+
     def broadcast_presence(self, status):
         presence_msg = {
             "type": "presence",
             "sender": self.username,
             "status": status
         }
+        # Only enqueue outside the lock; a slow peer must not stall the rest.
         with self.lock:
-            for peer_username, conn in self.connections.items():
-                try:
-                    conn.sendall(encode_message(presence_msg) + b'\n')
-                except Exception as e:
+            conns = list(self.connections.items())
+        for peer_username, conn in conns:
+            # A connection already being closed has nobody left to tell.
+            if conn.closed or conn.queue.closed:
+                continue
+            try:
+                conn.send_message(presence_msg, droppable=True)
+            except Exception as e:
+                if not (conn.closed or conn.queue.closed):
                     print(f"[ERROR] Broadcasting to {peer_username}: {e}")
 
     def shutdown(self):
         self.running = False
+        self.heartbeats.stop()
+        if self.discovery:
+            self.discovery.stop()
+        if self.dht:
+            self.dht.stop()
+        self.connection_manager.stop()
         self.broadcast_presence("offline")
+        self.file_transfers.shutdown()
         with self.lock:
-            for peer_username, conn in self.connections.items():
-                try:
-                    conn.close()
-                except Exception as e:
-                    print(f"[ERROR] Closing connection to {peer_username}: {e}")
+            conns = list(self.connections.items())
             self.connections.clear()
+            self.peer_status.clear()
+        for peer_username, conn in conns:
+            try:
+                conn.close()
+            except Exception as e:
+                print(f"[ERROR] Closing connection to {peer_username}: {e}")
         if self.server_socket:
             self.server_socket.close()
+        if self.selector_engine:
+            self.selector_engine.stop()
+        if self.history:
+            self.history.close()
+        if self.outbox:
+            self.outbox.close()
+        if self.metrics_server:
+            self.metrics_server.stop()
         print("[INFO] Network shutdown complete.")
@@ -0,0 +1,334 @@
+import collections
+import threading
+import time
+
+from channels import CHANNELS, CHANNEL_CHAT, CHANNEL_NAMES
+
+# What put() does once a channel is above its high watermark:
+#   "drop_presence" - drop the oldest queued presence frames to make room; a
+#                     presence frame that still does not fit is dropped,
+#                     anything else waits like "block"
+#   "block"         - wait until the writer drains below the low watermark
+#   "disconnect"    - give up on the slow peer and close the connection
+OVERFLOW_POLICIES = ("drop_presence", "block", "disconnect")
+
+DEFAULT_HIGH_WATERMARK = 4 * 1024 * 1024
+DEFAULT_LOW_WATERMARK = 1024 * 1024
+
+# Write coalescing: small frames queued within the window are gathered into
+# one vectored write of at most this many bytes.
+DEFAULT_COALESCE_WINDOW = 0.002
+DEFAULT_COALESCE_MAX_BYTES = 64 * 1024
+# Stay well below IOV_MAX (1024 on Linux) buffers per sendmsg.
+MAX_BATCH_FRAMES = 256
+
+
+class QueueOverflow(OSError):
+    """Raised by put() when a frame cannot be queued under the overflow policy."""
+
+
+class OutboundItem:
+    """One frame (possibly several buffers or file segments) queued for a peer."""
+    __slots__ = ("parts", "size", "on_sent", "droppable", "in_memory", "channel", "queued_at")
+
+    def __init__(self, parts, size, on_sent, droppable, channel=CHANNEL_CHAT, queued_at=0.0):
+        self.parts = parts
+        self.size = size
+        self.on_sent = on_sent
+        self.droppable = droppable
+        self.channel = channel
+        self.queued_at = queued_at
+        # Only frames held entirely in memory can be coalesced.
+        self.in_memory = all(isinstance(part, memoryview) for part in parts)
+
+
+class OutboundQueue:
+    """
+    Bounded per-connection send queue drained by a single writer.
+
+    Producers never touch the socket. Each logical channel has its own
+    deque, byte depth and (once negotiated) flow-control credit; the writer
+    takes frames from the most urgent channel that has both data and
+    credit. Items handed to the writer move to the in-flight list and are
+    accounted until the writer reports them written with task_done().
+
+    Once a channel crosses the high watermark its producers are throttled
+    until the writer has drained it down to the low watermark, so a bulk
+    transfer filling its channel never holds up chat.
+    """
+
+    def __init__(self, high_watermark=DEFAULT_HIGH_WATERMARK, low_watermark=DEFAULT_LOW_WATERMARK,
+                 overflow="drop_presence", block_timeout=30.0, coalesce=False,
+                 coalesce_window=DEFAULT_COALESCE_WINDOW, coalesce_max_bytes=DEFAULT_COALESCE_MAX_BYTES,
+                 send_latency=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {overflow!r}, expected one of {OVERFLOW_POLICIES}")
+        if low_watermark > high_watermark:
+            raise ValueError("low_watermark must not exceed high_watermark")
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.coalesce = coalesce
+        self.coalesce_window = coalesce_window
+        self.coalesce_max_bytes = coalesce_max_bytes
+        self.send_latency = send_latency  # optional metrics Histogram of enqueue-to-wire seconds
+        self.cond = threading.Condition()
+        self.queues = [collections.deque() for _ in CHANNELS]
+        self.depths = [0 for _ in CHANNELS]            # bytes queued or in flight, per channel
+        self.throttled = [False for _ in CHANNELS]     # above high, not yet back below low
+        self.credit = [None for _ in CHANNELS]         # None: not flow controlled
+        self.in_flight = collections.deque()           # items handed to the writer, in write order
+        self.depth_bytes = 0
+        self.closed = False
+        self.dropped_frames = 0
+        self.dropped_bytes = 0
+        self.overflows = 0
+        self.coalesced_writes = 0
+        self.coalesced_frames = 0
+        self.frames_sent = 0
+        self.bytes_sent = 0
+
+    def __len__(self):
+        return len(self.in_flight) + sum(len(queue) for queue in self.queues)
+
+    def stats(self):
+        with self.cond:
+            channels = {}
+            for channel in CHANNELS:
+                channels[CHANNEL_NAMES[channel]] = {
+                    "frames": len(self.queues[channel]),
+                    "bytes": self.depths[channel],
+                    "throttled": self.throttled[channel],
+                    "credit": self.credit[channel],
+                }
+            return {
+                "frames": len(self),
+                "bytes": self.depth_bytes,
+                "throttled": any(self.throttled),
+                "dropped_frames": self.dropped_frames,
+                "dropped_bytes": self.dropped_bytes,
+                "overflows": self.overflows,
+                "coalesced_writes": self.coalesced_writes,
+                "coalesced_frames": self.coalesced_frames,
+                "frames_sent": self.frames_sent,
+                "bytes_sent": self.bytes_sent,
+                "channels": channels,
+            }
+
+    # ------------------- producers -------------------
+    def put(self, parts, on_sent=None, droppable=False, block=True, channel=CHANNEL_CHAT):
+        """
+        Queue a frame made of buffers and/or FileSegments. Returns False if
+        it was dropped. Raises QueueOverflow under the "disconnect" policy,
+        when blocking times out, or after close().
+        """
+        return self.put_frames([parts], on_sent, droppable, block, channel)
+
+    def put_frames(self, frames, on_sent=None, droppable=False, block=True, channel=CHANNEL_CHAT):
+        """
+        Queue the fragments of one message as consecutive frames of channel.
+        They are admitted (or dropped) together; on_sent fires after the last.
+        """
+        sizes = [sum(len(part) for part in parts) for parts in frames]
+        size = sum(sizes)
+        with self.cond:
+            if self.closed:
+                raise QueueOverflow("send queue closed")
+            if self.depths[channel] and self.depths[channel] + size > self.high_watermark:
+                self.throttled[channel] = True
+            if self.throttled[channel]:
+                self.overflows += 1
+                if not self._make_room(channel, size, droppable, block):
+                    self.dropped_frames += len(frames)
+                    self.dropped_bytes += size
+                    return False
+            queue = self.queues[channel]
+            now = time.perf_counter()
+            for parts, frame_size in zip(frames, sizes):
+                queue.append(OutboundItem(list(parts), frame_size, None, droppable, channel, now))
+            queue[-1].on_sent = on_sent
+            self.depths[channel] += size
+            self.depth_bytes += size
+            self.cond.notify_all()
+            return True
+
+    def _make_room(self, channel, size, droppable, block):
+        if self.overflow == "disconnect":
+            raise QueueOverflow(f"send queue over {self.high_watermark} bytes")
+        if self.overflow == "drop_presence":
+            self._drop_presence(channel, size)
+            if not self.throttled[channel]:
+                return True
+            if droppable:
+                return False
+        if not block:
+            # The writer itself cannot wait on its own queue; let it through.
+            return True
+        deadline = time.monotonic() + self.block_timeout
+        while self.throttled[channel] and not self.closed:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise QueueOverflow(f"send queue still full after {self.block_timeout}s")
+            self.cond.wait(remaining)
+        if self.closed:
+            raise QueueOverflow("send queue closed")
+        return True
+
+    def _drop_presence(self, channel, size):
+        # Only queued items are dropped; in-flight ones may be part-written.
+        kept = collections.deque()
+        queue = self.queues[channel]
+        while queue and self.depths[channel] + size > self.low_watermark:
+            item = queue.popleft()
+            if item.droppable:
+                self.depths[channel] -= item.size
+                self.depth_bytes -= item.size
+                self.dropped_frames += 1
+                self.dropped_bytes += item.size
+            else:
+                kept.append(item)
+        kept.extend(queue)
+        self.queues[channel] = kept
+        if self.depths[channel] + size <= self.low_watermark:
+            self.throttled[channel] = False
+
+    # ------------------- flow control -------------------
+    def set_credit(self, windows):
+        """Start flow control with the peer's advertised windows ({channel: bytes})."""
+        with self.cond:
+            for channel, window in windows.items():
+                self.credit[channel] = window
+            self.cond.notify_all()
+
+    def add_credit(self, channel, increment):
+        with self.cond:
+            if self.credit[channel] is not None:
+                self.credit[channel] += increment
+            self.cond.notify_all()
+
+    def _ready_channel(self):
+        for channel in CHANNELS:
+            if self.queues[channel]:
+                credit = self.credit[channel]
+                # Queued output still drains after close(), whatever the credit.
+                if credit is None or credit > 0 or self.closed:
+                    return channel
+        return None
+
+    def _take(self, channel):
+        item = self.queues[channel].popleft()
+        if self.credit[channel] is not None:
+            self.credit[channel] -= item.size
+        self.in_flight.append(item)
+        return item
+
+    def has_ready(self):
+        """Whether the writer has anything it may send right now."""
+        with self.cond:
+            return bool(self.in_flight) or self._ready_channel() is not None
+
+    # ------------------- writer -------------------
+    def get(self, timeout=None):
+        """Blocking read of the next item for a writer thread. None once closed and empty."""
+        with self.cond:
+            while True:
+                if self.in_flight:
+                    return self.in_flight[0]
+                channel = self._ready_channel()
+                if channel is not None:
+                    return self._take(channel)
+                if self.closed:
+                    return None
+                if not self.cond.wait(timeout):
+                    return None
+
+    def peek(self):
+        """Next item without waiting, for an event-loop writer."""
+        with self.cond:
+            if self.in_flight:
+                return self.in_flight[0]
+            channel = self._ready_channel()
+            return self._take(channel) if channel is not None else None
+
+    def gather(self, window=0.0):
+        """
+        Leading run of in-memory frames to write with one vectored send,
+        capped at coalesce_max_bytes. With a window, waits up to that long
+        for more frames while less than the cap is queued.
+        """
+        with self.cond:
+            if window:
+                deadline = time.monotonic() + window
+                while not self.closed and self.depth_bytes < self.coalesce_max_bytes:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+            batch = []
+            total = 0
+            for item in self.in_flight:
+                if not item.in_memory or len(batch) == MAX_BATCH_FRAMES:
+                    return batch
+                batch.append(item)
+                total += item.size
+            while len(batch) < MAX_BATCH_FRAMES:
+                channel = self._ready_channel()
+                if channel is None:
+                    break
+                item = self.queues[channel][0]
+                if not item.in_memory or (batch and total + item.size > self.coalesce_max_bytes):
+                    break
+                batch.append(self._take(channel))
+                total += item.size
+            return batch
+
+    def advance(self, batch, sent):
+        """
+        Account for sent bytes of a gathered batch. Completed items are
+        retired; returns the items still (partly) unwritten.
+        """
+        done = 0
+        for i, item in enumerate(batch):
+            while item.parts:
+                part = item.parts[0]
+                if sent < len(part):
+                    if sent:
+                        item.parts[0] = part[sent:]
+                    self._count_write(done)
+                    return batch[i:]
+                sent -= len(part)
+                del item.parts[0]
+            self.task_done(item)
+            done += 1
+        self._count_write(done)
+        return []
+
+    def _count_write(self, frames):
+        with self.cond:
+            self.coalesced_writes += 1
+            self.coalesced_frames += frames
+
+    def task_done(self, item):
+        """The oldest in-flight item has been written completely."""
+        with self.cond:
+            if self.in_flight and self.in_flight[0] is item:
+                self.in_flight.popleft()
+                channel = item.channel
+                self.depths[channel] -= item.size
+                self.depth_bytes -= item.size
+                self.frames_sent += 1
+                self.bytes_sent += item.size
+                if self.throttled[channel] and self.depths[channel] <= self.low_watermark:
+                    self.throttled[channel] = False
+            self.cond.notify_all()
+        if self.send_latency is not None:
+            self.send_latency.observe(time.perf_counter() - item.queued_at)
+        if item.on_sent:
+            item.on_sent()
+
+    def close(self):
+        """Refuse new items; the writer still drains what is queued."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
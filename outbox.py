@@ -0,0 +1,257 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+# Messages kept per offline peer; beyond this the oldest are dropped.
+DEFAULT_OUTBOX_MAX_MESSAGES = 10000
+# Seconds a queued message is kept before it expires undelivered (a week).
+DEFAULT_OUTBOX_MAX_AGE = 7 * 24 * 3600.0
+# Messages written to disk per transaction, and handed to the connection
+# per batch when a peer comes back.
+DEFAULT_OUTBOX_BATCH_SIZE = 256
+# Longest a queued message waits in memory before it is written.
+OUTBOX_WRITE_INTERVAL = 0.2
+# How often expired messages are purged, in seconds.
+OUTBOX_EXPIRE_INTERVAL = 60.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    peer TEXT NOT NULL,
+    ts REAL NOT NULL,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outbox_peer ON outbox (peer, id);
+CREATE INDEX IF NOT EXISTS outbox_ts ON outbox (ts);
+"""
+
+INSERT = "INSERT INTO outbox (peer, ts, message) VALUES (?, ?, ?)"
+# Keep only a peer's newest max_messages rows.
+TRIM = "DELETE FROM outbox WHERE id IN (SELECT id FROM outbox WHERE peer = ? ORDER BY id DESC LIMIT -1 OFFSET ?)"
+
+
+# Wakes the worker to write a full batch of put messages.
+WRITE = object()
+
+
+def outbox_path(directory, username):
+    return os.path.join(directory, f"{username}.outbox.sqlite3")
+
+
+class Outbox:
+    """
+    Store-and-forward queue of messages for peers that are not connected,
+    kept in an SQLite database (WAL mode) so it survives restarts.
+
+    put() appends a message to the recipient's queue in memory; a single
+    worker thread writes what has been put in one transaction, batch_size
+    messages at a time and at least every OUTBOX_WRITE_INTERVAL seconds,
+    so a crash can only lose the last moment's messages. When the peer
+    (re)connects, the same worker hands its messages to the
+    connection in id order, batch_size at a time, and deletes a batch only
+    once its last frame has been written to the socket; if the connection
+    drops first, the rest is sent again on the next connect. Until a
+    peer's queue is empty, new messages to it are queued behind the old
+    ones (see put(only_if_queued=True)) so they arrive in order.
+
+    The number of messages per peer is kept in memory, so checking for
+    queued messages costs no query; reading and deleting a batch are range
+    scans on the (peer, id) index and cost the same with 10 or 100000 rows
+    queued.
+    """
+
+    def __init__(self, network, path, max_messages=DEFAULT_OUTBOX_MAX_MESSAGES,
+                 max_age=DEFAULT_OUTBOX_MAX_AGE, batch_size=DEFAULT_OUTBOX_BATCH_SIZE):
+        self.network = network
+        self.path = path
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self.batch_size = batch_size
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.counts = {}  # mapping: username -> messages queued, written or not
+        self.unwritten = []  # (peer, ts, message) rows put since the last write
+        self.overfull = set()  # peers whose oldest rows are to be dropped on the next write
+        self.scheduled = set()  # peers waiting for or being flushed by the worker
+        self.flush_requests = queue.Queue()
+        self.running = True
+        self.queued = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.expired = 0
+        with self.lock:
+            self._expire()
+            self._load_counts()
+        self.worker = threading.Thread(target=self._flush_loop, daemon=True)
+        self.worker.start()
+
+    def _load_counts(self):
+        self.counts = dict(self.db.execute("SELECT peer, COUNT(*) FROM outbox GROUP BY peer"))
+
+    # ------------------- queueing -------------------
+    def put(self, peer_username, message, only_if_queued=False):
+        """
+        Queue message for peer_username. With only_if_queued, only if
+        messages to that peer are already waiting; returns whether it was
+        queued.
+        """
+        payload = json.dumps(message)
+        with self.lock:
+            count = self.counts.get(peer_username, 0)
+            if only_if_queued and not count:
+                return False
+            self.unwritten.append((peer_username, time.time(), payload))
+            if count < self.max_messages:
+                self.counts[peer_username] = count + 1
+            else:
+                # The oldest goes on the next write to stay within the limit.
+                self.overfull.add(peer_username)
+                self.dropped += 1
+            self.queued += 1
+            full = len(self.unwritten) >= self.batch_size
+        if full:
+            self.flush_requests.put(WRITE)
+        # The peer may have connected since the caller looked.
+        with self.network.lock:
+            connected = peer_username in self.network.connections
+        if connected:
+            self.peer_connected(peer_username)
+        return True
+
+    def _write(self):
+        """Commit the messages put since the last write in one transaction. Called with the lock held."""
+        if not self.unwritten:
+            return
+        rows, self.unwritten = self.unwritten, []
+        overfull, self.overfull = self.overfull, set()
+        try:
+            with self.db:
+                self.db.executemany(INSERT, rows)
+                for peer_username in overfull:
+                    self.db.execute(TRIM, (peer_username, self.max_messages))
+        except sqlite3.Error as e:
+            print(f"[ERROR] Writing {len(rows)} queued messages: {e}")
+            self._load_counts()
+
+    def holds(self, peer_username):
+        """Whether messages to peer_username are waiting to be delivered."""
+        return self.counts.get(peer_username, 0) > 0
+
+    def pending(self):
+        """Messages queued per peer."""
+        with self.lock:
+            return {peer: count for peer, count in self.counts.items() if count}
+
+    def stats(self):
+        with self.lock:
+            return {"pending": sum(self.counts.values()), "queued": self.queued, "delivered": self.delivered,
+                    "dropped": self.dropped, "expired": self.expired}
+
+    # ------------------- delivery -------------------
+    def peer_connected(self, peer_username):
+        """Schedule delivery of peer_username's queued messages, if any."""
+        with self.lock:
+            if not self.counts.get(peer_username) or peer_username in self.scheduled:
+                return
+            self.scheduled.add(peer_username)
+        self.flush_requests.put(peer_username)
+
+    def _flush_loop(self):
+        next_expiry = time.monotonic() + OUTBOX_EXPIRE_INTERVAL
+        while self.running:
+            timeout = OUTBOX_WRITE_INTERVAL if self.unwritten else next_expiry - time.monotonic()
+            try:
+                peer_username = self.flush_requests.get(timeout=max(0.0, timeout))
+            except queue.Empty:
+                peer_username = None
+            with self.lock:
+                self._write()
+                if time.monotonic() >= next_expiry:
+                    self._expire()
+                    next_expiry = time.monotonic() + OUTBOX_EXPIRE_INTERVAL
+            if peer_username is None or peer_username is WRITE:
+                continue
+            try:
+                self._flush(peer_username)
+            except Exception as e:
+                print(f"[ERROR] Delivering queued messages to {peer_username}: {e}")
+                with self.lock:
+                    self.scheduled.discard(peer_username)
+                continue
+            with self.lock:
+                self.scheduled.discard(peer_username)
+            # A reconnect while this flush was winding down was not scheduled.
+            with self.network.lock:
+                conn = self.network.connections.get(peer_username)
+            if conn is not None and not conn.closed and self.running:
+                self.peer_connected(peer_username)
+
+    def _flush(self, peer_username):
+        sent_total = 0
+        while self.running:
+            with self.network.lock:
+                conn = self.network.connections.get(peer_username)
+            if conn is None or conn.closed:
+                break
+            with self.lock:
+                self._write()
+                rows = self.db.execute(
+                    "SELECT id, message FROM outbox WHERE peer = ? ORDER BY id LIMIT ?",
+                    (peer_username, self.batch_size),
+                ).fetchall()
+                if not rows:
+                    self.counts.pop(peer_username, None)
+                    break
+            written = threading.Event()
+            for index, (_, payload) in enumerate(rows):
+                on_sent = written.set if index == len(rows) - 1 else None
+                if not conn.send_message(json.loads(payload), on_sent=on_sent) and on_sent:
+                    written.set()
+            # Keep the batch until it is on the wire, so a connection lost
+            # halfway sends it again next time.
+            while not written.wait(1.0):
+                if conn.closed or not self.running:
+                    return
+            with self.lock:
+                with self.db:
+                    deleted = self.db.execute("DELETE FROM outbox WHERE peer = ? AND id <= ?",
+                                              (peer_username, rows[-1][0])).rowcount
+                self.counts[peer_username] = max(0, self.counts.get(peer_username, 0) - deleted)
+                self.delivered += len(rows)
+            sent_total += len(rows)
+        if sent_total:
+            print(f"[INFO] Delivered {sent_total} queued messages to {peer_username}.")
+
+    def _expire(self):
+        """Drop messages older than max_age. Called with the lock held."""
+        self._write()
+        try:
+            with self.db:
+                deleted = self.db.execute("DELETE FROM outbox WHERE ts < ?",
+                                          (time.time() - self.max_age,)).rowcount
+        except sqlite3.Error as e:
+            print(f"[ERROR] Expiring queued messages: {e}")
+            return
+        if deleted:
+            self.expired += deleted
+            self._load_counts()
+            print(f"[INFO] {deleted} queued messages expired undelivered.")
+
+    def close(self):
+        if not self.running:
+            return
+        self.running = False
+        self.flush_requests.put(None)
+        self.worker.join()
+        with self.lock:
+            self._write()
+            self.db.close()
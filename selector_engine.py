@@ -0,0 +1,444 @@
+import collections
+import errno
+import heapq
+import itertools
+import selectors
+import socket
+import threading
+import time
+from message import decode_message
+from framing import FRAME_HEADER
+from connection import PeerConnection, FileSegment, send_buffers
+
+
+class SelectorConnection(PeerConnection):
+    """
+    Per-socket state for the selector engine. The event loop is the writer
+    for the outbound queue; producers on other threads only enqueue and
+    wake it.
+    """
+
+    def __init__(self, engine, sock, addr, initiator):
+        super().__init__(sock, addr, engine.network._new_decoder(), engine.network._new_queue())
+        self.engine = engine
+        self.initiator = initiator
+        self.handshake_done = False
+        self.connecting = False
+        self.close_after_flush = False
+        self.flush_scheduled = False  # a coalescing timer is pending
+        self.admitted = False         # holds a handshake slot of the network's AdmissionControl
+        self.read_paused = False      # over its receive rate limit, not polled for reading
+        self.handler = engine._make_handler(self)
+
+    def _can_block(self):
+        # The loop drains the queue, so it must never wait on it.
+        return threading.current_thread() is not self.engine.thread
+
+    def _wake_writer(self):
+        self.engine.call_soon(self.engine.want_write, self)
+
+    def close(self):
+        self.engine.call_soon(self.engine.close_when_flushed, self)
+
+    def abort(self):
+        self.queue.close()
+        self.engine.call_soon(self.engine._close, self)
+
+
+class SelectorEngine:
+    """
+    Single-threaded event loop backend for PeerNetwork. All sockets are
+    non-blocking and multiplexed with the selectors module, so one thread
+    serves the listening socket and every peer connection.
+    """
+
+    def __init__(self, network):
+        self.network = network
+        self.selector = selectors.DefaultSelector()
+        self.server_socket = None
+        self.accept_paused = False  # at the handshake limit, not polling the listening socket
+        self.conns = set()
+        self.pending = collections.deque()
+        self.timers = []  # heap of (deadline, seq, func, args)
+        self.timer_seq = itertools.count()
+        self.wake_pending = False
+        self.wake_lock = threading.Lock()
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ, self._on_wake)
+        self.running = False
+        self.thread = None
+
+    # ------------------- loop control -------------------
+    def ensure_running(self):
+        if self.thread is None:
+            self.running = True
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def call_soon(self, func, *args):
+        """Schedule func(*args) on the loop thread. Safe to call from any thread."""
+        self.pending.append((func, args))
+        if threading.current_thread() is self.thread:
+            return
+        with self.wake_lock:
+            if self.wake_pending:
+                return
+            self.wake_pending = True
+        try:
+            self.wake_w.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def call_later(self, delay, func, *args):
+        """Schedule func(*args) after delay seconds. Loop thread only."""
+        heapq.heappush(self.timers, (time.monotonic() + delay, next(self.timer_seq), func, args))
+
+    def _run_timers(self):
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, func, args = heapq.heappop(self.timers)
+            self.pending.append((func, args))
+
+    def _select_timeout(self):
+        if not self.timers:
+            return 1.0
+        return min(1.0, max(0.0, self.timers[0][0] - time.monotonic()))
+
+    def _on_wake(self, key, mask):
+        try:
+            while self.wake_r.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+        with self.wake_lock:
+            self.wake_pending = False
+
+    def _run_pending(self):
+        for _ in range(len(self.pending)):
+            func, args = self.pending.popleft()
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"[ERROR] Selector engine callback {getattr(func, '__name__', func)}: {e}")
+
+    def run(self):
+        while self.running:
+            try:
+                events = self.selector.select(timeout=self._select_timeout())
+            except OSError as e:
+                print(f"[ERROR] Selector loop: {e}")
+                continue
+            for key, mask in events:
+                callback = key.data
+                try:
+                    callback(key, mask)
+                except Exception as e:
+                    print(f"[ERROR] Selector engine event: {e}")
+            self._run_timers()
+            self._run_pending()
+        self._teardown()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.call_soon(self._stop)
+        if threading.current_thread() is not self.thread:
+            self.thread.join(timeout=2.0)
+
+    def _stop(self):
+        # Give queued output (e.g. the offline presence) one last chance to go out.
+        for conn in list(self.conns):
+            self._flush(conn)
+        self.running = False
+
+    def _teardown(self):
+        for conn in list(self.conns):
+            self._close(conn)
+        if self.server_socket:
+            try:
+                self.selector.unregister(self.server_socket)
+            except (KeyError, ValueError):
+                pass
+            self.server_socket.close()
+            self.server_socket = None
+        self.selector.unregister(self.wake_r)
+        self.wake_r.close()
+        self.wake_w.close()
+        self.selector.close()
+
+    # ------------------- server side -------------------
+    def start_server(self, host, port, backlog):
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.network._tune_socket(self.server_socket)
+        self.server_socket.bind((host, port))
+        self.server_socket.listen(backlog)
+        self.server_socket.setblocking(False)
+        self.ensure_running()
+        self.call_soon(self.selector.register, self.server_socket, selectors.EVENT_READ, self._on_accept)
+
+    def _on_accept(self, key, mask):
+        # Drain the accept backlog in one go; the listener is level-triggered.
+        for _ in range(64):
+            if not self.network.admission.accepting():
+                # Leave the rest in the listen backlog until a handshake ends.
+                self.selector.unregister(self.server_socket)
+                self.accept_paused = True
+                return
+            try:
+                sock, addr = self.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                print(f"[ERROR] Accepting connection: {e}")
+                return
+            if not self.network.admission.admit(addr):
+                sock.close()
+                continue
+            print(f"[INFO] Accepted connection from {addr}")
+            sock.setblocking(False)
+            self.network._tune_socket(sock)
+            conn = SelectorConnection(self, sock, addr, initiator=False)
+            self._start_handshake(conn)
+            self.selector.register(sock, selectors.EVENT_READ, conn.handler)
+
+    # ------------------- client side -------------------
+    def connect(self, peer_host, peer_port):
+        self.ensure_running()
+        self.call_soon(self._connect, peer_host, peer_port)
+
+    def _connect(self, peer_host, peer_port):
+        if not self.network.admission.admit((peer_host, peer_port), inbound=False):
+            return
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        self.network._tune_socket(sock)
+        err = sock.connect_ex((peer_host, peer_port))
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            print(f"[ERROR] Connecting to peer {peer_host}:{peer_port} - {errno.errorcode.get(err, err)}")
+            sock.close()
+            self.network.admission.release()
+            return
+        conn = SelectorConnection(self, sock, (peer_host, peer_port), initiator=True)
+        conn.connecting = True
+        self._start_handshake(conn)
+        self.selector.register(sock, selectors.EVENT_WRITE, conn.handler)
+
+    def _start_handshake(self, conn):
+        """Track an admitted socket until its introduce arrives, or the handshake timeout."""
+        conn.admitted = True
+        self.conns.add(conn)
+        timeout = self.network.config.handshake_timeout
+        if timeout:
+            self.call_later(timeout, self._check_handshake, conn, timeout)
+
+    def _check_handshake(self, conn, timeout):
+        if not conn.closed and not conn.handshake_done:
+            self.network.admission.handshake_timed_out(conn.addr, timeout)
+            self._close(conn)
+
+    def _end_handshake(self, conn):
+        if conn.admitted:
+            conn.admitted = False
+            self.network.admission.release()
+            if self.accept_paused and self.server_socket is not None:
+                self.accept_paused = False
+                self.selector.register(self.server_socket, selectors.EVENT_READ, self._on_accept)
+
+    def _on_connected(self, conn):
+        conn.connecting = False
+        err = conn.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            if err == errno.ECONNREFUSED:
+                print(f"[ERROR] Connecting to peer {conn.addr[0]}:{conn.addr[1]} - Connection refused.")
+            else:
+                print(f"[ERROR] Connecting to peer {conn.addr[0]}:{conn.addr[1]} - {errno.errorcode.get(err, err)}")
+            self._close(conn)
+            return
+        conn.send_message(self.network._introduce_message())
+
+    # ------------------- per-connection I/O -------------------
+    def _make_handler(self, conn):
+        def handler(key, mask):
+            if conn.connecting:
+                self._on_connected(conn)
+                return
+            if mask & selectors.EVENT_READ:
+                self._on_readable(conn)
+            if mask & selectors.EVENT_WRITE and not conn.closed:
+                self._flush(conn)
+        return handler
+
+    def _on_readable(self, conn):
+        try:
+            received = conn.decoder.recv_into(conn.sock)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            print(f"[ERROR] Listening to peer {conn.peer_username or conn.addr}: {e}")
+            self._close(conn)
+            return
+        conn.received_at = time.perf_counter()
+        if not received:
+            if conn.peer_username:
+                print(f"[INFO] Connection closed by {conn.peer_username}")
+            self._close(conn)
+            return
+        self._handle_buffered(conn)
+
+    def _handle_buffered(self, conn):
+        try:
+            for flags, frame in conn.decoder.frames():
+                if conn.closed:
+                    break
+                if not conn.handshake_done:
+                    self._on_introduce(conn, frame)
+                    continue
+                self.network._handle_frame(conn, flags, frame)
+                if conn.limiter:
+                    delay = conn.limiter.charge(1, FRAME_HEADER.size + len(frame))
+                    if delay:
+                        # Leave the rest buffered and stop polling the socket
+                        # for a while; TCP pushes back on the sender.
+                        conn.read_paused = True
+                        self._update_interest(conn)
+                        self.call_later(delay, self._resume_reading, conn)
+                        return
+        except Exception as e:
+            print(f"[ERROR] Listening to peer {conn.peer_username or conn.addr}: {e}")
+            self._close(conn)
+
+    def _resume_reading(self, conn):
+        if conn.closed:
+            return
+        conn.read_paused = False
+        self._handle_buffered(conn)
+        self._update_interest(conn)
+
+    def _on_introduce(self, conn, line):
+        self._end_handshake(conn)
+        message = decode_message(line)
+        if not message or message.get("type") != "introduce":
+            if conn.initiator:
+                print("[ERROR] Did not receive valid introduction from peer.")
+            else:
+                print(f"[WARN] Did not receive valid introduction from {conn.addr}. Closing connection.")
+            self._close(conn)
+            return
+        peer_username = message.get("username")
+        if conn.initiator:
+            print(f"[INFO] Connected to peer: {peer_username} at {conn.addr[0]}:{conn.addr[1]}")
+            self.network._apply_options(conn, self.network._accepted_options(message), message)
+        else:
+            print(f"[INFO] Connection request from {peer_username} at {conn.addr}")
+            callback = getattr(self.network, "connection_request_callback", None)
+            if callback and not callback(peer_username, conn.addr):
+                print(f"[INFO] Connection rejected from {peer_username} at {conn.addr}")
+                self._close(conn)
+                return
+            print(f"[INFO] Connection accepted from {peer_username} at {conn.addr}")
+            options = self.network._negotiate(message)
+            conn.send_message(self.network._introduce_message(options))
+            self.network._apply_options(conn, options, message)
+        conn.peer_username = peer_username
+        conn.handshake_done = True
+        if not self.network._register_connection(peer_username, conn):
+            self._close(conn)
+
+    def want_write(self, conn):
+        if conn.closed:
+            return
+        queue = conn.queue
+        if queue.coalesce and queue.coalesce_window and queue.depth_bytes < queue.coalesce_max_bytes:
+            # Hold small frames back briefly so more can join the same write.
+            item = queue.peek()
+            if item is not None and item.in_memory:
+                if not conn.flush_scheduled:
+                    conn.flush_scheduled = True
+                    self.call_later(queue.coalesce_window, self._flush_held, conn)
+                return
+        self._flush(conn)
+
+    def _flush_held(self, conn):
+        conn.flush_scheduled = False
+        if not conn.closed:
+            self._flush(conn)
+
+    def _flush(self, conn):
+        try:
+            while True:
+                item = conn.queue.peek()
+                if item is None:
+                    break
+                if conn.queue.coalesce and item.in_memory:
+                    batch = conn.queue.gather()
+                    buffers = [part for queued in batch for part in queued.parts]
+                    if conn.queue.advance(batch, send_buffers(conn.sock, buffers)):
+                        break
+                    continue
+                part = item.parts[0]
+                if isinstance(part, FileSegment):
+                    part.send_nonblocking(conn.sock)
+                    if part.count:
+                        break
+                else:
+                    sent = conn.sock.send(part)
+                    if sent < len(part):
+                        item.parts[0] = part[sent:]
+                        break
+                del item.parts[0]
+                if not item.parts:
+                    conn.queue.task_done(item)
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as e:
+            print(f"[ERROR] Sending to {conn.peer_username or conn.addr}: {e}")
+            self._close(conn)
+            return
+        if conn.close_after_flush and not len(conn.queue):
+            self._close(conn)
+            return
+        self._update_interest(conn)
+
+    def _update_interest(self, conn):
+        if conn.closed:
+            return
+        events = 0 if conn.read_paused else selectors.EVENT_READ
+        if conn.queue.has_ready():
+            events |= selectors.EVENT_WRITE
+        try:
+            key = self.selector.get_key(conn.sock)
+        except KeyError:
+            key = None
+        # A paused socket with nothing to write is taken out of the selector.
+        if not events:
+            if key is not None:
+                self.selector.unregister(conn.sock)
+        elif key is None:
+            self.selector.register(conn.sock, events, conn.handler)
+        elif key.events != events:
+            self.selector.modify(conn.sock, events, key.data)
+
+    def close_when_flushed(self, conn):
+        if conn.closed:
+            return
+        conn.close_after_flush = True
+        conn.queue.close()
+        self._flush(conn)
+
+    def _close(self, conn):
+        if conn.closed:
+            return
+        conn.closed = True
+        conn.queue.close()
+        self.conns.discard(conn)
+        self._end_handshake(conn)
+        try:
+            self.selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        conn.sock.close()
+        if conn.peer_username:
+            self.network._unregister_connection(conn)